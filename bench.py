@@ -0,0 +1,775 @@
+"""
+Бенчмарки обработчиков бота и методов базы.
+
+    python bench.py                                  # базы на 1k, 100k и 1M записей
+    python bench.py --sizes 1000 --save baseline.json
+    python bench.py --sizes 1000 --compare baseline.json
+
+Обработчики прогоняются через Dispatcher.feed_update с заглушкой
+сессии бота: без сети и без лимитера исходящих сообщений. Методы
+Database вызываются напрямую. Для каждого размера базы создаётся
+отдельный файл, засеянный синтетическими записями; старые записи
+переносятся в архив, как это делает архиватор в работе.
+
+Для каждой операции — p50/p95/p99 в микросекундах и пик памяти,
+выделенной за вызов (tracemalloc, отдельным прогоном, чтобы не
+искажать время). --save пишет результаты в JSON, --compare сверяет
+p50 с сохранённым прогоном и завершается с кодом 1 при регрессии.
+Параллельная нагрузка сравнивает задержку обработчиков и лаг event
+loop, когда база вызывается прямо в нём (как до AsyncDatabase), и через
+пулы потоков AsyncDatabase. Шаги записи повторяются на MemoryStorage
+и SQLiteStorage — разница показывает цену хранилища FSM. Запись и отмена повторяются
+без админа и с админом: хэндлер не ждёт AdminNotifier. Запросы /stats
+сравниваются с прежним подсчётом COUNT(*)/GROUP BY по appointments. Клавиатуры
+замеряются с холодным и тёплым KeyboardCache.
+Шторм нажатий показывает, сколько из сотен одновременных нажатий
+одного пользователя дошло до хэндлеров и базы без ограничителя и с ним.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from datetime import date, datetime, timedelta
+from time import perf_counter_ns
+from typing import Awaitable, Callable, Dict, List, Optional
+
+# Окружение бота задаётся до импорта: база во временном каталоге,
+# FSM в памяти (хранилище привязано к базе, созданной при импорте)
+_TMP = tempfile.TemporaryDirectory(prefix='bench_')
+os.environ.setdefault('BOT_TOKEN', '123456:bench')
+os.environ['DB_FILE'] = os.path.join(_TMP.name, 'import.db')
+os.environ['ADMIN_IDS'] = '1'
+os.environ['FSM_STORAGE'] = 'memory'
+
+import bot  # noqa: E402
+
+from aiogram import __version__ as aiogram_version  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.fsm.storage.base import StorageKey  # noqa: E402
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+from aiogram.types import CallbackQuery, Chat, Message, Update, User  # noqa: E402
+
+logging.disable(logging.INFO)
+
+ADMIN_ID = 1
+CLIENT_ID = 10 ** 9  # Постоянный клиент, от имени которого идут сценарии записи
+ALLOC_RUNS = 20      # Вызовов под tracemalloc на операцию
+SEED_CHUNK = 50_000
+FAR_FUTURE = 3000    # Сценарии бронирования берут дни, где засеянных записей нет
+STORM_ID = 2 * 10 ** 9  # Пользователи шторма нажатий (свои корзины на каждый прогон)
+STORM_TAPS = 200     # Нажатий одного вида кнопки в шторме
+LOAD_USERS = 50      # Одновременных пользователей в параллельной нагрузке
+LOAD_WRITERS = 10    # Из них подтверждают запись, остальные читают
+LAG_TICK = 0.001     # Период пробы отзывчивости event loop, секунды
+
+
+# ================================
+# 🧪 ЗАГЛУШКА СЕССИИ
+# ================================
+
+class StubSession(BaseSession):
+    """Сессия без сети: отправка и редактирование возвращают сообщение, остальное — True"""
+
+    def __init__(self):
+        super().__init__()
+        self._message_ids = itertools.count(1)
+        self.calls = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        name = type(method).__name__
+        if name.startswith(('Send', 'Edit')):
+            chat_id = getattr(method, 'chat_id', None) or CLIENT_ID
+            return Message(
+                message_id=next(self._message_ids),
+                date=datetime.now(),
+                chat=Chat(id=chat_id, type='private'),
+                text=getattr(method, 'text', None)
+            )
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+# ================================
+# 🌱 ЗАСЕВ БАЗЫ
+# ================================
+
+def seed(path: str, size: int) -> bot.Database:
+    """База с size записями за несколько лет: ~20% отменены, на слот — одна активная"""
+    database = bot.Database(path)
+    rng = random.Random(size)
+    today = date.today()
+    span = max(60, min(4 * 365, size // 10))
+    start = today - timedelta(days=span * 3 // 4)
+    clients = max(10, size // 10)
+    keys = list(bot.SERVICES)
+    taken = set()
+
+    with database._writer as conn:
+        conn.executemany(
+            "INSERT INTO clients (user_id, username, full_name, phone) VALUES (?, ?, ?, ?)",
+            ((user_id, f"user{user_id}", f"Клиент {user_id}", "+79000000000") for user_id in range(1, clients + 1))
+        )
+        conn.execute(
+            "INSERT INTO clients (user_id, username, full_name, phone, total_visits) VALUES (?, 'bench', 'Бенчмарк', '+79000000001', 1)",
+            (CLIENT_ID,)
+        )
+
+    def rows(count: int):
+        for _ in range(count):
+            day = (start + timedelta(days=rng.randrange(span))).isoformat()
+            time = rng.choice(bot.WORKING_HOURS)
+            key = rng.choice(keys)
+            status = 'cancelled'
+            if (day, time) not in taken and rng.random() < 0.8:
+                status = 'pending'
+                taken.add((day, time))
+            yield (rng.randrange(1, clients + 1), bot.SERVICES[key]['name'], key,
+                   day, time, bot.SERVICES[key]['price'], status)
+
+    for offset in range(0, size, SEED_CHUNK):
+        with database._writer as conn:
+            conn.executemany("""
+                INSERT INTO appointments (user_id, service, service_key, date, time, price, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, rows(min(SEED_CHUNK, size - offset)))
+
+    cutoff = (today - timedelta(days=bot.ARCHIVE_AFTER_DAYS)).isoformat()
+    while database.archive_batch(cutoff, SEED_CHUNK) == SEED_CHUNK:
+        pass
+    database._writer.execute("ANALYZE")
+    database.warm_slot_index()
+    return database
+
+
+# ================================
+# ⏱ ЗАМЕРЫ
+# ================================
+
+def summarize(samples: List[int], allocations: List[int]) -> dict:
+    samples = sorted(samples)
+
+    def percentile(q: float) -> float:
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] / 1000, 1)
+
+    return {
+        'p50_us': percentile(0.50),
+        'p95_us': percentile(0.95),
+        'p99_us': percentile(0.99),
+        'alloc_peak_kib': round(max(allocations) / 1024, 1) if allocations else 0.0,
+    }
+
+
+async def measure(call: Callable[[int], Awaitable], iterations: int,
+                  setup: Optional[Callable[[int], Awaitable]] = None) -> dict:
+    """Время iterations вызовов, затем пик памяти на ALLOC_RUNS вызовах; setup не замеряется"""
+    samples = []
+    for i in range(iterations):
+        if setup:
+            await setup(i)
+        started = perf_counter_ns()
+        await call(i)
+        samples.append(perf_counter_ns() - started)
+
+    allocations = []
+    tracemalloc.start()
+    try:
+        for i in range(iterations, iterations + ALLOC_RUNS):
+            if setup:
+                await setup(i)
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            await call(i)
+            allocations.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+
+    return summarize(samples, allocations)
+
+
+def sync_call(method: Callable, *args) -> Callable[[int], Awaitable]:
+    """Синхронный метод Database как замеряемый вызов"""
+    async def call(i: int):
+        method(*args)
+    return call
+
+
+# ================================
+# 🤖 СЦЕНАРИИ ОБРАБОТЧИКОВ
+# ================================
+
+_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> User:
+    return User(id=user_id, is_bot=False, first_name='Bench', username=f'user{user_id}')
+
+
+def message_update(user_id: int, text: str) -> Update:
+    return Update(update_id=next(_ids), message=Message(
+        message_id=next(_ids), date=datetime.now(),
+        chat=Chat(id=user_id, type='private'), from_user=_user(user_id), text=text
+    ))
+
+
+def callback_update(user_id: int, data: str) -> Update:
+    message = Message(
+        message_id=next(_ids), date=datetime.now(),
+        chat=Chat(id=user_id, type='private'), from_user=_user(42), text='bench'
+    )
+    return Update(update_id=next(_ids), callback_query=CallbackQuery(
+        id=str(next(_ids)), from_user=_user(user_id), chat_instance='bench', message=message, data=data
+    ))
+
+
+def far_day(i: int) -> str:
+    """Свободный день для i-й записи сценария"""
+    return (date.today() + timedelta(days=FAR_FUTURE + i)).isoformat()
+
+
+def handler_scenarios(database: bot.Database) -> Dict[str, tuple]:
+    """Имя -> (построение апдейта по номеру итерации, подготовка состояния или None)"""
+    service_key = next(iter(bot.SERVICES))
+    service = bot.SERVICES[service_key]
+    tomorrow = date.today() + timedelta(days=1)
+    next_month = (tomorrow.replace(day=1) + timedelta(days=32)).replace(day=1)
+    key = StorageKey(bot_id=bot.bot.id, chat_id=CLIENT_ID, user_id=CLIENT_ID)
+    profile = {'full_name': 'Бенчмарк', 'phone': '+79000000001'}
+    booking = {**profile, 'service': service['name'], 'service_key': service_key,
+               'price': service['price'], 'duration': service['duration']}
+    cancel_ids = {}
+
+    def state(fsm_state, data: dict):
+        async def setup(i: int):
+            await bot.storage.set_state(key, fsm_state)
+            await bot.storage.set_data(key, data(i) if callable(data) else data)
+        return setup
+
+    async def book_for_cancel(i: int):
+        cancel_ids[i] = database.add_appointment(
+            CLIENT_ID, service['name'], service_key, far_day(100_000 + i), bot.WORKING_HOURS[0], service['price']
+        )
+
+    return {
+        'cmd_start': (lambda i: message_update(CLIENT_ID, '/start'), None),
+        'start_booking': (lambda i: message_update(CLIENT_ID, '📅 Записаться на маникюр'), None),
+        'process_service': (lambda i: callback_update(CLIENT_ID, bot.ServiceCallback(key=service_key).pack()),
+                            state(bot.BookingStates.choosing_service, profile)),
+        'change_month': (lambda i: callback_update(CLIENT_ID, bot.MonthCallback(year=next_month.year, month=next_month.month).pack()),
+                         state(bot.BookingStates.choosing_date, booking)),
+        'process_date': (lambda i: callback_update(CLIENT_ID, bot.DateCallback(day=tomorrow.toordinal() + i % 30).pack()),
+                         state(bot.BookingStates.choosing_date, booking)),
+        'process_time': (lambda i: callback_update(CLIENT_ID, bot.TimeCallback(minutes=bot.to_minutes(bot.WORKING_HOURS[i % len(bot.WORKING_HOURS)])).pack()),
+                         state(bot.BookingStates.choosing_time, {**booking, 'date': tomorrow.isoformat()})),
+        'confirm_booking': (lambda i: callback_update(CLIENT_ID, bot.CB_CONFIRM),
+                            state(bot.BookingStates.confirming,
+                                  lambda i: {**booking, 'date': far_day(i), 'time': bot.WORKING_HOURS[0]})),
+        'my_appointments': (lambda i: message_update(CLIENT_ID, '📋 Мои записи'), None),
+        'cancel_appointment': (lambda i: callback_update(CLIENT_ID, bot.CancelCallback(appointment_id=cancel_ids.pop(i)).pack()), book_for_cancel),
+        'admin_panel': (lambda i: message_update(ADMIN_ID, '👑 Панель управления'), None),
+        'admin_today': (lambda i: message_update(ADMIN_ID, '/today'), None),
+        'admin_week': (lambda i: message_update(ADMIN_ID, '/week'), None),
+        'admin_all': (lambda i: message_update(ADMIN_ID, '/all'), None),
+        'admin_history': (lambda i: message_update(ADMIN_ID, '/history'), None),
+        'admin_stats': (lambda i: message_update(ADMIN_ID, '/stats'), None),
+    }
+
+
+async def bench_handlers(database: bot.Database, iterations: int) -> Dict[str, dict]:
+    # Один пользователь жмёт кнопки сотни раз подряд — ограничитель здесь мешал бы замеру
+    bot.throttle.enabled = False
+    results = {}
+    for name, (build, setup) in handler_scenarios(database).items():
+        async def call(i: int, build=build):
+            await bot.dp.feed_update(bot.bot, build(i))
+        results[name] = await measure(call, iterations, setup)
+    return results
+
+
+STORAGE_STEPS = ('process_service', 'change_month', 'process_date', 'process_time')
+
+
+async def bench_storage(database: bot.Database, iterations: int) -> Dict[str, dict]:
+    """
+    Шаги записи, которые читают и меняют состояние FSM, на MemoryStorage
+    aiogram и на SQLiteStorage бота; строки «Δ» — разница перцентилей,
+    то есть цена SQLiteStorage на один апдейт.
+    """
+    scenarios = handler_scenarios(database)
+    memory_storage, fsm_storage = bot.dp.fsm.storage, bot.storage
+    results = {}
+    for name, storage in (('memory', MemoryStorage()), ('sqlite', bot.SQLiteStorage(bot.db))):
+        bot.dp.fsm.storage = bot.storage = storage
+        try:
+            for step in STORAGE_STEPS:
+                build, setup = scenarios[step]
+
+                async def call(i: int, build=build):
+                    await bot.dp.feed_update(bot.bot, build(i))
+                results[f"{step}, {name}"] = await measure(call, iterations, setup)
+        finally:
+            await storage.close()
+    bot.dp.fsm.storage, bot.storage = memory_storage, fsm_storage
+
+    for step in STORAGE_STEPS:
+        memory, sqlite = results[f"{step}, memory"], results[f"{step}, sqlite"]
+        results[f"{step}, Δ"] = {
+            metric: round(sqlite[metric] - memory[metric], 1) for metric in ('p50_us', 'p95_us', 'p99_us', 'alloc_peak_kib')
+        }
+    return results
+
+
+async def bench_notifier(database: bot.Database, iterations: int) -> Dict[str, dict]:
+    """
+    Запись и отмена без админа и с админом на StubSession. Хэндлер только
+    ставит уведомление в очередь; разница «Δ» — время, которое воркер
+    AdminNotifier (чтение записи и отправка) делит с хэндлером в том же
+    loop, а не ожидание отправки.
+    """
+    service_key = next(iter(bot.SERVICES))
+    service = bot.SERVICES[service_key]
+    key = StorageKey(bot_id=bot.bot.id, chat_id=CLIENT_ID, user_id=CLIENT_ID)
+    booking = {'full_name': 'Бенчмарк', 'phone': '+79000000001', 'service': service['name'],
+               'service_key': service_key, 'price': service['price'], 'duration': service['duration']}
+    default_notifier = bot.notifier
+    results = {}
+    for offset, (name, admin_ids) in enumerate((('без админа', []), ('с админом', [ADMIN_ID])), start=4):
+        bot.notifier = bot.AdminNotifier(bot.bot, admin_ids)
+        cancel_ids = {}
+
+        async def confirm_setup(i: int, offset=offset):
+            await bot.storage.set_state(key, bot.BookingStates.confirming)
+            await bot.storage.set_data(key, {**booking, 'date': far_day(offset * 100_000 + i), 'time': bot.WORKING_HOURS[0]})
+
+        async def cancel_setup(i: int, offset=offset, cancel_ids=cancel_ids):
+            cancel_ids[i] = database.add_appointment(
+                CLIENT_ID, service['name'], service_key, far_day(offset * 100_000 + 50_000 + i),
+                bot.WORKING_HOURS[0], service['price']
+            )
+
+        async def confirm(i: int):
+            await bot.dp.feed_update(bot.bot, callback_update(CLIENT_ID, bot.CB_CONFIRM))
+
+        async def cancel(i: int, cancel_ids=cancel_ids):
+            await bot.dp.feed_update(bot.bot, callback_update(CLIENT_ID, bot.CancelCallback(appointment_id=cancel_ids.pop(i)).pack()))
+
+        results[f"confirm_booking, {name}"] = await measure(confirm, iterations, confirm_setup)
+        results[f"cancel, {name}"] = await measure(cancel, iterations, cancel_setup)
+        await bot.notifier.close()
+    bot.notifier = default_notifier
+
+    for step in ('confirm_booking', 'cancel'):
+        off, on = results[f"{step}, без админа"], results[f"{step}, с админом"]
+        results[f"{step}, Δ"] = {
+            metric: round(on[metric] - off[metric], 1) for metric in ('p50_us', 'p95_us', 'p99_us', 'alloc_peak_kib')
+        }
+    return results
+
+
+# Запросы /stats до сводок stats_*: подсчёт по appointments при каждом вызове
+LEGACY_STATS_QUERIES = {
+    'get_stats': (
+        "SELECT COUNT(*) FROM clients",
+        "SELECT COUNT(*) FROM appointments WHERE status = 'pending' AND date >= date('now')",
+        "SELECT COUNT(*) FROM appointments WHERE date = date('now') AND status = 'pending'",
+        """SELECT COUNT(*) FROM appointments
+           WHERE date BETWEEN date('now') AND date('now', '+7 days') AND status = 'pending'""",
+        """SELECT COALESCE(SUM(price), 0) FROM appointments
+           WHERE strftime('%Y-%m', date) = strftime('%Y-%m', 'now') AND status = 'pending'""",
+    ),
+    'get_services_stats': (
+        """SELECT service_key, COUNT(*), SUM(price) FROM appointments
+           WHERE status = 'pending' AND date >= date('now')
+           GROUP BY service_key""",
+    ),
+    'get_popular_days': (
+        """SELECT strftime('%w', date), COUNT(*) FROM appointments
+           WHERE status = 'pending'
+           GROUP BY strftime('%w', date)
+           ORDER BY COUNT(*) DESC
+           LIMIT 3""",
+    ),
+}
+
+
+async def bench_stats(database: bot.Database, iterations: int) -> Dict[str, dict]:
+    """Запросы /stats: прежний COUNT(*)/GROUP BY по appointments и чтение сводок"""
+    def legacy(queries: tuple) -> Callable[[int], Awaitable]:
+        async def call(i: int):
+            conn = database._reader()
+            for query in queries:
+                conn.execute(query).fetchall()
+        return call
+
+    results = {}
+    for name, queries in LEGACY_STATS_QUERIES.items():
+        results[f"{name}, COUNT(*)"] = await measure(legacy(queries), iterations)
+        results[f"{name}, сводки"] = await measure(sync_call(getattr(database, name)), iterations)
+    return results
+
+
+class InlineDatabase(bot.AsyncDatabase):
+    """Вызовы Database прямо в потоке event loop — поведение до AsyncDatabase, для сравнения"""
+
+    async def _run(self, executor, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+
+async def bench_concurrency(database: bot.Database, iterations: int) -> Dict[str, dict]:
+    """
+    Параллельная нагрузка: LOAD_USERS пользователей одновременно, из них
+    LOAD_WRITERS подтверждают запись, остальные открывают свои записи и
+    /start, а админ в это время пересчитывает статистику (/rebuild_stats).
+    Задержка апдейта — от прихода раунда до конца обработки; лаг loop —
+    опоздание пробуждения задачи-пробы каждые LAG_TICK. База вызывается
+    inline (до) и через AsyncDatabase (после).
+    """
+    service_key = next(iter(bot.SERVICES))
+    service = bot.SERVICES[service_key]
+    users = range(1, LOAD_USERS + 1)
+    rounds = max(1, iterations // LOAD_USERS)
+    days = itertools.count(300_000)
+    async_db = bot.db
+
+    async def timed(update: Update, arrived: int) -> int:
+        # От прихода апдейта, а не от старта задачи: иначе ожидание
+        # заблокированного loop в задержку не попадёт
+        await bot.dp.feed_update(bot.bot, update)
+        return perf_counter_ns() - arrived
+
+    results = {}
+    for name, layer in (('inline (до)', InlineDatabase(database)), ('AsyncDatabase (после)', async_db)):
+        bot.db = layer
+        samples = []
+        lags = []
+        ticking = True
+
+        async def ticker():
+            # Отзывчивость loop: на сколько опаздывает пробуждение через LAG_TICK
+            while ticking:
+                started = perf_counter_ns()
+                await asyncio.sleep(LAG_TICK)
+                lags.append(max(0, perf_counter_ns() - started - int(LAG_TICK * 1e9)))
+
+        probe = asyncio.create_task(ticker())
+        for _ in range(rounds):
+            updates = []
+            for user_id in users:
+                if user_id <= LOAD_WRITERS:
+                    key = StorageKey(bot_id=bot.bot.id, chat_id=user_id, user_id=user_id)
+                    await bot.storage.set_state(key, bot.BookingStates.confirming)
+                    await bot.storage.set_data(key, {
+                        'full_name': 'Бенчмарк', 'phone': '+79000000001', 'service': service['name'],
+                        'service_key': service_key, 'price': service['price'], 'duration': service['duration'],
+                        'date': far_day(next(days)), 'time': bot.WORKING_HOURS[0],
+                    })
+                    updates.append(callback_update(user_id, bot.CB_CONFIRM))
+                else:
+                    updates.append(message_update(user_id, '📋 Мои записи' if user_id % 2 else '/start'))
+            # Тот же раунд, пока админ пересчитывает статистику — долгий запрос к базе
+            arrived = perf_counter_ns()
+            admin = asyncio.create_task(bot.dp.feed_update(bot.bot, message_update(ADMIN_ID, '/rebuild_stats')))
+            samples += await asyncio.gather(*(timed(update, arrived) for update in updates))
+            await admin
+        ticking = False
+        await probe
+        results[name] = summarize(samples, [])
+        results[f"{name}, лаг loop"] = summarize(lags, [])
+    bot.db = async_db
+    return results
+
+
+async def bench_keyboards(iterations: int) -> Dict[str, dict]:
+    """Отрисовка клавиатур через KeyboardCache: холодный кэш (сброс перед каждым вызовом) и тёплый"""
+    today = date.today()
+    next_month = (today.replace(day=1) + timedelta(days=32)).replace(day=1)
+    samples = {
+        'render_calendar': (bot.render_calendar, (next_month.year, next_month.month, today, 0b1010, 0b0101)),
+        'render_time_keyboard': (bot.render_time_keyboard, (0b00100101, bot.closing_mask(bot.DEFAULT_DURATION))),
+    }
+    results = {}
+    for name, (render, args) in samples.items():
+        async def cold(i: int, render=render):
+            render.cache._items.clear()
+
+        results[f"{name} (холодный)"] = await measure(sync_call(render, *args), iterations, cold)
+        results[f"{name} (тёплый)"] = await measure(sync_call(render, *args), iterations)
+    return results
+
+
+async def bench_routing(iterations: int) -> Dict[str, dict]:
+    """Разбор callback_data: поиск префикса и unpack фабрикой, без хэндлера"""
+    samples = {
+        bot.ServiceCallback: bot.ServiceCallback(key=next(iter(bot.SERVICES))).pack(),
+        bot.MonthCallback: bot.MonthCallback(year=2030, month=12).pack(),
+        bot.DateCallback: bot.DateCallback(day=date.today().toordinal()).pack(),
+        bot.TimeCallback: bot.TimeCallback(minutes=bot.to_minutes(bot.WORKING_HOURS[-1])).pack(),
+        bot.CancelCallback: bot.CancelCallback(appointment_id=10 ** 9).pack(),
+        bot.HistoryPageCallback: bot.HistoryPageCallback(
+            date_from=bot.pack_date('2020-01-01'), date_to=bot.pack_date('2030-12-31'), backward=True,
+            day=bot.pack_date('2025-06-15'), minutes=bot.to_minutes(bot.WORKING_HOURS[0]), appointment_id=10 ** 9
+        ).pack(),
+    }
+    results = {}
+    for factory, data in samples.items():
+        results[factory.__name__] = await measure(sync_call(bot.callbacks.resolve, data), iterations)
+    results['static'] = await measure(sync_call(bot.callbacks.resolve, bot.CB_CONFIRM), iterations)
+    return results
+
+
+def _observations(family: str) -> int:
+    """Сколько замеров накопила гистограмма метрик бота (по всем меткам)"""
+    return sum(sum(histogram.counts) for histogram in bot.metrics._families[family][3].values())
+
+
+async def tap_storm(database: bot.Database) -> Dict[str, dict]:
+    """
+    Шторм нажатий: STORM_TAPS одновременных нажатий отмены чужой записи
+    и листания месяцев — без ограничителя и с ним. Повторы отмены ещё и
+    схлопываются IdempotencyGuard, поэтому база читается один раз и без
+    ограничителя; хэндлер при этом вызывается на каждое нажатие.
+    
+    db_calls — только вызовы базы из задач самих нажатий: фоновые
+    задачи (уведомления админу, лист ожидания) в счёт не идут.
+    """
+    appointment_id = database._reader().execute("SELECT MIN(id) FROM appointments").fetchone()[0]
+    next_month = (date.today().replace(day=1) + timedelta(days=32)).replace(day=1)
+    taps = {
+        'cancel': bot.CancelCallback(appointment_id=appointment_id).pack(),
+        'month': bot.MonthCallback(year=next_month.year, month=next_month.month).pack(),
+    }
+
+    storm_tasks = set()
+    db_calls = 0
+    run_db = bot.db._run
+
+    async def counted_run(executor, func, *args, **kwargs):
+        nonlocal db_calls
+        if asyncio.current_task() in storm_tasks:
+            db_calls += 1
+        return await run_db(executor, func, *args, **kwargs)
+
+    # Уведомления предыдущих сценариев не должны дописываться в шторм
+    await bot.notifier.close()
+    bot.db._run = counted_run
+    results = {}
+    try:
+        for enabled in (False, True):
+            bot.throttle.enabled = enabled
+            for name, data in taps.items():
+                user_id = STORM_ID + len(results)
+                handled, db_calls = _observations('bot_handler_duration_seconds'), 0
+                started = perf_counter_ns()
+                storm_tasks = {
+                    asyncio.create_task(bot.dp.feed_update(bot.bot, callback_update(user_id, data)))
+                    for _ in range(STORM_TAPS)
+                }
+                await asyncio.gather(*storm_tasks)
+                results[f"{name}{'' if enabled else ' (без ограничителя)'}"] = {
+                    'taps': STORM_TAPS,
+                    'handled': _observations('bot_handler_duration_seconds') - handled,
+                    'db_calls': db_calls,
+                    'ms': round((perf_counter_ns() - started) / 1e6, 1),
+                }
+    finally:
+        del bot.db._run
+        bot.throttle.enabled = bot.THROTTLE
+    return results
+
+
+# ================================
+# 🗄️ СЦЕНАРИИ БАЗЫ
+# ================================
+
+async def bench_database(database: bot.Database, iterations: int) -> Dict[str, dict]:
+    today = date.today()
+    today_str = today.isoformat()
+    tomorrow = (today + timedelta(days=1)).isoformat()
+    week_end = (today + timedelta(days=7)).isoformat()
+    service_key = next(iter(bot.SERVICES))
+    appointment_id = database._reader().execute("SELECT MAX(id) FROM appointments").fetchone()[0]
+    reserved = {}
+
+    async def reserve(i: int):
+        reserved[i] = database.reserve_appointment(
+            CLIENT_ID, 'bench', service_key, far_day(200_000 + i), bot.WORKING_HOURS[0], 0
+        )
+
+    async def cancel(i: int):
+        database.cancel_appointment(reserved.pop(i))
+
+    async def mark(i: int):
+        database.mark_reminded(reserved.pop(i))
+
+    scenarios = {
+        'get_client_info': (sync_call(database.get_client_info, CLIENT_ID), None),
+        'get_user_appointments': (sync_call(database.get_user_appointments, CLIENT_ID), None),
+        'get_appointments_by_date': (sync_call(database.get_appointments_by_date, tomorrow), None),
+        'get_day_bookings': (sync_call(database.get_day_bookings, tomorrow), None),
+        'get_blocked_mask': (sync_call(database.get_blocked_mask, tomorrow, bot.DEFAULT_DURATION), None),
+        'load_day': (sync_call(database.load_day, tomorrow), None),
+        'get_appointment_details': (sync_call(database.get_appointment_details, appointment_id), None),
+        'get_day_appointments': (sync_call(database.get_day_appointments, today_str), None),
+        'get_period_appointments': (sync_call(database.get_period_appointments, today_str, week_end), None),
+        'get_appointments_page': (sync_call(database.get_appointments_page), None),
+        'get_pending_totals': (sync_call(database.get_pending_totals), None),
+        'get_history_page': (sync_call(database.get_history_page, '0000-01-01', '9999-12-31'), None),
+        'get_stats': (sync_call(database.get_stats), None),
+        'get_services_stats': (sync_call(database.get_services_stats), None),
+        'get_popular_days': (sync_call(database.get_popular_days), None),
+        'get_due_reminders': (sync_call(database.get_due_reminders, today_str, tomorrow), None),
+        'get_fsm_record': (sync_call(database.get_fsm_record, 'missing'), None),
+        'add_client': (sync_call(database.add_client, CLIENT_ID, 'bench', 'Бенчмарк', '+79000000001'), None),
+        'reserve_appointment': (reserve, None),
+        'cancel_appointment': (cancel, reserve),
+        'mark_reminded': (mark, reserve),
+        'archive_batch': (sync_call(database.archive_batch, '0000-01-01'), None),
+    }
+
+    results = {}
+    for name, (call, setup) in scenarios.items():
+        results[name] = await measure(call, iterations, setup)
+    return results
+
+
+# ================================
+# 📊 ОТЧЁТ
+# ================================
+
+def print_storm(results: Dict[str, dict]):
+    print("\nШторм нажатий (одновременно, один пользователь)")
+    print(f"{'кнопка':<28}{'нажатий':>12}{'хэндлер':>12}{'база':>12}{'всего, мс':>12}")
+    for name, r in results.items():
+        print(f"{name:<28}{r['taps']:>12}{r['handled']:>12}{r['db_calls']:>12}{r['ms']:>12}")
+
+
+def print_table(title: str, results: Dict[str, dict]):
+    print(f"\n{title}")
+    print(f"{'операция':<28}{'p50, мкс':>12}{'p95, мкс':>12}{'p99, мкс':>12}{'пик, КиБ':>12}")
+    for name, r in results.items():
+        print(f"{name:<28}{r['p50_us']:>12}{r['p95_us']:>12}{r['p99_us']:>12}{r['alloc_peak_kib']:>12}")
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> List[str]:
+    """Операции, чей p50 вырос больше чем в (1 + threshold) раз"""
+    regressions = []
+    for size, groups in current['results'].items():
+        for group, operations in groups.items():
+            for name, r in operations.items():
+                old = baseline.get('results', {}).get(size, {}).get(group, {}).get(name)
+                if old and old['p50_us'] > 0 and r['p50_us'] > old['p50_us'] * (1 + threshold):
+                    regressions.append(
+                        f"{size}/{group}/{name}: p50 {old['p50_us']} -> {r['p50_us']} мкс "
+                        f"(x{r['p50_us'] / old['p50_us']:.2f})"
+                    )
+    return regressions
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(sizes: List[int], iterations: int) -> dict:
+    bot.dp.include_router(bot.router)
+    bot.bot.session = StubSession()
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'aiogram': aiogram_version,
+            'iterations': iterations,
+        },
+        'results': {},
+        'storm': {},
+    }
+
+    for size in sizes:
+        started = perf_counter_ns()
+        database = seed(os.path.join(_TMP.name, f'bench_{size}.db'), size)
+        bot.db = bot.AsyncDatabase(database)
+        print(f"\n=== {size} записей (засев {(perf_counter_ns() - started) / 1e9:.1f} с) ===")
+
+        handlers = await bench_handlers(database, iterations)
+        print_table("Обработчики (feed_update)", handlers)
+        storages = await bench_storage(database, iterations)
+        print_table("Хранилища FSM (MemoryStorage и SQLiteStorage)", storages)
+        notifications = await bench_notifier(database, iterations)
+        print_table("Уведомления админу (AdminNotifier)", notifications)
+        stats = await bench_stats(database, iterations)
+        print_table("Статистика /stats (COUNT(*) и сводки)", stats)
+        concurrency = await bench_concurrency(database, iterations)
+        print_table(f"Обработчики под нагрузкой ({LOAD_USERS} пользователей, {LOAD_WRITERS} пишут)", concurrency)
+        methods = await bench_database(database, iterations)
+        print_table("Методы Database", methods)
+        routing = await bench_routing(iterations)
+        print_table("Разбор кнопок (CallbackRouter.resolve)", routing)
+        keyboards = await bench_keyboards(iterations)
+        print_table("Клавиатуры (KeyboardCache)", keyboards)
+        report['results'][str(size)] = {
+            'handlers': handlers, 'storage': storages, 'notifier': notifications, 'stats': stats, 'concurrency': concurrency, 'database': methods, 'routing': routing,
+            'keyboards': keyboards,
+        }
+        report['storm'][str(size)] = storm = await tap_storm(database)
+        print_storm(storm)
+
+        await bot.notifier.close()
+        await bot.db.close()
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки обработчиков и методов базы")
+    parser.add_argument('--sizes', default='1000,100000,1000000',
+                        help="Размеры баз через запятую (по умолчанию 1000,100000,1000000)")
+    parser.add_argument('--iterations', type=int, default=200, help="Замеров на операцию")
+    parser.add_argument('--save', metavar='FILE', help="Сохранить результаты в JSON")
+    parser.add_argument('--compare', metavar='FILE', help="Сравнить p50 с сохранённым JSON")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Допустимый рост p50 при сравнении (0.2 = +20%%)")
+    args = parser.parse_args()
+
+    report = asyncio.run(run([int(size) for size in args.sizes.split(',')], args.iterations))
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Результаты сохранены в {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        print(f"\nСравнение с {args.compare} (ревизия {baseline.get('meta', {}).get('revision')}):")
+        if regressions:
+            print("\n".join(f"⚠️ {line}" for line in regressions))
+            sys.exit(1)
+        print("✅ Регрессий нет")
+
+
+if __name__ == "__main__":
+    main()
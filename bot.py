@@ -6,18 +6,35 @@
 """
 
 import asyncio
+import inspect
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, List
+from functools import partial, wraps
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from heapq import heappop, heappush
+from itertools import count
+from typing import Any, Callable, Dict, List, Literal, Optional
 import sqlite3
+import threading
+import traceback
+import sys
+from time import monotonic, perf_counter
 import os
 import re
 
-from aiogram import Bot, Dispatcher, F, Router
-from aiogram.filters import Command, StateFilter
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.filters import Command, CommandObject, StateFilter
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
 from aiogram.types import (
     Message, 
     CallbackQuery, 
@@ -27,7 +44,13 @@ from aiogram.types import (
     KeyboardButton,
     ReplyKeyboardRemove
 )
-from aiogram.exceptions import TelegramBadRequest
+from pydantic import field_validator
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError
+)
 
 # ================================
 # 🎯 КОНФИГУРАЦИЯ
@@ -36,220 +59,1673 @@ from aiogram.exceptions import TelegramBadRequest
 BOT_TOKEN = os.getenv('BOT_TOKEN', "8583432941:AAHA0aaAtDwCsj_Agrn6e1jDIsSNzirde6c")
 ADMIN_IDS = [int(id) for id in os.getenv('ADMIN_IDS', '8485520947').split(',')]
 
+# База данных
+DB_FILE = os.getenv('DB_FILE', "manicure.db")
+DB_READERS = int(os.getenv('DB_READERS', 4))  # Размер пула читающих соединений
+
+# Доставка обновлений: webhook, если задан WEBHOOK_URL, иначе polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # Общий для всех процессов: Telegram шлёт его с каждым обновлением
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise SystemExit("❌ Задан WEBHOOK_URL, но не задан WEBHOOK_SECRET")
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', 20))
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '')  # Свой Bot API сервер (например, локальный стенд)
+
+# Лимиты исходящих сообщений (сообщений в секунду)
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', 30))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', 1))
+OUTBOUND_GROUP_RATE = float(os.getenv('OUTBOUND_GROUP_RATE', 20 / 60))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', 5))  # Сколько сообщений в чат можно отправить подряд
+
+# Напоминания: за сколько до визита и на сколько вперёд держать их в памяти
+REMINDER_LEAD = timedelta(hours=int(os.getenv('REMINDER_LEAD_HOURS', 24)))
+REMINDER_HORIZON = timedelta(hours=int(os.getenv('REMINDER_HORIZON_HOURS', 24)))
+
+# Хранилище FSM: 'sqlite' (переживает перезапуск) или 'memory'
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', 0.5))  # Секунды между сбросами на диск
+FSM_TTL = int(os.getenv('FSM_TTL', 2 * 24 * 3600))  # Брошенная запись живёт в памяти 2 дня
+FSM_MAX_ENTRIES = int(os.getenv('FSM_MAX_ENTRIES', 10000))
+
+# Админ-панель: записей на одной странице /all и /history
+ADMIN_PAGE_SIZE = int(os.getenv('ADMIN_PAGE_SIZE', 10))
+
+# Архив: прошедшие и отменённые записи старше ARCHIVE_AFTER_DAYS дней
+# переносятся из рабочей таблицы пачками по ARCHIVE_BATCH
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 30))
+ARCHIVE_BATCH = int(os.getenv('ARCHIVE_BATCH', 500))
+ARCHIVE_INTERVAL = int(os.getenv('ARCHIVE_INTERVAL', 6 * 3600))  # Секунды между проходами
+
+# Мониторинг event loop: задержка тиков и поиск блокирующих вызовов
+LOOP_MONITOR = os.getenv('LOOP_MONITOR', '1') == '1'  # Включается и на ходу командой /loop_monitor
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.25))  # Секунды между тиками
+LOOP_BLOCK_THRESHOLD = float(os.getenv('LOOP_BLOCK_THRESHOLD', 0.2))  # Блокировка дольше — в лог со стеком
+
+# Кэш профилей клиентов перед get_client_info
+CLIENT_CACHE_SIZE = int(os.getenv('CLIENT_CACHE_SIZE', 10000))
+CLIENT_CACHE_NEGATIVE = os.getenv('CLIENT_CACHE_NEGATIVE', '1') == '1'  # Запоминать и незарегистрированных
+
+# Защита от частых нажатий: корзины токенов на пользователя и на вид кнопки
+THROTTLE = os.getenv('THROTTLE', '1') == '1'
+THROTTLE_USER_RATE = float(os.getenv('THROTTLE_USER_RATE', 5))  # Нажатий в секунду на все кнопки
+THROTTLE_USER_BURST = int(os.getenv('THROTTLE_USER_BURST', 10))
+THROTTLE_ACTION_RATE = float(os.getenv('THROTTLE_ACTION_RATE', 2))  # Нажатий в секунду на кнопки одного вида
+THROTTLE_ACTION_BURST = int(os.getenv('THROTTLE_ACTION_BURST', 3))
+THROTTLE_COALESCE_WAIT = float(os.getenv('THROTTLE_COALESCE_WAIT', 1.0))  # Дольше навигацию не откладываем
+THROTTLE_MAX_USERS = int(os.getenv('THROTTLE_MAX_USERS', 10000))
+
+# Повторные нажатия подтверждения и отмены: сколько помнить результат первого
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 30))
+IDEMPOTENCY_MAX = int(os.getenv('IDEMPOTENCY_MAX', 10000))
+
+# Лист ожидания: сколько держать освободившийся слот за первым в очереди
+WAITLIST_HOLD = int(os.getenv('WAITLIST_HOLD', 15 * 60))  # Секунды
+WAITLIST_CLEANUP_INTERVAL = int(os.getenv('WAITLIST_CLEANUP_INTERVAL', 3600))  # Секунды между чистками прошедших дат
+
 # Информация о салоне
 MASTER_NAME = "Юлия"
 SALON_ADDRESS = "г. Каменка, ул. Суворова"
 SALON_PHONE = "+7 (900) 123-45-67"  # 👈 Укажите реальный номер
 INSTAGRAM = "@julia_nails_kamenka"  # 👈 Укажите реальный Instagram
 
+# ================================
+# 📈 МЕТРИКИ
+# ================================
+
+# Границы гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    """Гистограмма с фиксированными границами (бакеты — как le в Prometheus)"""
+    __slots__ = ('counts', 'sum')
+    
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+    
+    def observe(self, value: float):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+
+class Metrics:
+    """
+    Счётчики и гистограммы в памяти с выдачей в текстовом формате
+    Prometheus.
+    
+    Пишут в них только корутины в потоке event loop (замеры базы — тоже,
+    уже после await), поэтому блокировки не нужны: запись — поиск в
+    словаре и пара сложений.
+    """
+    
+    def __init__(self):
+        self._families: Dict[str, tuple] = {}  # имя -> (тип, метка, описание, {значение метки: данные})
+    
+    def counter(self, name: str, label: str, description: str):
+        self._families[name] = ('counter', label, description, {})
+    
+    def histogram(self, name: str, label: str, description: str):
+        self._families[name] = ('histogram', label, description, {})
+    
+    def inc(self, name: str, label_value: str, amount: int = 1):
+        values = self._families[name][3]
+        values[label_value] = values.get(label_value, 0) + amount
+    
+    def observe(self, name: str, label_value: str, seconds: float):
+        values = self._families[name][3]
+        histogram = values.get(label_value)
+        if histogram is None:
+            histogram = values[label_value] = Histogram()
+        histogram.observe(seconds)
+    
+    def render(self, components: Optional[Dict[str, dict]] = None) -> str:
+        """Текст для /metrics; components — словари stats() компонентов, выдаются как gauge"""
+        lines = []
+        for name, (kind, label, description, values) in self._families.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for label_value, value in sorted(values.items()):
+                label_value = _escape_label(label_value)
+                if kind == 'counter':
+                    lines.append(f'{name}{{{label}="{label_value}"}} {value}')
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(LATENCY_BUCKETS + ('+Inf',), value.counts):
+                    cumulative += bucket
+                    lines.append(f'{name}_bucket{{{label}="{label_value}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{label}="{label_value}"}} {value.sum}')
+                lines.append(f'{name}_count{{{label}="{label_value}"}} {cumulative}')
+        
+        if components:
+            lines.append("# HELP bot_component_stat Внутренняя статистика компонентов бота")
+            lines.append("# TYPE bot_component_stat gauge")
+            for component, stats in components.items():
+                for stat, value in _flatten_stats(stats):
+                    lines.append(
+                        f'bot_component_stat{{component="{_escape_label(component)}",stat="{_escape_label(stat)}"}} {value}'
+                    )
+        return "\n".join(lines) + "\n"
+
+def _escape_label(value) -> str:
+    """Значение метки по правилам текстового формата Prometheus"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _flatten_stats(stats: dict, prefix: str = ""):
+    """Вложенный словарь stats() -> пары (путь_через_подчёркивание, число)"""
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            yield from _flatten_stats(value, f"{prefix}{key}_")
+        elif isinstance(value, (int, float)):
+            yield f"{prefix}{key}", value
+
+metrics = Metrics()
+metrics.counter('bot_updates_total', 'type', "Обработанные обновления Telegram")
+metrics.counter('bot_update_errors_total', 'type', "Обновления, обработка которых завершилась исключением")
+metrics.histogram('bot_update_duration_seconds', 'type', "Время обработки обновления целиком")
+metrics.histogram('bot_handler_duration_seconds', 'handler', "Время работы хэндлера")
+metrics.counter('bot_handler_errors_total', 'handler', "Исключения в хэндлерах")
+metrics.histogram('bot_db_duration_seconds', 'method', "Время вызова метода базы, включая ожидание в очереди потока")
+metrics.counter('bot_db_errors_total', 'method', "Исключения в методах базы")
+metrics.counter('bot_throttled_total', 'action', "Нажатия кнопок, отброшенные или схлопнутые ограничителем")
+metrics.counter('bot_callback_duplicates_total', 'handler', "Повторные нажатия, получившие результат первого")
+
 # ================================
 # 🗄️ УЛУЧШЕННАЯ БАЗА ДАННЫХ
 # ================================
 
+# Триггеры материализованной статистики (stats_counters, stats_daily, stats_monthly, stats_service_daily)
+# При изменении состава таблиц увеличивайте STATS_VERSION — статистика пересчитается при запуске
+STATS_VERSION = 2
+# Удаление уходит в статистику, только если строка не перенесена в архив —
+# история остаётся в сводках. Старые триггеры удаления заменены такими
+OBSOLETE_TRIGGERS = ['trg_stats_appointment_delete', 'trg_service_stats_delete']
+STATS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_stats_client_insert AFTER INSERT ON clients
+    BEGIN
+        INSERT INTO stats_counters (name, value) VALUES ('total_clients', 1)
+        ON CONFLICT(name) DO UPDATE SET value = value + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_stats_appointment_insert AFTER INSERT ON appointments
+    WHEN NEW.status = 'pending'
+    BEGIN
+        INSERT INTO stats_daily (date, pending_count, pending_revenue)
+        VALUES (NEW.date, 1, COALESCE(NEW.price, 0))
+        ON CONFLICT(date) DO UPDATE SET
+            pending_count = pending_count + 1,
+            pending_revenue = pending_revenue + excluded.pending_revenue;
+        INSERT INTO stats_monthly (month, pending_count, pending_revenue)
+        VALUES (substr(NEW.date, 1, 7), 1, COALESCE(NEW.price, 0))
+        ON CONFLICT(month) DO UPDATE SET
+            pending_count = pending_count + 1,
+            pending_revenue = pending_revenue + excluded.pending_revenue;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_stats_appointment_leave AFTER UPDATE OF status ON appointments
+    WHEN OLD.status = 'pending' AND NEW.status != 'pending'
+    BEGIN
+        UPDATE stats_daily SET
+            pending_count = pending_count - 1,
+            pending_revenue = pending_revenue - COALESCE(OLD.price, 0)
+        WHERE date = OLD.date;
+        UPDATE stats_monthly SET
+            pending_count = pending_count - 1,
+            pending_revenue = pending_revenue - COALESCE(OLD.price, 0)
+        WHERE month = substr(OLD.date, 1, 7);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_stats_appointment_return AFTER UPDATE OF status ON appointments
+    WHEN OLD.status != 'pending' AND NEW.status = 'pending'
+    BEGIN
+        INSERT INTO stats_daily (date, pending_count, pending_revenue)
+        VALUES (NEW.date, 1, COALESCE(NEW.price, 0))
+        ON CONFLICT(date) DO UPDATE SET
+            pending_count = pending_count + 1,
+            pending_revenue = pending_revenue + excluded.pending_revenue;
+        INSERT INTO stats_monthly (month, pending_count, pending_revenue)
+        VALUES (substr(NEW.date, 1, 7), 1, COALESCE(NEW.price, 0))
+        ON CONFLICT(month) DO UPDATE SET
+            pending_count = pending_count + 1,
+            pending_revenue = pending_revenue + excluded.pending_revenue;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_service_stats_insert AFTER INSERT ON appointments
+    WHEN NEW.status = 'pending'
+    BEGIN
+        INSERT INTO stats_service_daily (date, service_key, pending_count, pending_revenue)
+        VALUES (NEW.date, COALESCE(NEW.service_key, ''), 1, COALESCE(NEW.price, 0))
+        ON CONFLICT(date, service_key) DO UPDATE SET
+            pending_count = pending_count + 1,
+            pending_revenue = pending_revenue + excluded.pending_revenue;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_service_stats_leave AFTER UPDATE OF status ON appointments
+    WHEN OLD.status = 'pending' AND NEW.status != 'pending'
+    BEGIN
+        UPDATE stats_service_daily SET
+            pending_count = pending_count - 1,
+            pending_revenue = pending_revenue - COALESCE(OLD.price, 0)
+        WHERE date = OLD.date AND service_key = COALESCE(OLD.service_key, '');
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_service_stats_return AFTER UPDATE OF status ON appointments
+    WHEN OLD.status != 'pending' AND NEW.status = 'pending'
+    BEGIN
+        INSERT INTO stats_service_daily (date, service_key, pending_count, pending_revenue)
+        VALUES (NEW.date, COALESCE(NEW.service_key, ''), 1, COALESCE(NEW.price, 0))
+        ON CONFLICT(date, service_key) DO UPDATE SET
+            pending_count = pending_count + 1,
+            pending_revenue = pending_revenue + excluded.pending_revenue;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_service_stats_purge AFTER DELETE ON appointments
+    WHEN OLD.status = 'pending' AND NOT EXISTS (SELECT 1 FROM appointments_archive WHERE id = OLD.id)
+    BEGIN
+        UPDATE stats_service_daily SET
+            pending_count = pending_count - 1,
+            pending_revenue = pending_revenue - COALESCE(OLD.price, 0)
+        WHERE date = OLD.date AND service_key = COALESCE(OLD.service_key, '');
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_stats_appointment_purge AFTER DELETE ON appointments
+    WHEN OLD.status = 'pending' AND NOT EXISTS (SELECT 1 FROM appointments_archive WHERE id = OLD.id)
+    BEGIN
+        UPDATE stats_daily SET
+            pending_count = pending_count - 1,
+            pending_revenue = pending_revenue - COALESCE(OLD.price, 0)
+        WHERE date = OLD.date;
+        UPDATE stats_monthly SET
+            pending_count = pending_count - 1,
+            pending_revenue = pending_revenue - COALESCE(OLD.price, 0)
+        WHERE month = substr(OLD.date, 1, 7);
+    END
+    """,
+]
+
+# Горячие запросы: методы Database берут SQL отсюда, а check_query_plans
+# следит, чтобы ни один из них не скатился в полный просмотр таблицы.
+# Просмотр сводок stats_* допустим: они растут по календарю, а не по записям
+HOT_QUERIES = {
+    'user_appointments': """
+        SELECT id, service, date, time, status, price
+        FROM appointments
+        WHERE user_id = ? AND status = 'pending' AND date >= ?
+        ORDER BY date, time
+    """,
+    'day_bookings': """
+        SELECT time, service_key FROM appointments
+        WHERE status = 'pending' AND date = ?
+    """,
+    'upcoming_bookings': """
+        SELECT date, time, service_key FROM appointments
+        WHERE status = 'pending' AND date >= ?
+    """,
+    'appointment_details': """
+        SELECT a.user_id, c.full_name, c.phone, a.service, a.date, a.time, a.price
+        FROM appointments a
+        JOIN clients c ON a.user_id = c.user_id
+        WHERE a.id = ?
+    """,
+    'day_appointments': """
+        SELECT a.id, c.full_name, c.phone, a.service, a.time, a.price
+        FROM appointments a
+        JOIN clients c ON a.user_id = c.user_id
+        WHERE a.status = 'pending' AND a.date = ?
+        ORDER BY a.time
+    """,
+    'period_appointments': """
+        SELECT a.date, a.time, c.full_name, c.phone, a.service, a.price
+        FROM appointments a
+        JOIN clients c ON a.user_id = c.user_id
+        WHERE a.status = 'pending' AND a.date BETWEEN ? AND ?
+        ORDER BY a.date, a.time
+    """,
+    'appointments_after': """
+        SELECT a.id, c.full_name, c.phone, a.service, a.date, a.time, a.price
+        FROM appointments a
+        JOIN clients c ON a.user_id = c.user_id
+        WHERE a.status = 'pending' AND (a.date, a.time, a.id) > (?, ?, ?)
+        ORDER BY a.date, a.time, a.id
+        LIMIT ?
+    """,
+    'appointments_before': """
+        SELECT a.id, c.full_name, c.phone, a.service, a.date, a.time, a.price
+        FROM appointments a
+        JOIN clients c ON a.user_id = c.user_id
+        WHERE a.status = 'pending' AND (a.date, a.time, a.id) < (?, ?, ?)
+        ORDER BY a.date DESC, a.time DESC, a.id DESC
+        LIMIT ?
+    """,
+    'pending_totals': """
+        SELECT COALESCE(SUM(pending_count), 0), COALESCE(SUM(pending_revenue), 0)
+        FROM stats_daily
+        WHERE date >= (SELECT MIN(date) FROM appointments WHERE status = 'pending')
+    """,
+    'archive_candidates': """
+        SELECT id FROM appointments
+        WHERE date <= (
+            SELECT MAX(date) FROM (
+                SELECT date FROM appointments WHERE date < ? ORDER BY date LIMIT ?
+            )
+        )
+    """,
+    'history_older': """
+        SELECT a.id, c.full_name, c.phone, a.service, a.date, a.time, a.price, a.status
+        FROM appointments_archive a
+        LEFT JOIN clients c ON a.user_id = c.user_id
+        WHERE a.date BETWEEN ? AND ? AND (a.date, a.time, a.id) < (?, ?, ?)
+        ORDER BY a.date DESC, a.time DESC, a.id DESC
+        LIMIT ?
+    """,
+    'history_newer': """
+        SELECT a.id, c.full_name, c.phone, a.service, a.date, a.time, a.price, a.status
+        FROM appointments_archive a
+        LEFT JOIN clients c ON a.user_id = c.user_id
+        WHERE a.date BETWEEN ? AND ? AND (a.date, a.time, a.id) > (?, ?, ?)
+        ORDER BY a.date, a.time, a.id
+        LIMIT ?
+    """,
+    'client_info': """
+        SELECT full_name, phone, total_visits, created_at
+        FROM clients WHERE user_id = ?
+    """,
+    'stats': """
+        SELECT
+            (SELECT COALESCE(SUM(value), 0) FROM stats_counters WHERE name = 'total_clients'),
+            (SELECT COALESCE(SUM(pending_count), 0) FROM stats_daily WHERE date >= ?),
+            (SELECT COALESCE(SUM(pending_count), 0) FROM stats_daily WHERE date = ?),
+            (SELECT COALESCE(SUM(pending_count), 0) FROM stats_daily WHERE date BETWEEN ? AND ?),
+            (SELECT COALESCE(SUM(pending_revenue), 0) FROM stats_monthly WHERE month = ?)
+    """,
+    'services_stats': """
+        SELECT service_key, SUM(pending_count), SUM(pending_revenue)
+        FROM stats_service_daily
+        WHERE date >= ?
+        GROUP BY service_key
+        HAVING SUM(pending_count) > 0
+    """,
+    'due_reminders': """
+        SELECT id, date, time, datetime(created_at, 'localtime') FROM appointments INDEXED BY idx_reminder_due
+        WHERE date BETWEEN ? AND ?
+        AND status = 'pending' AND reminded_at IS NULL
+        ORDER BY date, time
+    """,
+    'fsm_record': "SELECT state, data FROM fsm_storage WHERE key = ?",
+}
+
+class AvailabilityIndex:
+    """
+    Занятые интервалы по датам в памяти процесса.
+    
+    Для каждой даты хранится отсортированный список интервалов
+    (начало, конец) в минутах от полуночи, пересечения ищутся через
+    bisect. Все даты начиная с warm_from загружены целиком, более
+    ранние подгружаются из базы по запросу.
+    """
+    
+    def __init__(self, hours: List[str], closing_time: str):
+        self._starts = [to_minutes(time) for time in hours]
+        self._closing = to_minutes(closing_time)
+        self._days: Dict[str, List[tuple]] = {}
+        self._max_length = 0
+        self.warm_from = None
+        self.hits = 0
+        self.misses = 0
+    
+    def warm(self, rows: List[tuple], since: str):
+        """Заполнение индекса строками (date, time, service_key) активных записей"""
+        self._days.clear()
+        for date, time, service_key in rows:
+            self.add(date, time, service_duration(service_key), force=True)
+        self.warm_from = since
+    
+    def is_loaded(self, date: str) -> bool:
+        """Есть ли дата в индексе целиком"""
+        return date in self._days or (self.warm_from is not None and date >= self.warm_from)
+    
+    def set_day(self, date: str, rows: List[tuple]):
+        """Загрузка одной даты строками (time, service_key)"""
+        self._days.pop(date, None)
+        for time, service_key in rows:
+            self.add(date, time, service_duration(service_key), force=True)
+        self._days.setdefault(date, [])
+    
+    def forget_before(self, date: str):
+        """Выгрузка дат раньше date: при следующем обращении они загрузятся из базы заново"""
+        for day in [day for day in self._days if day < date]:
+            del self._days[day]
+    
+    def advance(self, since: str):
+        """Сдвиг warm_from вперёд: прошедшие даты больше не считаются загруженными"""
+        if self.warm_from is not None and since > self.warm_from:
+            self.forget_before(since)
+            self.warm_from = since
+    
+    def add(self, date: str, time: str, duration: int, force: bool = False):
+        if not force and not self.is_loaded(date):
+            return
+        start = to_minutes(time)
+        insort(self._days.setdefault(date, []), (start, start + duration))
+        self._max_length = max(self._max_length, duration)
+    
+    def remove(self, date: str, time: str, duration: int):
+        intervals = self._days.get(date)
+        if not intervals:
+            return
+        start = to_minutes(time)
+        i = bisect_left(intervals, (start, start + duration))
+        if i < len(intervals) and intervals[i] == (start, start + duration):
+            del intervals[i]
+    
+    def _overlaps(self, intervals: List[tuple], start: int, end: int) -> bool:
+        # Пересечься могут только интервалы, начавшиеся не раньше start - max_length
+        lo = bisect_left(intervals, (start - self._max_length,))
+        hi = bisect_left(intervals, (end,))
+        return any(busy_end > start for _, busy_end in intervals[lo:hi])
+    
+    def blocked_mask(self, date: str, duration: int):
+        """
+        Маска стартов WORKING_HOURS, куда услуга длительностью duration
+        не помещается (бит i — WORKING_HOURS[i]). None, если дата не загружена.
+        """
+        if not self.is_loaded(date):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.compute_mask(date, duration)
+    
+    def compute_mask(self, date: str, duration: int) -> int:
+        """То же, что blocked_mask, без учёта в счётчиках"""
+        intervals = self._days.get(date, ())
+        mask = 0
+        for i, start in enumerate(self._starts):
+            end = start + duration
+            if end > self._closing or (intervals and self._overlaps(intervals, start, end)):
+                mask |= 1 << i
+        return mask
+    
+    def month_summary(self, year: int, month: int, duration: int) -> tuple:
+        """
+        Загруженность месяца для услуги длительностью duration:
+        (full_days, partial_days) — битовые маски по дням (бит d-1 — день d).
+        """
+        full_mask = (1 << len(self._starts)) - 1
+        full_days = partial_days = 0
+        prefix = f"{year:04d}-{month:02d}-"
+        for day in range(1, 32):
+            if not self._days.get(f"{prefix}{day:02d}"):
+                continue
+            if self.compute_mask(f"{prefix}{day:02d}", duration) == full_mask:
+                full_days |= 1 << (day - 1)
+            else:
+                partial_days |= 1 << (day - 1)
+        return full_days, partial_days
+    
+    def fits(self, date: str, time: str, duration: int) -> bool:
+        start = to_minutes(time)
+        end = start + duration
+        return end <= self._closing and not self._overlaps(self._days.get(date, []), start, end)
+    
+    def snapshot(self) -> Dict[str, List[tuple]]:
+        return {date: list(intervals) for date, intervals in self._days.items() if intervals}
+    
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'days': len(self._days),
+            'intervals': sum(len(intervals) for intervals in self._days.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
 class Database:
-    def __init__(self, db_file: str = "manicure.db"):
+    def __init__(self, db_file: str = DB_FILE):
         self.db_file = db_file
+        # Одно долгоживущее пишущее соединение + по читающему на поток
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+        self._writer = self._connect()
+        self.slots = AvailabilityIndex(WORKING_HOURS, CLOSING_TIME)
+        self.holds: Dict[int, tuple] = {}  # id в waitlist -> (date, time, duration) удержанного слота
         self.init_db()
+        self.warm_slot_index()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Открытие соединения в режиме WAL"""
+        conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+    
+    def _reader(self) -> sqlite3.Connection:
+        """Читающее соединение текущего потока"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            self._readers.append(conn)
+        return conn
+    
+    def close(self):
+        """Закрытие всех соединений"""
+        with self._write_lock:
+            self._writer.close()
+        for conn in self._readers:
+            conn.close()
+        self._readers.clear()
     
     def init_db(self):
         """Инициализация базы данных"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        # Таблица клиентов с дополнительными полями
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS clients (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                full_name TEXT,
-                phone TEXT,
-                total_visits INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_visit TIMESTAMP
-            )
-        """)
-        
-        # Таблица записей с улучшенной структурой
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS appointments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                service TEXT,
-                service_key TEXT,
-                date TEXT,
-                time TEXT,
-                price INTEGER,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                cancelled_at TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES clients (user_id)
-            )
-        """)
+        with self._write_lock, self._writer as conn:
+            cursor = conn.cursor()
+            
+            # Таблица клиентов с дополнительными полями
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS clients (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    full_name TEXT,
+                    phone TEXT,
+                    total_visits INTEGER DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_visit TIMESTAMP
+                )
+            """)
+            
+            # Таблица записей с улучшенной структурой
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS appointments (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    service TEXT,
+                    service_key TEXT,
+                    date TEXT,
+                    time TEXT,
+                    price INTEGER,
+                    status TEXT DEFAULT 'pending',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    cancelled_at TIMESTAMP,
+                    reminded_at TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES clients (user_id)
+                )
+            """)
+            
+            # Миграция баз, созданных до появления напоминаний
+            columns = {row[1] for row in cursor.execute("PRAGMA table_info(appointments)")}
+            if 'reminded_at' not in columns:
+                cursor.execute("ALTER TABLE appointments ADD COLUMN reminded_at TIMESTAMP")
+            
+            # Индексы для быстрого поиска
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_date ON appointments(date, time)")
+            # Составные индексы под горячие запросы; одиночные по user_id и status
+            # они полностью покрывают
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_status_date ON appointments(user_id, status, date, time)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_status_date ON appointments(status, date, time, service_key)")
+            cursor.execute("DROP INDEX IF EXISTS idx_user")
+            cursor.execute("DROP INDEX IF EXISTS idx_status")
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_reminder_due ON appointments(date, time)
+                WHERE status = 'pending' AND reminded_at IS NULL
+            """)
+            
+            # Материализованная статистика: поддерживается триггерами
+            # в той же транзакции, что и изменение записей
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS stats_counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS stats_daily (
+                    date TEXT PRIMARY KEY,
+                    pending_count INTEGER NOT NULL DEFAULT 0,
+                    pending_revenue INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS stats_monthly (
+                    month TEXT PRIMARY KEY,
+                    pending_count INTEGER NOT NULL DEFAULT 0,
+                    pending_revenue INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS stats_service_daily (
+                    date TEXT,
+                    service_key TEXT,
+                    pending_count INTEGER NOT NULL DEFAULT 0,
+                    pending_revenue INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (date, service_key)
+                )
+            """)
+            # Архив: те же столбцы, id сохраняется из рабочей таблицы
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS appointments_archive (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    service TEXT,
+                    service_key TEXT,
+                    date TEXT,
+                    time TEXT,
+                    price INTEGER,
+                    status TEXT,
+                    created_at TIMESTAMP,
+                    cancelled_at TIMESTAMP,
+                    reminded_at TIMESTAMP,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_archive_date ON appointments_archive(date, time)")
+            
+            for trigger in OBSOLETE_TRIGGERS:
+                cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            for trigger in STATS_TRIGGERS:
+                cursor.execute(trigger)
+            
+            # Состояния FSM (незавершённые записи)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS fsm_storage (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            # Лист ожидания: time IS NULL — любое время дня;
+            # held_time/hold_until — предложенный и удержанный слот
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS waitlist (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    service_key TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    time TEXT,
+                    held_time TEXT,
+                    hold_until REAL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_waitlist_user ON waitlist(user_id, date, IFNULL(time, ''))")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_waitlist_date ON waitlist(date)")
         
-        # Индексы для быстрого поиска
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_date ON appointments(date, time)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_user ON appointments(user_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_status ON appointments(status)")
+        # Один активный клиент на слот — последняя линия защиты от гонок
+        try:
+            with self._write_lock, self._writer as conn:
+                conn.execute("""
+                    CREATE UNIQUE INDEX IF NOT EXISTS idx_slot_pending
+                    ON appointments(date, time) WHERE status = 'pending'
+                """)
+        except sqlite3.IntegrityError:
+            logger.warning("⚠️ В базе есть дубли активных записей на один слот, уникальный индекс не создан")
         
-        conn.commit()
-        conn.close()
+        # Статистика новее базы — заполняем её из истории
+        version = self._writer.execute("PRAGMA user_version").fetchone()[0]
+        if version < STATS_VERSION:
+            self.rebuild_stats()
+            with self._write_lock:
+                self._writer.execute(f"PRAGMA user_version = {STATS_VERSION}")
     
     def add_client(self, user_id: int, username: str, full_name: str, phone: str):
         """Добавление или обновление клиента"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO clients (user_id, username, full_name, phone)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET
-                username=excluded.username,
-                full_name=excluded.full_name,
-                phone=excluded.phone
-        """, (user_id, username, full_name, phone))
-        conn.commit()
-        conn.close()
-    
-    def add_appointment(self, user_id: int, service: str, service_key: str, date: str, time: str, price: int):
-        """Добавление записи"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute("""
+        with self._write_lock, self._writer as conn:
+            conn.execute("""
+                INSERT INTO clients (user_id, username, full_name, phone)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username=excluded.username,
+                    full_name=excluded.full_name,
+                    phone=excluded.phone
+            """, (user_id, username, full_name, phone))
+    
+    def _insert_appointment(self, conn: sqlite3.Connection, user_id: int, service: str,
+                            service_key: str, date: str, time: str, price: int) -> int:
+        cursor = conn.execute("""
             INSERT INTO appointments (user_id, service, service_key, date, time, price)
             VALUES (?, ?, ?, ?, ?, ?)
         """, (user_id, service, service_key, date, time, price))
-        appointment_id = cursor.lastrowid
         
         # Обновляем счетчик визитов
-        cursor.execute("""
+        conn.execute("""
             UPDATE clients SET total_visits = total_visits + 1
             WHERE user_id = ?
         """, (user_id,))
+        return cursor.lastrowid
+    
+    def add_appointment(self, user_id: int, service: str, service_key: str, date: str, time: str, price: int):
+        """Добавление записи"""
+        with self._write_lock, self._writer as conn:
+            appointment_id = self._insert_appointment(conn, user_id, service, service_key, date, time, price)
+            self.slots.add(date, time, service_duration(service_key))
+        
+        return appointment_id
+    
+    def reserve_appointment(self, user_id: int, service: str, service_key: str,
+                            date: str, time: str, price: int) -> Optional[int]:
+        """
+        Атомарное бронирование слота: проверка и вставка под одной
+        блокировкой писателя и в одной транзакции.
+        Возвращает ID записи или None, если слот уже занят.
+        """
+        with self._write_lock:
+            return self._reserve_locked(user_id, service, service_key, date, time, price)
+    
+    def _reserve_locked(self, user_id: int, service: str, service_key: str, date: str, time: str,
+                        price: int, waitlist_id: Optional[int] = None) -> Optional[int]:
+        """Тело reserve_appointment под уже взятой блокировкой; waitlist_id снимается с листа в той же транзакции"""
+        duration = service_duration(service_key)
+        if not self.slots.is_loaded(date):
+            self._load_day_locked(date)
+        if not self.slots.fits(date, time, duration):
+            return None
+        
+        try:
+            with self._writer as conn:
+                appointment_id = self._insert_appointment(
+                    conn, user_id, service, service_key, date, time, price
+                )
+                if waitlist_id is not None:
+                    conn.execute("DELETE FROM waitlist WHERE id = ?", (waitlist_id,))
+        except sqlite3.IntegrityError:
+            return None
         
-        conn.commit()
-        conn.close()
+        self.slots.add(date, time, duration)
         return appointment_id
     
     def get_appointments_by_date(self, date: str) -> List[str]:
         """Получение занятых времен на дату"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute("""
+        cursor = self._reader().execute("""
             SELECT time FROM appointments 
             WHERE date = ? AND status = 'pending'
         """, (date,))
-        times = [row[0] for row in cursor.fetchall()]
-        conn.close()
-        return times
+        return [row[0] for row in cursor.fetchall()]
     
     def get_user_appointments(self, user_id: int) -> List[tuple]:
         """Получение активных записей пользователя"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, service, date, time, status, price
-            FROM appointments 
-            WHERE user_id = ? AND status = 'pending'
-            AND date >= date('now')
-            ORDER BY date, time
-        """, (user_id,))
-        appointments = cursor.fetchall()
-        conn.close()
-        return appointments
-    
-    def cancel_appointment(self, appointment_id: int):
-        """Отмена записи"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE appointments 
-            SET status = 'cancelled', cancelled_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        """, (appointment_id,))
-        conn.commit()
-        conn.close()
+        today = datetime.now().strftime("%Y-%m-%d")
+        cursor = self._reader().execute(HOT_QUERIES['user_appointments'], (user_id, today))
+        return cursor.fetchall()
+    
+    def cancel_appointment(self, appointment_id: int) -> Optional[tuple]:
+        """Отмена записи; возвращает освободившийся слот (date, time, service_key) или None"""
+        with self._write_lock, self._writer as conn:
+            row = conn.execute("""
+                SELECT date, time, service_key FROM appointments
+                WHERE id = ? AND status = 'pending'
+            """, (appointment_id,)).fetchone()
+            conn.execute("""
+                UPDATE appointments 
+                SET status = 'cancelled', cancelled_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, (appointment_id,))
+            
+            if row:
+                date, time, service_key = row
+                self.slots.remove(date, time, service_duration(service_key))
+        return row
+    
+    def add_waiter(self, user_id: int, service_key: str, date: str, time: Optional[str]) -> Optional[int]:
+        """Подписка на слот (или на весь день при time=None); None, если подписка уже есть"""
+        with self._write_lock, self._writer as conn:
+            cursor = conn.execute("""
+                INSERT OR IGNORE INTO waitlist (user_id, service_key, date, time)
+                VALUES (?, ?, ?, ?)
+            """, (user_id, service_key, date, time))
+            return cursor.lastrowid if cursor.rowcount else None
+    
+    def load_waitlist(self, since: str) -> List[tuple]:
+        """Подписки с даты since в порядке очереди; удержания возвращаются в индекс слотов"""
+        with self._write_lock:
+            rows = self._writer.execute("""
+                SELECT id, user_id, service_key, date, time, held_time, hold_until
+                FROM waitlist WHERE date >= ? ORDER BY id
+            """, (since,)).fetchall()
+            for entry_id, _, service_key, date, _, held_time, _ in rows:
+                if held_time and entry_id not in self.holds:
+                    self._hold(entry_id, date, held_time, service_duration(service_key))
+        return rows
+    
+    def _hold(self, entry_id: int, date: str, time: str, duration: int):
+        self.holds[entry_id] = (date, time, duration)
+        self.slots.add(date, time, duration, force=True)
+    
+    def _unhold(self, entry_id: int):
+        hold = self.holds.pop(entry_id, None)
+        if hold is not None:
+            self.slots.remove(*hold)
+    
+    def hold_slot(self, entry_id: int, date: str, time: str, duration: int, until: float) -> bool:
+        """
+        Удержание слота за ожидающим: в индексе слот занят для всех, пока
+        его не заберут (claim_hold) или не отпустят (remove_waiter).
+        False, если слот уже не свободен или подписки нет.
+        """
+        with self._write_lock:
+            if not self.slots.is_loaded(date):
+                self._load_day_locked(date)
+            if not self.slots.fits(date, time, duration):
+                return False
+            with self._writer as conn:
+                updated = conn.execute("""
+                    UPDATE waitlist SET held_time = ?, hold_until = ? WHERE id = ?
+                """, (time, until, entry_id)).rowcount
+            if not updated:
+                return False
+            self._hold(entry_id, date, time, duration)
+            return True
+    
+    def claim_hold(self, entry_id: int, user_id: int, service: str, service_key: str, price: int) -> Optional[int]:
+        """Запись на удержанный слот: снятие удержания, бронь и удаление подписки — одной операцией"""
+        with self._write_lock:
+            hold = self.holds.get(entry_id)
+            if hold is None:
+                return None
+            date, time, duration = hold
+            self._unhold(entry_id)
+            appointment_id = self._reserve_locked(user_id, service, service_key, date, time, price, waitlist_id=entry_id)
+            if appointment_id is None:
+                self._hold(entry_id, date, time, duration)
+            return appointment_id
+    
+    def remove_waiter(self, entry_id: int):
+        """Снятие с листа ожидания вместе с удержанием, если оно было"""
+        with self._write_lock, self._writer as conn:
+            conn.execute("DELETE FROM waitlist WHERE id = ?", (entry_id,))
+            self._unhold(entry_id)
+    
+    def purge_waitlist(self, before: str) -> int:
+        """Удаление подписок на даты раньше before"""
+        with self._write_lock, self._writer as conn:
+            for entry_id, (date, _, _) in list(self.holds.items()):
+                if date < before:
+                    self._unhold(entry_id)
+            return conn.execute("DELETE FROM waitlist WHERE date < ?", (before,)).rowcount
+    
+    def get_day_bookings(self, date: str) -> List[tuple]:
+        """Активные записи на дату: (time, service_key)"""
+        cursor = self._reader().execute(HOT_QUERIES['day_bookings'], (date,))
+        return cursor.fetchall()
+    
+    def warm_slot_index(self):
+        """Загрузка в индекс всех активных записей начиная с сегодня"""
+        today = datetime.now().strftime("%Y-%m-%d")
+        with self._write_lock:
+            rows = self._writer.execute(HOT_QUERIES['upcoming_bookings'], (today,)).fetchall()
+            self.slots.warm(rows, today)
+            for date, time, duration in self.holds.values():
+                self.slots.add(date, time, duration, force=True)
+    
+    def get_blocked_mask(self, date: str, duration: int) -> int:
+        """Маска недоступных стартов для услуги (из индекса, при промахе — из базы)"""
+        mask = self.slots.blocked_mask(date, duration)
+        if mask is None:
+            self.load_day(date)
+            mask = self.slots.compute_mask(date, duration)
+        return mask
+    
+    def load_day(self, date: str):
+        """
+        Загрузка даты в индекс из базы. Под блокировкой писателя: иначе
+        set_day из потока-читателя перезапишет дату поверх slots.add
+        параллельной брони, и она пропадёт из индекса.
+        """
+        with self._write_lock:
+            self._load_day_locked(date)
+    
+    def _load_day_locked(self, date: str):
+        self.slots.set_day(date, self.get_day_bookings(date))
+    
+    def verify_slot_index(self) -> List[str]:
+        """Сверка индекса с таблицей: даты, где они расходятся"""
+        with self._write_lock:
+            rows = self._writer.execute(HOT_QUERIES['upcoming_bookings'], (self.slots.warm_from,)).fetchall()
+            expected = AvailabilityIndex(WORKING_HOURS, CLOSING_TIME)
+            expected.warm(rows, self.slots.warm_from)
+            # Удержания листа ожидания занимают слоты только в индексе
+            for date, time, duration in self.holds.values():
+                expected.add(date, time, duration, force=True)
+            expected = expected.snapshot()
+            actual = {
+                date: intervals for date, intervals in self.slots.snapshot().items()
+                if date >= self.slots.warm_from
+            }
+        
+        return sorted(d for d in set(expected) | set(actual) if expected.get(d) != actual.get(d))
     
     def get_appointment_details(self, appointment_id: int) -> tuple:
         """Получение деталей записи"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT a.user_id, c.full_name, c.phone, a.service, a.date, a.time, a.price
-            FROM appointments a
-            JOIN clients c ON a.user_id = c.user_id
-            WHERE a.id = ?
-        """, (appointment_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return result
-    
-    def get_all_appointments(self, status: str = 'pending') -> List[tuple]:
-        """Получение всех записей для админа"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        query = """
-            SELECT a.id, c.full_name, c.phone, c.username, a.service, a.date, a.time, a.price, a.status
-            FROM appointments a
-            JOIN clients c ON a.user_id = c.user_id
+        cursor = self._reader().execute(HOT_QUERIES['appointment_details'], (appointment_id,))
+        return cursor.fetchone()
+    
+    def get_appointments_page(self, cursor: Optional[tuple] = None, backward: bool = False,
+                              limit: int = ADMIN_PAGE_SIZE) -> List[tuple]:
         """
-        if status:
-            query += " WHERE a.status = ?"
-            cursor.execute(query + " ORDER BY a.date, a.time", (status,))
-        else:
-            cursor.execute(query + " ORDER BY a.date DESC, a.time", ())
-        
-        appointments = cursor.fetchall()
-        conn.close()
-        return appointments
+        Страница активных записей по ключу (date, time, id): следующие
+        после cursor или, при backward, предыдущие перед ним.
+        Возвращает до limit + 1 строк в порядке возрастания — лишняя
+        говорит о том, что в этом направлении есть ещё страница.
+        """
+        if backward:
+            rows = self._reader().execute(HOT_QUERIES['appointments_before'], (*cursor, limit + 1)).fetchall()
+            rows.reverse()
+            return rows
+        return self._reader().execute(
+            HOT_QUERIES['appointments_after'], (*(cursor or ('', '', 0)), limit + 1)
+        ).fetchall()
+    
+    def get_pending_totals(self) -> tuple:
+        """
+        Число и сумма активных записей, которые листает /all (из дневной
+        сводки). Сводки хранят и ушедшие в архив активные записи, поэтому
+        считаем только дни начиная с самой ранней оставшейся в таблице.
+        """
+        return self._reader().execute(HOT_QUERIES['pending_totals']).fetchone()
+    
+    def archive_batch(self, before: str, limit: int = ARCHIVE_BATCH) -> int:
+        """
+        Перенос записей с датой раньше before в архив одной транзакцией:
+        самые ранние дни, пока не наберётся limit записей. День уходит
+        целиком (пачка может превысить limit на его остаток), иначе
+        get_pending_totals до следующей пачки считал бы полдня.
+        Возвращает число перенесённых строк.
+        """
+        with self._write_lock, self._writer as conn:
+            # Прошедшие даты больше не «тёплые», перенесённые в индексе устарели
+            self.slots.advance(datetime.now().strftime("%Y-%m-%d"))
+            self.slots.forget_before(before)
+            ids = [row[0] for row in conn.execute(HOT_QUERIES['archive_candidates'], (before, limit))]
+            if not ids:
+                return 0
+            placeholders = ", ".join("?" * len(ids))
+            conn.execute(f"""
+                INSERT INTO appointments_archive (id, user_id, service, service_key, date, time,
+                                                  price, status, created_at, cancelled_at, reminded_at)
+                SELECT id, user_id, service, service_key, date, time,
+                       price, status, created_at, cancelled_at, reminded_at
+                FROM appointments WHERE id IN ({placeholders})
+            """, ids)
+            conn.execute(f"DELETE FROM appointments WHERE id IN ({placeholders})", ids)
+        return len(ids)
+    
+    def get_history_page(self, date_from: str, date_to: str, cursor: Optional[tuple] = None,
+                         backward: bool = False, limit: int = ADMIN_PAGE_SIZE) -> List[tuple]:
+        """
+        Страница архива за период, от новых к старым, по ключу
+        (date, time, id). Как get_appointments_page: до limit + 1 строк
+        в порядке показа.
+        """
+        if backward:
+            rows = self._reader().execute(
+                HOT_QUERIES['history_newer'], (date_from, date_to, *cursor, limit + 1)
+            ).fetchall()
+            rows.reverse()
+            return rows
+        return self._reader().execute(
+            HOT_QUERIES['history_older'], (date_from, date_to, *(cursor or ('9999-12-31', '', 0)), limit + 1)
+        ).fetchall()
+    
+    def get_day_appointments(self, date: str) -> List[tuple]:
+        """Активные записи на день с данными клиентов"""
+        cursor = self._reader().execute(HOT_QUERIES['day_appointments'], (date,))
+        return cursor.fetchall()
+    
+    def get_period_appointments(self, date_from: str, date_to: str) -> List[tuple]:
+        """Активные записи за период с данными клиентов"""
+        cursor = self._reader().execute(HOT_QUERIES['period_appointments'], (date_from, date_to))
+        return cursor.fetchall()
     
     def get_client_info(self, user_id: int) -> tuple:
         """Получение информации о клиенте"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT full_name, phone, total_visits, created_at
-            FROM clients WHERE user_id = ?
-        """, (user_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return result
+        cursor = self._reader().execute(HOT_QUERIES['client_info'], (user_id,))
+        return cursor.fetchone()
     
     def get_stats(self) -> dict:
-        """Статистика для админа"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
+        """Статистика для админа (из материализованных счётчиков)"""
+        today = datetime.now()
+        today_str = today.strftime("%Y-%m-%d")
+        week_end = (today + timedelta(days=7)).strftime("%Y-%m-%d")
         
-        stats = {}
+        row = self._reader().execute(HOT_QUERIES['stats'], (today_str, today_str, today_str, week_end, today.strftime("%Y-%m"))).fetchone()
         
-        # Всего клиентов
-        cursor.execute("SELECT COUNT(*) FROM clients")
-        stats['total_clients'] = cursor.fetchone()[0]
+        return {
+            'total_clients': row[0],
+            'active_appointments': row[1],
+            'today_appointments': row[2],
+            'week_appointments': row[3],
+            'month_revenue': row[4],
+        }
+    
+    def _raw_stats(self, conn: sqlite3.Connection) -> dict:
+        """Те же агрегаты, посчитанные по исходным таблицам (вместе с архивом)"""
+        source = """(
+            SELECT date, service_key, price, status FROM appointments
+            UNION ALL
+            SELECT date, service_key, price, status FROM appointments_archive
+        )"""
+        return {
+            'counters': dict(conn.execute(
+                "SELECT 'total_clients', COUNT(*) FROM clients"
+            ).fetchall()),
+            'daily': {row[0]: row[1:] for row in conn.execute(f"""
+                SELECT date, COUNT(*), COALESCE(SUM(price), 0) FROM {source}
+                WHERE status = 'pending' GROUP BY date
+            """)},
+            'monthly': {row[0]: row[1:] for row in conn.execute(f"""
+                SELECT substr(date, 1, 7), COUNT(*), COALESCE(SUM(price), 0) FROM {source}
+                WHERE status = 'pending' GROUP BY substr(date, 1, 7)
+            """)},
+            'service_daily': {row[:2]: row[2:] for row in conn.execute(f"""
+                SELECT date, COALESCE(service_key, ''), COUNT(*), COALESCE(SUM(price), 0) FROM {source}
+                WHERE status = 'pending' GROUP BY date, COALESCE(service_key, '')
+            """)},
+        }
+    
+    def rebuild_stats(self):
+        """Пересчёт материализованной статистики с нуля"""
+        with self._write_lock, self._writer as conn:
+            raw = self._raw_stats(conn)
+            conn.execute("DELETE FROM stats_counters")
+            conn.execute("DELETE FROM stats_daily")
+            conn.execute("DELETE FROM stats_monthly")
+            conn.execute("DELETE FROM stats_service_daily")
+            conn.executemany("INSERT INTO stats_counters (name, value) VALUES (?, ?)", raw['counters'].items())
+            conn.executemany(
+                "INSERT INTO stats_daily (date, pending_count, pending_revenue) VALUES (?, ?, ?)",
+                [(date, *values) for date, values in raw['daily'].items()]
+            )
+            conn.executemany(
+                "INSERT INTO stats_monthly (month, pending_count, pending_revenue) VALUES (?, ?, ?)",
+                [(month, *values) for month, values in raw['monthly'].items()]
+            )
+            conn.executemany(
+                "INSERT INTO stats_service_daily (date, service_key, pending_count, pending_revenue) VALUES (?, ?, ?, ?)",
+                [(*key, *values) for key, values in raw['service_daily'].items()]
+            )
+    
+    def check_stats(self) -> List[str]:
+        """Сверка материализованной статистики с исходными таблицами"""
+        with self._write_lock:
+            conn = self._writer
+            raw = self._raw_stats(conn)
+            stored = {
+                'counters': dict(conn.execute("SELECT name, value FROM stats_counters").fetchall()),
+                'daily': {row[0]: row[1:] for row in conn.execute(
+                    "SELECT date, pending_count, pending_revenue FROM stats_daily WHERE pending_count != 0"
+                )},
+                'monthly': {row[0]: row[1:] for row in conn.execute(
+                    "SELECT month, pending_count, pending_revenue FROM stats_monthly WHERE pending_count != 0"
+                )},
+                'service_daily': {row[:2]: row[2:] for row in conn.execute("""
+                    SELECT date, service_key, pending_count, pending_revenue FROM stats_service_daily
+                    WHERE pending_count != 0
+                """)},
+            }
         
-        # Активные записи
-        cursor.execute("SELECT COUNT(*) FROM appointments WHERE status = 'pending' AND date >= date('now')")
-        stats['active_appointments'] = cursor.fetchone()[0]
+        problems = []
+        for table in ('counters', 'daily', 'monthly', 'service_daily'):
+            for key in sorted(set(raw[table]) | set(stored[table])):
+                if raw[table].get(key) != stored[table].get(key):
+                    problems.append(f"{table}[{key}]: {stored[table].get(key)} != {raw[table].get(key)}")
+        return problems
+    
+    def get_due_reminders(self, date_from: str, date_to: str) -> List[tuple]:
+        """Записи без напоминания в диапазоне дат: (id, date, time, created_at по местному времени)"""
+        cursor = self._reader().execute(HOT_QUERIES['due_reminders'], (date_from, date_to))
+        return cursor.fetchall()
+    
+    def mark_reminded(self, appointment_id: int) -> bool:
+        """Отметка об отправке напоминания; False, если отмечать нечего"""
+        with self._write_lock, self._writer as conn:
+            cursor = conn.execute("""
+                UPDATE appointments SET reminded_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'pending' AND reminded_at IS NULL
+            """, (appointment_id,))
+            return cursor.rowcount == 1
+    
+    def get_fsm_record(self, key: str) -> Optional[list]:
+        """Состояние и данные FSM по ключу"""
+        row = self._reader().execute(HOT_QUERIES['fsm_record'], (key,)).fetchone()
+        if row is None:
+            return None
+        state, data = row
+        return [state, json.loads(data) if data else {}]
+    
+    def save_fsm_records(self, rows: List[tuple]):
+        """Пакетное сохранение (key, state, data); пустые записи удаляются"""
+        with self._write_lock, self._writer as conn:
+            conn.executemany(
+                "DELETE FROM fsm_storage WHERE key = ?",
+                [(key,) for key, state, data in rows if state is None and data is None]
+            )
+            conn.executemany("""
+                INSERT INTO fsm_storage (key, state, data, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(key) DO UPDATE SET
+                    state=excluded.state,
+                    data=excluded.data,
+                    updated_at=excluded.updated_at
+            """, [row for row in rows if row[1] is not None or row[2] is not None])
+    
+    def get_services_stats(self) -> List[tuple]:
+        """Статистика по услугам среди активных записей (из сводки по дням и услугам)"""
+        cursor = self._reader().execute(HOT_QUERIES['services_stats'], (datetime.now().strftime("%Y-%m-%d"),))
+        return cursor.fetchall()
+    
+    def get_popular_days(self, limit: int = 3) -> List[tuple]:
+        """Самые загруженные дни недели (из дневной сводки)"""
+        cursor = self._reader().execute("""
+            SELECT 
+                CASE CAST(strftime('%w', date) AS INTEGER)
+                    WHEN 0 THEN 'Воскресенье'
+                    WHEN 1 THEN 'Понедельник'
+                    WHEN 2 THEN 'Вторник'
+                    WHEN 3 THEN 'Среда'
+                    WHEN 4 THEN 'Четверг'
+                    WHEN 5 THEN 'Пятница'
+                    WHEN 6 THEN 'Суббота'
+                END as day,
+                SUM(pending_count)
+            FROM stats_daily
+            WHERE pending_count > 0
+            GROUP BY strftime('%w', date)
+            ORDER BY SUM(pending_count) DESC
+            LIMIT ?
+        """, (limit,))
+        return cursor.fetchall()
+    
+    def check_query_plans(self) -> List[str]:
+        """Горячие запросы, план которых содержит полный просмотр таблицы (SCAN)"""
+        conn = self._reader()
+        problems = []
+        for name, query in HOT_QUERIES.items():
+            params = (None,) * query.count('?')
+            for *_, detail in conn.execute(f"EXPLAIN QUERY PLAN {query}", params):
+                if detail.startswith('SCAN') and detail != 'SCAN CONSTANT ROW' and not detail.startswith('SCAN stats_'):
+                    problems.append(f"{name}: {detail}")
+        return problems
+
+
+class ClientCache:
+    """
+    LRU-кэш строк get_client_info по user_id.
+    
+    Работает только из потока event loop, поэтому без блокировок.
+    Профиль меняют лишь add_client и новые записи (total_visits) — после
+    них запись сбрасывается. Чтение, начатое до сброса, может вернуть
+    старую строку; чтобы она не попала в кэш, заполнение идёт только если
+    счётчик поколений не сдвинулся за время похода в базу.
+    """
+    
+    _MISSING = object()  # Пользователя нет в базе (негативная запись)
+    
+    def __init__(self, maxsize: int = CLIENT_CACHE_SIZE, negative: bool = CLIENT_CACHE_NEGATIVE):
+        self.maxsize = maxsize
+        self.negative = negative
+        self._items: OrderedDict = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    def get(self, user_id: int):
+        """Строка клиента, None для известного отсутствия, _MISSING — идти в базу"""
+        row = self._items.get(user_id, ClientCache._MISSING)
+        if row is ClientCache._MISSING:
+            self.misses += 1
+            return row
+        self._items.move_to_end(user_id)
+        if row is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return row
+    
+    def put(self, user_id: int, row: Optional[tuple], generation: int):
+        if generation != self.generation or (row is None and not self.negative):
+            return
+        self._items[user_id] = row
+        self._items.move_to_end(user_id)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+    
+    def invalidate(self, user_id: int):
+        self.generation += 1
+        self.invalidations += 1
+        self._items.pop(user_id, None)
+    
+    def clear(self):
+        self.generation += 1
+        self._items.clear()
+    
+    def stats(self) -> dict:
+        total = self.hits + self.negative_hits + self.misses
+        return {
+            'size': len(self._items),
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': (self.hits + self.negative_hits) / total if total else 0.0,
+        }
+
+
+class AsyncDatabase:
+    """
+    Неблокирующий доступ к Database из хэндлеров.
+    
+    Все записи идут через один поток-писатель (SQLite всё равно
+    допускает только одного писателя), чтения — через пул потоков,
+    у каждого из которых своё соединение в режиме WAL.
+    """
+    
+    def __init__(self, database: Database, readers: int = DB_READERS):
+        self.sync = database
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self.clients = ClientCache()
+    
+    async def _write(self, func, *args, **kwargs):
+        return await self._run(self._write_executor, func, *args, **kwargs)
+    
+    async def _read(self, func, *args, **kwargs):
+        return await self._run(self._read_executor, func, *args, **kwargs)
+    
+    async def _run(self, executor: ThreadPoolExecutor, func, *args, **kwargs):
+        # Замер пишется уже в потоке event loop — без блокировок
+        started = perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, partial(func, *args, **kwargs))
+        except Exception:
+            metrics.inc('bot_db_errors_total', func.__name__)
+            raise
+        finally:
+            metrics.observe('bot_db_duration_seconds', func.__name__, perf_counter() - started)
+    
+    async def close(self):
+        """Дожидается очередей и закрывает соединения"""
+        self._write_executor.shutdown(wait=True)
+        self._read_executor.shutdown(wait=True)
+        self.sync.close()
+    
+    async def add_client(self, user_id: int, username: str, full_name: str, phone: str):
+        try:
+            return await self._write(self.sync.add_client, user_id, username, full_name, phone)
+        finally:
+            self.clients.invalidate(user_id)
+    
+    async def add_appointment(self, user_id: int, service: str, service_key: str, date: str, time: str, price: int) -> int:
+        try:
+            return await self._write(self.sync.add_appointment, user_id, service, service_key, date, time, price)
+        finally:
+            # Запись увеличивает total_visits
+            self.clients.invalidate(user_id)
+    
+    async def reserve_appointment(self, user_id: int, service: str, service_key: str,
+                                  date: str, time: str, price: int) -> Optional[int]:
+        try:
+            return await self._write(self.sync.reserve_appointment, user_id, service, service_key, date, time, price)
+        finally:
+            self.clients.invalidate(user_id)
+    
+    async def cancel_appointment(self, appointment_id: int) -> Optional[tuple]:
+        return await self._write(self.sync.cancel_appointment, appointment_id)
+    
+    async def add_waiter(self, user_id: int, service_key: str, date: str, time: Optional[str]) -> Optional[int]:
+        return await self._write(self.sync.add_waiter, user_id, service_key, date, time)
+    
+    async def load_waitlist(self, since: str) -> List[tuple]:
+        return await self._write(self.sync.load_waitlist, since)
+    
+    async def hold_slot(self, entry_id: int, date: str, time: str, duration: int, until: float) -> bool:
+        return await self._write(self.sync.hold_slot, entry_id, date, time, duration, until)
+    
+    async def claim_hold(self, entry_id: int, user_id: int, service: str, service_key: str, price: int) -> Optional[int]:
+        try:
+            return await self._write(self.sync.claim_hold, entry_id, user_id, service, service_key, price)
+        finally:
+            self.clients.invalidate(user_id)
+    
+    async def remove_waiter(self, entry_id: int):
+        return await self._write(self.sync.remove_waiter, entry_id)
+    
+    async def purge_waitlist(self, before: str) -> int:
+        return await self._write(self.sync.purge_waitlist, before)
+    
+    async def get_appointments_by_date(self, date: str) -> List[str]:
+        return await self._read(self.sync.get_appointments_by_date, date)
+    
+    async def get_blocked_mask(self, date: str, duration: int) -> int:
+        # Попадание в индекс отвечаем сразу, без похода в пул
+        mask = self.sync.slots.blocked_mask(date, duration)
+        if mask is not None:
+            return mask
+        await self._read(self.sync.load_day, date)
+        return self.sync.slots.compute_mask(date, duration)
+    
+    async def get_month_availability(self, year: int, month: int, duration: int) -> tuple:
+        # Будущие даты всегда в индексе — считаем в памяти, без пула
+        return self.sync.slots.month_summary(year, month, duration)
+    
+    async def verify_slot_index(self) -> List[str]:
+        # Сверка держит блокировку писателя — не занимаем ею поток-читатель
+        return await self._write(self.sync.verify_slot_index)
+    
+    async def warm_slot_index(self):
+        return await self._write(self.sync.warm_slot_index)
+    
+    async def get_user_appointments(self, user_id: int) -> List[tuple]:
+        return await self._read(self.sync.get_user_appointments, user_id)
+    
+    async def get_appointment_details(self, appointment_id: int) -> tuple:
+        return await self._read(self.sync.get_appointment_details, appointment_id)
+    
+    async def get_appointments_page(self, cursor: Optional[tuple] = None, backward: bool = False,
+                                    limit: int = ADMIN_PAGE_SIZE) -> List[tuple]:
+        return await self._read(self.sync.get_appointments_page, cursor, backward, limit)
+    
+    async def get_pending_totals(self) -> tuple:
+        return await self._read(self.sync.get_pending_totals)
+    
+    async def archive_batch(self, before: str, limit: int = ARCHIVE_BATCH) -> int:
+        return await self._write(self.sync.archive_batch, before, limit)
+    
+    async def get_history_page(self, date_from: str, date_to: str, cursor: Optional[tuple] = None,
+                               backward: bool = False, limit: int = ADMIN_PAGE_SIZE) -> List[tuple]:
+        return await self._read(self.sync.get_history_page, date_from, date_to, cursor, backward, limit)
+    
+    async def get_day_appointments(self, date: str) -> List[tuple]:
+        return await self._read(self.sync.get_day_appointments, date)
+    
+    async def get_period_appointments(self, date_from: str, date_to: str) -> List[tuple]:
+        return await self._read(self.sync.get_period_appointments, date_from, date_to)
+    
+    async def get_client_info(self, user_id: int) -> Optional[tuple]:
+        row = self.clients.get(user_id)
+        if row is not ClientCache._MISSING:
+            return row
+        generation = self.clients.generation
+        row = await self._read(self.sync.get_client_info, user_id)
+        self.clients.put(user_id, row, generation)
+        return row
+    
+    async def get_stats(self) -> dict:
+        return await self._read(self.sync.get_stats)
+    
+    async def get_due_reminders(self, date_from: str, date_to: str) -> List[tuple]:
+        return await self._read(self.sync.get_due_reminders, date_from, date_to)
+    
+    async def mark_reminded(self, appointment_id: int) -> bool:
+        return await self._write(self.sync.mark_reminded, appointment_id)
+    
+    async def get_fsm_record(self, key: str) -> Optional[list]:
+        return await self._read(self.sync.get_fsm_record, key)
+    
+    async def save_fsm_records(self, rows: List[tuple]):
+        return await self._write(self.sync.save_fsm_records, rows)
+    
+    async def rebuild_stats(self):
+        return await self._write(self.sync.rebuild_stats)
+    
+    async def check_stats(self) -> List[str]:
+        return await self._write(self.sync.check_stats)
+    
+    async def get_services_stats(self) -> List[tuple]:
+        return await self._read(self.sync.get_services_stats)
+    
+    async def get_popular_days(self, limit: int = 3) -> List[tuple]:
+        return await self._read(self.sync.get_popular_days, limit)
+    
+    async def check_query_plans(self) -> List[str]:
+        return await self._read(self.sync.check_query_plans)
+
+
+# ================================
+# 💾 ХРАНИЛИЩЕ СОСТОЯНИЙ FSM
+# ================================
+
+class _SessionRecord:
+    __slots__ = ('state', 'data', 'touched')
+    
+    def __init__(self, state: Optional[str], data: Optional[dict], touched: float):
+        self.state = state
+        self.data = data
+        self.touched = touched
+
+
+class BoundedMemoryStorage(BaseStorage):
+    """
+    FSM-хранилище в памяти с ограниченным размером.
+    
+    Сессия удаляется, если к ней не обращались ttl секунд, а при
+    превышении max_entries вытесняется самая давняя. Пустые сессии
+    (без состояния и данных) не хранятся вовсе. on_drop(key, record)
+    вызывается для каждой просроченной или вытесненной сессии.
+    """
+    
+    def __init__(self, ttl: float = FSM_TTL, max_entries: int = FSM_MAX_ENTRIES,
+                 on_drop: Optional[Callable[[StorageKey, _SessionRecord], None]] = None):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._on_drop = on_drop
+        self._records: OrderedDict = OrderedDict()  # от давних к свежим
+        self.expired = 0
+        self.evicted = 0
+    
+    def _expire(self, now: float):
+        # Давние записи всегда в начале — просроченные снимаются с головы
+        records = self._records
+        while records:
+            record = next(iter(records.values()))
+            if now - record.touched < self._ttl:
+                break
+            self._drop()
+            self.expired += 1
+    
+    def _drop(self):
+        key, record = self._records.popitem(last=False)
+        if self._on_drop is not None:
+            self._on_drop(key, record)
+    
+    def _get(self, key: StorageKey) -> Optional[_SessionRecord]:
+        now = monotonic()
+        self._expire(now)
+        record = self._records.get(key)
+        if record is not None:
+            record.touched = now
+            self._records.move_to_end(key)
+        return record
+    
+    def _put(self, key: StorageKey, state: Optional[str], data: Optional[dict]):
+        if state is None and not data:
+            self._records.pop(key, None)
+            return
         
-        # Записи сегодня
-        cursor.execute("SELECT COUNT(*) FROM appointments WHERE date = date('now') AND status = 'pending'")
-        stats['today_appointments'] = cursor.fetchone()[0]
+        now = monotonic()
+        self._expire(now)
+        self._records[key] = _SessionRecord(state, data or None, now)
+        self._records.move_to_end(key)
+        if len(self._records) > self._max_entries:
+            self._drop()
+            self.evicted += 1
+    
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._get(key)
+        state = state.state if isinstance(state, State) else state
+        self._put(key, state, record.data if record else None)
+    
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self._get(key)
+        return record.state if record else None
+    
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = self._get(key)
+        self._put(key, record.state if record else None, data.copy())
+    
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self._get(key)
+        return record.data.copy() if record and record.data else {}
+    
+    async def close(self) -> None:
+        self._records.clear()
+    
+    def stats(self) -> dict:
+        return {
+            'live': len(self._records),
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в той же базе SQLite — незавершённые записи
+    переживают перезапуск.
+    
+    Чтения обслуживаются из кэша в памяти — это BoundedMemoryStorage
+    с тем же TTL и вытеснением давних сессий, так что кэш не растёт
+    вместе с числом пользователей. Пустые сессии в нём не хранятся:
+    промах, ничего не нашедший в базе, не кэшируется. Записи помечают
+    ключ «грязным» и раз в flush_interval сбрасываются одной
+    транзакцией, так что несколько update_data подряд стоят одной
+    строки в базе. Вытесненная грязная сессия ждёт сброса в _pending.
+    """
+    
+    def __init__(self, database: AsyncDatabase, flush_interval: float = FSM_FLUSH_INTERVAL,
+                 ttl: float = FSM_TTL, max_entries: int = FSM_MAX_ENTRIES):
+        self._db = database
+        self._flush_interval = flush_interval
+        self._key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache = BoundedMemoryStorage(ttl, max_entries, on_drop=self._on_drop)
+        self._dirty: set = set()
+        self._flushing: set = set()
+        # Несохранённые (state, data) ключей, которых нет в кэше:
+        # вытесненные до сброса или очищенные до удаления из базы
+        self._pending: Dict[StorageKey, tuple] = {}
+        self._flush_task = None
+        self.misses = 0
+        self.writes = 0
+        self.flushes = 0
+        self.rows_flushed = 0
+    
+    def _on_drop(self, key: StorageKey, record: _SessionRecord):
+        # Чистую сессию можно забыть — она есть в базе; грязную — только после сброса
+        if key in self._dirty or key in self._flushing:
+            self._pending[key] = (record.state, record.data)
+    
+    def _lookup(self, key: StorageKey) -> Optional[tuple]:
+        record = self._cache._get(key)
+        if record is not None:
+            return record.state, record.data
+        return self._pending.get(key)
+    
+    async def _record(self, key: StorageKey) -> tuple:
+        """(state, data) из кэша, при промахе — из базы"""
+        record = self._lookup(key)
+        if record is not None:
+            return record
+        self.misses += 1
+        loaded = await self._db.get_fsm_record(self._key_builder.build(key))
+        # Пока ждали базу, запись могла появиться в кэше
+        record = self._lookup(key)
+        if record is not None:
+            return record
+        if loaded is None:
+            return None, None
+        self._cache._put(key, *loaded)
+        return self._lookup(key) or (None, None)
+    
+    def _write(self, key: StorageKey, state: Optional[str], data: Optional[dict]):
+        self._cache._put(key, state, data)
+        if state is None and not data:
+            # Пустая сессия в кэш не попадает — до удаления из базы помним её здесь
+            self._pending[key] = (None, None)
+        else:
+            self._pending.pop(key, None)
+        self._dirty.add(key)
+        self.writes += 1
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+    
+    async def _delayed_flush(self):
+        await asyncio.sleep(self._flush_interval)
+        self._flush_task = None
+        await self.flush()
+    
+    async def flush(self):
+        """Сброс накопленных изменений одной транзакцией"""
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        self._flushing = keys
+        rows = []
+        for key in keys:
+            state, data = self._lookup(key) or (None, None)
+            rows.append((self._key_builder.build(key), state, json.dumps(data, ensure_ascii=False) if data else None))
         
-        # Записи на неделю
-        cursor.execute("""
-            SELECT COUNT(*) FROM appointments 
-            WHERE date BETWEEN date('now') AND date('now', '+7 days')
-            AND status = 'pending'
-        """)
-        stats['week_appointments'] = cursor.fetchone()[0]
+        try:
+            await self._db.save_fsm_records(rows)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить состояния FSM: {e}")
+            self._dirty |= keys
+            return
+        finally:
+            self._flushing = set()
         
-        # Доход за месяц
-        cursor.execute("""
-            SELECT COALESCE(SUM(price), 0) FROM appointments 
-            WHERE strftime('%Y-%m', date) = strftime('%Y-%m', 'now')
-            AND status = 'pending'
-        """)
-        stats['month_revenue'] = cursor.fetchone()[0]
+        # В базе они уже есть — ждать сброса больше нечему
+        for key in keys:
+            if key not in self._dirty:
+                self._pending.pop(key, None)
         
-        conn.close()
-        return stats
+        self.flushes += 1
+        self.rows_flushed += len(rows)
+    
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        _, data = await self._record(key)
+        self._write(key, state.state if isinstance(state, State) else state, data)
+    
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key))[0]
+    
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        state, _ = await self._record(key)
+        self._write(key, state, data.copy() or None)
+    
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        data = (await self._record(key))[1]
+        return data.copy() if data else {}
+    
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+    
+    def stats(self) -> dict:
+        return {
+            'cached': len(self._cache._records),
+            'pending': len(self._pending),
+            'dirty': len(self._dirty),
+            'misses': self.misses,
+            'evicted': self._cache.evicted,
+            'expired': self._cache.expired,
+            'writes': self.writes,
+            'flushes': self.flushes,
+            'rows_flushed': self.rows_flushed,
+        }
 
 # ================================
 # 📋 СОСТОЯНИЯ FSM
@@ -306,6 +1782,25 @@ SERVICES = {
 }
 
 WORKING_HOURS = ["09:00", "10:30", "12:00", "13:30", "15:00", "16:30", "18:00", "19:30"]
+CLOSING_TIME = "21:00"
+DEFAULT_DURATION = 90  # Для записей с неизвестной услугой
+
+def to_minutes(time: str) -> int:
+    """'HH:MM' -> минуты от полуночи"""
+    hours, minutes = time.split(":")
+    return int(hours) * 60 + int(minutes)
+
+def service_duration(service_key: str) -> int:
+    """Длительность услуги в минутах"""
+    return SERVICES.get(service_key, {}).get('duration', DEFAULT_DURATION)
+
+def closing_mask(duration: int) -> int:
+    """Маска стартов WORKING_HOURS, с которых услуга не успевает закончиться до закрытия"""
+    mask = 0
+    for i, time in enumerate(WORKING_HOURS):
+        if to_minutes(time) + duration > to_minutes(CLOSING_TIME):
+            mask |= 1 << i
+    return mask
 
 # Месяцы на русском
 MONTHS_RU = {
@@ -314,10 +1809,214 @@ MONTHS_RU = {
     9: "сентября", 10: "октября", 11: "ноября", 12: "декабря"
 }
 
+# ================================
+# 🔘 ДАННЫЕ ИНЛАЙН-КНОПОК
+# ================================
+
+# Компактная схема "<префикс>:<поле>:...": дата — порядковый номер дня
+# (date.toordinal), время — минуты от полуночи. Разбор и проверка — один
+# раз, в CallbackRouter, до вызова хэндлера.
+
+ServiceKey = Literal[tuple(SERVICES)]
+
+class ServiceCallback(CallbackData, prefix="s"):
+    key: ServiceKey
+
+class ServiceInfoCallback(CallbackData, prefix="i"):
+    key: ServiceKey
+
+class MonthCallback(CallbackData, prefix="m"):
+    year: int
+    month: int
+    
+    @field_validator('year')
+    @classmethod
+    def _year(cls, year: int) -> int:
+        if not 1 <= year <= 9999:
+            raise ValueError("год вне 1..9999")
+        return year
+    
+    @field_validator('month')
+    @classmethod
+    def _month(cls, month: int) -> int:
+        if not 1 <= month <= 12:
+            raise ValueError("месяц вне 1..12")
+        return month
+
+class DateCallback(CallbackData, prefix="d"):
+    day: int
+    
+    @field_validator('day')
+    @classmethod
+    def _day(cls, day: int) -> int:
+        return _check_ordinal(day)
+
+class TimeCallback(CallbackData, prefix="t"):
+    minutes: int
+    
+    @field_validator('minutes')
+    @classmethod
+    def _minutes(cls, minutes: int) -> int:
+        if unpack_time(minutes) not in WORKING_HOURS:
+            raise ValueError("время вне расписания")
+        return minutes
+
+class CancelCallback(CallbackData, prefix="c"):
+    appointment_id: int
+
+class WaitDayCallback(CallbackData, prefix="wd"):
+    """Лист ожидания на весь занятый день"""
+    day: int
+    
+    @field_validator('day')
+    @classmethod
+    def _day(cls, day: int) -> int:
+        return _check_ordinal(day)
+
+class WaitSlotCallback(CallbackData, prefix="ws"):
+    """Лист ожидания на занятое время (дата — из FSM)"""
+    minutes: int
+    
+    @field_validator('minutes')
+    @classmethod
+    def _minutes(cls, minutes: int) -> int:
+        if unpack_time(minutes) not in WORKING_HOURS:
+            raise ValueError("время вне расписания")
+        return minutes
+
+class WaitClaimCallback(CallbackData, prefix="wc"):
+    entry_id: int
+
+class WaitDeclineCallback(CallbackData, prefix="wx"):
+    entry_id: int
+
+class PageCallback(CallbackData, prefix="a"):
+    """Страница /all: направление и курсор (date, time, id)"""
+    backward: bool
+    day: int
+    minutes: int
+    appointment_id: int
+    
+    @field_validator('day')
+    @classmethod
+    def _day(cls, day: int) -> int:
+        return _check_ordinal(day)
+    
+    @field_validator('minutes')
+    @classmethod
+    def _minutes(cls, minutes: int) -> int:
+        return _check_minutes(minutes)
+
+class HistoryPageCallback(CallbackData, prefix="h"):
+    """Страница /history: период, направление и курсор (date, time, id)"""
+    date_from: int
+    date_to: int
+    backward: bool
+    day: int
+    minutes: int
+    appointment_id: int
+    
+    @field_validator('date_from', 'date_to', 'day')
+    @classmethod
+    def _dates(cls, day: int) -> int:
+        return _check_ordinal(day)
+    
+    @field_validator('minutes')
+    @classmethod
+    def _minutes(cls, minutes: int) -> int:
+        return _check_minutes(minutes)
+
+# Кнопки без данных
+CB_MENU = "menu"
+CB_SERVICES = "services"
+CB_DATES = "dates"
+CB_CONFIRM = "yes"
+CB_DECLINE = "no"
+CB_NOOP = "noop"
+
+def pack_date(date: str) -> int:
+    """'YYYY-MM-DD' -> порядковый номер дня"""
+    return datetime.strptime(date, "%Y-%m-%d").toordinal()
+
+def unpack_date(day: int) -> str:
+    """Порядковый номер дня -> 'YYYY-MM-DD'"""
+    return datetime.fromordinal(day).date().isoformat()
+
+def unpack_time(minutes: int) -> str:
+    """Минуты от полуночи -> 'HH:MM'"""
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def _check_ordinal(day: int) -> int:
+    if not 1 <= day <= datetime.max.toordinal():
+        raise ValueError("дата вне диапазона")
+    return day
+
+def _check_minutes(minutes: int) -> int:
+    if not 0 <= minutes < 24 * 60:
+        raise ValueError("время вне суток")
+    return minutes
+
 # ================================
 # 🎨 УЛУЧШЕННЫЕ КЛАВИАТУРЫ
 # ================================
 
+class KeyboardCache:
+    """
+    LRU-кэш готовых клавиатур, ключ — аргументы функции отрисовки.
+    
+    Кэш сбрасывается при смене суток, чтобы календарь не показывал
+    вчерашнюю дату как сегодняшнюю. Закэшированные клавиатуры общие
+    для всех пользователей — изменять их после отрисовки нельзя.
+    """
+    
+    registry: Dict[str, 'KeyboardCache'] = {}
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items: OrderedDict = OrderedDict()
+        self._day = datetime.now().date()
+        self.hits = 0
+        self.misses = 0
+    
+    def __call__(self, func):
+        KeyboardCache.registry[func.__name__] = self
+        
+        @wraps(func)
+        def wrapper(*args):
+            today = datetime.now().date()
+            if today != self._day:
+                self._items.clear()
+                self._day = today
+            
+            markup = self._items.get(args)
+            if markup is not None:
+                self._items.move_to_end(args)
+                self.hits += 1
+                return markup
+            
+            self.misses += 1
+            markup = self._items[args] = func(*args)
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+            return markup
+        
+        wrapper.cache = self
+        return wrapper
+    
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+def keyboard_cache_stats() -> Dict[str, dict]:
+    """Статистика всех кэшей клавиатур"""
+    return {name: cache.stats() for name, cache in KeyboardCache.registry.items()}
+
+@KeyboardCache(maxsize=2)
 def get_main_keyboard(is_admin: bool = False) -> ReplyKeyboardMarkup:
     """Главное меню с красивыми эмодзи"""
     keyboard = [
@@ -337,6 +2036,7 @@ def get_main_keyboard(is_admin: bool = False) -> ReplyKeyboardMarkup:
     
     return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
 
+@KeyboardCache(maxsize=1)
 def get_services_keyboard() -> InlineKeyboardMarkup:
     """Красивая клавиатура выбора услуг"""
     buttons = []
@@ -344,28 +2044,37 @@ def get_services_keyboard() -> InlineKeyboardMarkup:
     for key, service in SERVICES.items():
         buttons.append([InlineKeyboardButton(
             text=f"{service['emoji']} {service['name'].replace(service['emoji'] + ' ', '')}",
-            callback_data=f"service_{key}"
+            callback_data=ServiceCallback(key=key).pack()
         )])
         buttons.append([InlineKeyboardButton(
             text=f"   ├ {service['duration']} мин • {service['price']}₽",
-            callback_data=f"info_{key}"
+            callback_data=ServiceInfoCallback(key=key).pack()
         )])
     
     buttons.append([InlineKeyboardButton(
         text="« Назад в меню",
-        callback_data="back_to_menu"
+        callback_data=CB_MENU
     )])
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def get_calendar_keyboard(selected_month: int = None, selected_year: int = None) -> InlineKeyboardMarkup:
-    """Улучшенный календарь"""
-    now = datetime.now()
+def get_calendar_keyboard(selected_month: int = None, selected_year: int = None,
+                          availability: tuple = (0, 0)) -> InlineKeyboardMarkup:
+    """
+    Улучшенный календарь.
+    availability — (full_days, partial_days) из AvailabilityIndex.month_summary
+    """
+    today = datetime.now().date()
     
     if selected_month and selected_year:
-        current_date = datetime(selected_year, selected_month, 1)
-    else:
-        current_date = now
+        return render_calendar(selected_year, selected_month, today, *availability)
+    return render_calendar(today.year, today.month, today, *availability)
+
+@KeyboardCache(maxsize=64)
+def render_calendar(year: int, month: int, today, full_days: int = 0, partial_days: int = 0) -> InlineKeyboardMarkup:
+    """Отрисовка календаря на месяц"""
+    now = datetime(today.year, today.month, today.day)
+    current_date = datetime(year, month, 1)
     
     buttons = []
     
@@ -373,13 +2082,13 @@ def get_calendar_keyboard(selected_month: int = None, selected_year: int = None)
     month_name = MONTHS_RU[current_date.month].capitalize()
     buttons.append([InlineKeyboardButton(
         text=f"📅 {month_name} {current_date.year}",
-        callback_data="ignore"
+        callback_data=CB_NOOP
     )])
     
     # Дни недели
     weekdays = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
     buttons.append([
-        InlineKeyboardButton(text=day, callback_data="ignore") 
+        InlineKeyboardButton(text=day, callback_data=CB_NOOP) 
         for day in weekdays
     ])
     
@@ -395,19 +2104,26 @@ def get_calendar_keyboard(selected_month: int = None, selected_year: int = None)
     
     last_day = (next_month - timedelta(days=1)).day
     
-    week = [InlineKeyboardButton(text=" ", callback_data="ignore")] * start_weekday
+    week = [InlineKeyboardButton(text=" ", callback_data=CB_NOOP)] * start_weekday
     
     for day in range(1, last_day + 1):
         date = current_date.replace(day=day)
         
         # Только будущие даты
-        if date.date() >= now.date():
+        if date.date() >= now.date() and full_days & (1 << (day - 1)):
+            week.append(InlineKeyboardButton(text="🚫", callback_data=WaitDayCallback(day=date.toordinal()).pack()))
+        elif date.date() >= now.date() and partial_days & (1 << (day - 1)):
+            week.append(InlineKeyboardButton(
+                text=f"{day}•",
+                callback_data=DateCallback(day=date.toordinal()).pack()
+            ))
+        elif date.date() >= now.date():
             week.append(InlineKeyboardButton(
                 text=f"✓ {day}" if date.date() == now.date() else str(day),
-                callback_data=f"date_{date.strftime('%Y-%m-%d')}"
+                callback_data=DateCallback(day=date.toordinal()).pack()
             ))
         else:
-            week.append(InlineKeyboardButton(text="·", callback_data="ignore"))
+            week.append(InlineKeyboardButton(text="·", callback_data=CB_NOOP))
         
         if len(week) == 7:
             buttons.append(week)
@@ -415,7 +2131,7 @@ def get_calendar_keyboard(selected_month: int = None, selected_year: int = None)
     
     if week:
         while len(week) < 7:
-            week.append(InlineKeyboardButton(text=" ", callback_data="ignore"))
+            week.append(InlineKeyboardButton(text=" ", callback_data=CB_NOOP))
         buttons.append(week)
     
     # Навигация по месяцам
@@ -425,7 +2141,7 @@ def get_calendar_keyboard(selected_month: int = None, selected_year: int = None)
         prev_year = current_date.year if current_date.month > 1 else current_date.year - 1
         nav_buttons.append(InlineKeyboardButton(
             text="◀️ Назад",
-            callback_data=f"month_{prev_year}_{prev_month}"
+            callback_data=MonthCallback(year=prev_year, month=prev_month).pack()
         ))
     
     if current_date.month < 12:
@@ -433,7 +2149,7 @@ def get_calendar_keyboard(selected_month: int = None, selected_year: int = None)
         next_year = current_date.year
         nav_buttons.append(InlineKeyboardButton(
             text="Вперёд ▶️",
-            callback_data=f"month_{next_year}_{next_month}"
+            callback_data=MonthCallback(year=next_year, month=next_month).pack()
         ))
     
     if nav_buttons:
@@ -441,23 +2157,36 @@ def get_calendar_keyboard(selected_month: int = None, selected_year: int = None)
     
     buttons.append([InlineKeyboardButton(
         text="« К выбору услуги",
-        callback_data="back_to_services"
+        callback_data=CB_SERVICES
     )])
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def get_time_keyboard(date: str, booked_times: List[str]) -> InlineKeyboardMarkup:
+def get_time_keyboard(date: str, blocked_mask: int, duration: int = DEFAULT_DURATION) -> InlineKeyboardMarkup:
     """Улучшенная клавиатура выбора времени"""
+    # Кнопки не зависят от даты (она хранится в FSM), только от занятости
+    return render_time_keyboard(blocked_mask, closing_mask(duration))
+
+@KeyboardCache(maxsize=256)
+def render_time_keyboard(blocked_mask: int, closed_mask: int = 0) -> InlineKeyboardMarkup:
+    """
+    Отрисовка слотов по маске недоступных стартов. Старты из closed_mask
+    не освободятся никогда (услуга не успевает до закрытия) — в лист
+    ожидания на них не записываем.
+    """
     buttons = []
     row = []
     
     for i, time in enumerate(WORKING_HOURS):
-        if time in booked_times:
+        if closed_mask & (1 << i):
+            btn_text = f"⛔ {time}"
+            callback = CB_NOOP
+        elif blocked_mask & (1 << i):
             btn_text = f"🚫 {time}"
-            callback = "time_unavailable"
+            callback = WaitSlotCallback(minutes=to_minutes(time)).pack()
         else:
             btn_text = f"🟢 {time}"
-            callback = f"time_{time}"
+            callback = TimeCallback(minutes=to_minutes(time)).pack()
         
         row.append(InlineKeyboardButton(text=btn_text, callback_data=callback))
         
@@ -470,7 +2199,7 @@ def get_time_keyboard(date: str, booked_times: List[str]) -> InlineKeyboardMarku
     
     buttons.append([InlineKeyboardButton(
         text="« К выбору даты",
-        callback_data="back_to_date"
+        callback_data=CB_DATES
     )])
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
@@ -479,8 +2208,17 @@ def get_confirmation_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура подтверждения"""
     return InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="✅ Подтвердить запись", callback_data="confirm_yes"),
-            InlineKeyboardButton(text="❌ Отменить", callback_data="confirm_no")
+            InlineKeyboardButton(text="✅ Подтвердить запись", callback_data=CB_CONFIRM),
+            InlineKeyboardButton(text="❌ Отменить", callback_data=CB_DECLINE)
+        ]
+    ])
+
+def get_waitlist_offer_keyboard(entry_id: int) -> InlineKeyboardMarkup:
+    """Кнопки предложения освободившегося слота"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="✅ Записаться", callback_data=WaitClaimCallback(entry_id=entry_id).pack()),
+            InlineKeyboardButton(text="✖️ Не нужно", callback_data=WaitDeclineCallback(entry_id=entry_id).pack())
         ]
     ])
 
@@ -495,34 +2233,473 @@ def get_my_appointments_keyboard(appointments: List[tuple]) -> InlineKeyboardMar
         
         buttons.append([InlineKeyboardButton(
             text=f"🗑 Отменить запись {formatted_date} в {time}",
-            callback_data=f"cancel_{apt_id}"
+            callback_data=CancelCallback(appointment_id=apt_id).pack()
         )])
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+def get_admin_page_keyboard(page: Callable[..., CallbackData], rows: List[tuple], cursor: Optional[tuple],
+                            backward: bool, has_more: bool) -> Optional[InlineKeyboardMarkup]:
+    """
+    Навигация по страницам /all и /history: page(backward, day, minutes,
+    appointment_id) строит данные кнопки с курсором крайней строки.
+    Строки: (id, _, _, _, date, time, ...)
+    """
+    def button(text: str, backward: bool, row: tuple) -> InlineKeyboardButton:
+        return InlineKeyboardButton(text=text, callback_data=page(
+            backward=backward, day=pack_date(row[4]), minutes=to_minutes(row[5]), appointment_id=row[0]
+        ).pack())
+    
+    buttons = []
+    # Назад можно, если пришли по курсору вперёд или сзади есть ещё строки;
+    # вперёд — если пришли назад или впереди есть ещё строки
+    if has_more if backward else cursor is not None:
+        buttons.append(button("◀️", True, rows[0]))
+    if backward or has_more:
+        buttons.append(button("▶️", False, rows[-1]))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
 # ================================
 # 🤖 ИНИЦИАЛИЗАЦИЯ
 # ================================
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=session)
+db = AsyncDatabase(Database())
+storage = SQLiteStorage(db) if FSM_STORAGE == 'sqlite' else BoundedMemoryStorage()
+dp = Dispatcher(storage=storage)
+router = Router()
+
+# ================================
+# 📤 ИСХОДЯЩИЕ СООБЩЕНИЯ
+# ================================
+
+PRIORITY_INTERACTIVE = 0  # Ответы на действия пользователя
+PRIORITY_NOTIFICATION = 1  # Уведомления админам, предложения из листа ожидания (слот держится ограниченное время)
+PRIORITY_BULK = 2  # Фоновые рассылки без срочности: напоминания за сутки
+
+# Приоритет исходящих запросов в текущей задаче
+outbound_priority: ContextVar[int] = ContextVar('outbound_priority', default=PRIORITY_INTERACTIVE)
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity"""
+    
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+    
+    def take(self, now: float) -> float:
+        """Забирает токен и возвращает 0, либо возвращает, сколько ждать"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def wait(self, now: float) -> float:
+        """Сколько ждать токена, не забирая его"""
+        tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+    
+    def pause(self, now: float, seconds: float):
+        """Блокировка корзины (flood wait): токены появятся через seconds"""
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+        self.updated = now
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """
+    Планировщик исходящих запросов к Bot API.
+    
+    Каждое сообщение в чат проходит через корзину этого чата и общую
+    корзину бота. Очередь к общей корзине упорядочена по приоритету,
+    поэтому ответы пользователям обгоняют уведомления и рассылки.
+    RetryAfter от Telegram выдерживается автоматически, после чего
+    запрос повторяется. Запросы без chat_id (getUpdates, answerCallbackQuery
+    и т.п.) в лимиты сообщений не входят и идут напрямую.
+    """
+    
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE, chat_rate: float = OUTBOUND_CHAT_RATE,
+                 group_rate: float = OUTBOUND_GROUP_RATE, chat_burst: int = OUTBOUND_CHAT_BURST,
+                 max_chats: int = 10000):
+        # Общий лимит без запаса на всплеск: иначе в первую секунду ушло бы 2 × rate
+        self._global = TokenBucket(global_rate, 1)
+        self._chat_rate = chat_rate
+        self._group_rate = group_rate
+        self._chat_burst = chat_burst
+        self._max_chats = max_chats
+        self._chats: OrderedDict = OrderedDict()
+        self._waiters: List[tuple] = []
+        self._seq = count()
+        self._pump_task = None
+        self.sent = [0, 0, 0]
+        self.wait_total = [0.0, 0.0, 0.0]
+        self.wait_max = [0.0, 0.0, 0.0]
+        self.retry_after = 0
+    
+    def _chat(self, chat_id) -> tuple:
+        """(корзина, блокировка очереди) чата"""
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            # Группы и каналы: ~20 сообщений в минуту, личные чаты: ~1 в секунду
+            rate = self._group_rate if isinstance(chat_id, str) or chat_id < 0 else self._chat_rate
+            chat = self._chats[chat_id] = (TokenBucket(rate, self._chat_burst), asyncio.Lock())
+            if len(self._chats) > self._max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return chat
+    
+    async def _acquire(self, chat_id, priority: int):
+        bucket, lock = self._chat(chat_id)
+        # Сообщения одного чата встают в общую очередь по одному и по порядку.
+        # Токен чата берётся уже после неё: если взять его до очереди,
+        # задержанные в ней сообщения уйдут в чат пачкой сверх лимита
+        async with lock:
+            while True:
+                delay = bucket.wait(monotonic())
+                if delay:
+                    await asyncio.sleep(delay)
+                    continue
+                await self._acquire_global(priority)
+                if not bucket.take(monotonic()):
+                    return
+                # Пока ждали очередь, чат получил flood wait — общий токен возвращаем
+                self._global.tokens += 1
+    
+    async def _acquire_global(self, priority: int):
+        # Без очереди и при свободном токене — сразу
+        if not self._waiters and not self._global.take(monotonic()):
+            return
+        
+        waiter = asyncio.get_running_loop().create_future()
+        heappush(self._waiters, (priority, next(self._seq), waiter))
+        if self._pump_task is None:
+            self._pump_task = asyncio.create_task(self._pump())
+        await waiter
+    
+    async def _pump(self):
+        try:
+            while self._waiters:
+                delay = self._global.take(monotonic())
+                if delay:
+                    await asyncio.sleep(delay)
+                    continue
+                _, _, waiter = heappop(self._waiters)
+                if waiter.done():
+                    self._global.tokens += 1
+                else:
+                    waiter.set_result(None)
+        finally:
+            self._pump_task = None
+    
+    async def __call__(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        
+        priority = outbound_priority.get()
+        started = monotonic()
+        await self._acquire(chat_id, priority)
+        waited = monotonic() - started
+        self.sent[priority] += 1
+        self.wait_total[priority] += waited
+        self.wait_max[priority] = max(self.wait_max[priority], waited)
+        
+        while True:
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retry_after += 1
+                logger.warning(f"⏳ Flood control для чата {chat_id}: ждём {e.retry_after} с")
+                self._chat(chat_id)[0].pause(monotonic(), e.retry_after)
+                await self._acquire(chat_id, priority)
+    
+    def stats(self) -> dict:
+        names = ('interactive', 'notification', 'bulk')
+        return {
+            'queue_depth': len(self._waiters),
+            'chats': len(self._chats),
+            'retry_after': self.retry_after,
+            'priorities': {
+                name: {
+                    'sent': self.sent[i],
+                    'wait_avg': self.wait_total[i] / self.sent[i] if self.sent[i] else 0.0,
+                    'wait_max': self.wait_max[i],
+                }
+                for i, name in enumerate(names)
+            },
+        }
+
+outbound = OutboundScheduler()
+bot.session.middleware(outbound)
+
+# ================================
+# 🧱 MIDDLEWARE
+# ================================
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Ограничение числа одновременно обрабатываемых обновлений"""
+    
+    def __init__(self, limit: int):
+        self._semaphore = asyncio.Semaphore(limit)
+    
+    async def __call__(self, handler, event, data):
+        async with self._semaphore:
+            return await handler(event, data)
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Поток обновлений, ошибки и полное время обработки — по типу обновления"""
+    
+    async def __call__(self, handler, event, data):
+        event_type = event.event_type
+        metrics.inc('bot_updates_total', event_type)
+        started = perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc('bot_update_errors_total', event_type)
+            raise
+        finally:
+            metrics.observe('bot_update_duration_seconds', event_type, perf_counter() - started)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время работы и ошибки конкретного хэндлера (внутренний middleware роутера)"""
+    
+    async def __call__(self, handler, event, data):
+        name = data['handler'].callback.__name__
+        started = perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', name)
+            raise
+        finally:
+            metrics.observe('bot_handler_duration_seconds', name, perf_counter() - started)
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничение частоты нажатий инлайн-кнопок до их разбора и хэндлера.
+    
+    У каждого пользователя общая корзина токенов и по корзине на вид
+    кнопки (префикс callback_data). Лишнее нажатие получает пустой
+    answerCallbackQuery и не доходит ни до базы, ни до editMessage.
+    Навигация (месяцы, страницы) не отбрасывается, а схлопывается:
+    ждёт токен не дольше THROTTLE_COALESCE_WAIT, и выполняется только
+    последнее нажатие — промежуточные экраны всё равно никто не увидит.
+    Состояние — LRU на THROTTLE_MAX_USERS пользователей: вытесняется тот,
+    кто давно не нажимал, а его корзины и так были бы полными.
+    """
+    
+    def __init__(self, coalesce: tuple = (), enabled: bool = THROTTLE):
+        self.enabled = enabled
+        self.coalesce = frozenset(coalesce)
+        self._users: OrderedDict = OrderedDict()  # user_id -> (общая корзина, {вид: корзина}, {вид: ожидающий})
+        self.passed = 0
+        self.dropped = 0
+        self.coalesced = 0
+    
+    def _user(self, user_id: int) -> tuple:
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = (TokenBucket(THROTTLE_USER_RATE, THROTTLE_USER_BURST), {}, {})
+            if len(self._users) > THROTTLE_MAX_USERS:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return user
+    
+    @staticmethod
+    def _take(user: tuple, action: str) -> float:
+        """Токен из обеих корзин или время ожидания (тогда не тратится ни один)"""
+        bucket = user[1].get(action)
+        if bucket is None:
+            bucket = user[1][action] = TokenBucket(THROTTLE_ACTION_RATE, THROTTLE_ACTION_BURST)
+        now = monotonic()
+        wait = bucket.take(now)
+        if wait:
+            return wait
+        wait = user[0].take(now)
+        if wait:
+            bucket.tokens += 1
+        return wait
+    
+    async def _wait_latest(self, user: tuple, action: str, wait: float) -> bool:
+        """Ждёт токен, пока это нажатие последнее; False — его обогнало следующее"""
+        pending = user[2]
+        previous = pending.get(action)
+        if previous is not None and not previous.done():
+            previous.set_result(False)
+        
+        loop = asyncio.get_running_loop()
+        waiter = pending[action] = loop.create_future()
+        try:
+            while wait:
+                if wait > THROTTLE_COALESCE_WAIT:
+                    return False
+                timer = loop.call_later(wait, lambda: waiter.done() or waiter.set_result(True))
+                try:
+                    if not await waiter:
+                        return False
+                finally:
+                    timer.cancel()
+                waiter = pending[action] = loop.create_future()
+                wait = self._take(user, action)
+            return True
+        finally:
+            if pending.get(action) is waiter:
+                del pending[action]
+    
+    async def __call__(self, handler, event: CallbackQuery, data):
+        if not self.enabled or event.from_user is None:
+            return await handler(event, data)
+        
+        # Префикс из непроверенных данных: неизвестные сводим к одному виду,
+        # чтобы поддельные кнопки не плодили корзины и серии метрик
+        action = (event.data or "").partition(":")[0]
+        if action not in callbacks.routes:
+            action = "unknown"
+        user = self._user(event.from_user.id)
+        wait = self._take(user, action)
+        # Пока кто-то ждёт, очередь навигации держит он — иначе старое нажатие отработает после нового
+        if action in self.coalesce and (wait or action in user[2]):
+            if not await self._wait_latest(user, action, wait):
+                self.coalesced += 1
+                metrics.inc('bot_throttled_total', action)
+                await event.answer()
+                return None
+        elif wait:
+            self.dropped += 1
+            metrics.inc('bot_throttled_total', action)
+            await event.answer("⏳ Не так быстро")
+            return None
+        
+        self.passed += 1
+        return await handler(event, data)
+    
+    def stats(self) -> dict:
+        return {
+            'users': len(self._users),
+            'passed': self.passed,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+        }
+
+throttle = ThrottlingMiddleware(
+    coalesce=(MonthCallback.__prefix__, PageCallback.__prefix__, HistoryPageCallback.__prefix__)
 )
-logger = logging.getLogger(__name__)
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-router = Router()
-db = Database()
+# Метрики — первыми, чтобы время обновления включало ожидание семафора
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+dp.update.outer_middleware(ConcurrencyLimitMiddleware(MAX_CONCURRENT_UPDATES))
+# Частые нажатия отсекаются до разбора callback_data и хэндлеров
+dp.callback_query.outer_middleware(throttle)
+# Для кнопок время хэндлеров пишет CallbackRouter
+router.message.middleware(HandlerMetricsMiddleware())
 
 # ================================
 # 🔔 УВЕДОМЛЕНИЯ АДМИНУ
 # ================================
 
-async def notify_admin_new_booking(appointment_id: int):
-    """Отправка уведомления админу о новой записи"""
-    details = db.get_appointment_details(appointment_id)
+class AdminNotifier:
+    """
+    Фоновая рассылка уведомлений админам.
+    
+    Хэндлер только ставит уведомление в очередь и сразу продолжает
+    работу. Воркер берёт уведомления по порядку (отмена не обгонит
+    запись) и отправляет каждое всем админам одновременно, повторяя
+    попытки при временных ошибках Telegram с растущей задержкой.
+    """
+    
+    def __init__(self, bot: Bot, admin_ids: List[int], retries: int = 3, base_delay: float = 1.0):
+        self._bot = bot
+        self._admin_ids = admin_ids
+        self._retries = retries
+        self._base_delay = base_delay
+        self._queue = None
+        self._worker = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+    
+    def submit(self, build_text):
+        """Постановка в очередь; build_text — корутина-функция, возвращающая текст или None"""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        self._queue.put_nowait(build_text)
+    
+    async def _run(self):
+        outbound_priority.set(PRIORITY_NOTIFICATION)
+        while True:
+            build_text = await self._queue.get()
+            try:
+                text = await build_text()
+                if text:
+                    await asyncio.gather(*(self._deliver(admin_id, text) for admin_id in self._admin_ids))
+            except Exception as e:
+                logger.error(f"Ошибка подготовки уведомления: {e}")
+            finally:
+                self._queue.task_done()
+    
+    async def _deliver(self, admin_id: int, text: str):
+        for attempt in range(self._retries + 1):
+            try:
+                await self._bot.send_message(admin_id, text, parse_mode="HTML")
+                self.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                delay = e.retry_after
+            except (TelegramNetworkError, TelegramServerError):
+                delay = self._base_delay * 2 ** attempt
+            except Exception as e:
+                logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+                self.failed += 1
+                return
+            
+            if attempt < self._retries:
+                self.retried += 1
+                await asyncio.sleep(delay)
+        
+        logger.error(f"Не удалось отправить уведомление админу {admin_id} после {self._retries + 1} попыток")
+        self.failed += 1
+    
+    async def close(self, timeout: float = 10):
+        """Дожидается отправки очереди (не дольше timeout) и останавливает воркер"""
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Не отправлено уведомлений: {self._queue.qsize()}")
+        self._worker.cancel()
+        self._worker = None
+    
+    def stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize() if self._queue else 0,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+        }
+
+notifier = AdminNotifier(bot, ADMIN_IDS)
+
+async def booking_notification_text(appointment_id: int) -> Optional[str]:
+    """Текст уведомления о новой записи"""
+    details = await db.get_appointment_details(appointment_id)
     if not details:
         return
     
@@ -543,16 +2720,11 @@ async def notify_admin_new_booking(appointment_id: int):
 
 📝 <b>ID записи:</b> #{appointment_id}
     """
-    
-    for admin_id in ADMIN_IDS:
-        try:
-            await bot.send_message(admin_id, notification, parse_mode="HTML")
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+    return notification
 
-async def notify_admin_cancellation(appointment_id: int, cancelled_by_user: bool = True):
-    """Уведомление об отмене записи"""
-    details = db.get_appointment_details(appointment_id)
+async def cancellation_notification_text(appointment_id: int, cancelled_by_user: bool = True) -> Optional[str]:
+    """Текст уведомления об отмене записи"""
+    details = await db.get_appointment_details(appointment_id)
     if not details:
         return
     
@@ -574,12 +2746,733 @@ async def notify_admin_cancellation(appointment_id: int, cancelled_by_user: bool
 ⚠️ Отменено {who_cancelled}
 📝 ID: #{appointment_id}
     """
+    return notification
+
+def notify_admin_new_booking(appointment_id: int):
+    """Уведомление админам о новой записи (отправляется в фоне)"""
+    notifier.submit(partial(booking_notification_text, appointment_id))
+
+def notify_admin_cancellation(appointment_id: int, cancelled_by_user: bool = True):
+    """Уведомление админам об отмене записи (отправляется в фоне)"""
+    notifier.submit(partial(cancellation_notification_text, appointment_id, cancelled_by_user))
+
+# ================================
+# ⏰ НАПОМИНАНИЯ
+# ================================
+
+class ReminderScheduler:
+    """
+    Напоминания клиентам за REMINDER_LEAD до визита.
+    
+    В памяти — только напоминания, срок которых наступает в ближайшие
+    REMINDER_HORIZON: они лежат в куче по времени отправки, и задача
+    спит до ближайшего из них, а не опрашивает базу. Горизонт
+    перечитывается раз в половину своей длины. Перед отправкой запись
+    помечается в базе (reminded_at), так что после перезапуска
+    напоминание не уйдёт повторно.
+    
+    Записи, сделанные меньше чем за REMINDER_LEAD до визита, остаются
+    без напоминания — и при записи, и при перечитывании горизонта.
+    """
+    
+    def __init__(self, lead: timedelta = REMINDER_LEAD, horizon: timedelta = REMINDER_HORIZON):
+        self._lead = lead
+        self._horizon = horizon
+        self._heap: List[tuple] = []
+        self._due: Dict[int, float] = {}  # appointment_id -> время отправки
+        self._loaded_until = 0.0
+        self._wakeup = None
+        self._task = None
+        self.sent = 0
+    
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+    
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    def _push(self, appointment_id: int, due: float):
+        self._due[appointment_id] = due
+        heappush(self._heap, (due, appointment_id))
+    
+    def schedule(self, appointment_id: int, date: str, time: str):
+        """Новая запись: в кучу, если напоминание попадает в загруженный горизонт"""
+        due = (datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M") - self._lead).timestamp()
+        # Записались меньше чем за REMINDER_LEAD — напоминать незачем
+        if due <= datetime.now().timestamp() or due > self._loaded_until:
+            return
+        self._push(appointment_id, due)
+        if self._wakeup is not None and self._heap[0][1] == appointment_id:
+            self._wakeup.set()
+    
+    def discard(self, appointment_id: int):
+        """Отмена записи: элемент кучи станет пустышкой и будет пропущен"""
+        self._due.pop(appointment_id, None)
+    
+    async def _load(self):
+        now = datetime.now()
+        until = now + self._lead + self._horizon
+        rows = await db.get_due_reminders(now.strftime("%Y-%m-%d"), until.strftime("%Y-%m-%d"))
+        for appointment_id, date, time, created_at in rows:
+            visit = datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M")
+            if visit <= now or visit > until or appointment_id in self._due:
+                continue
+            # Записались меньше чем за REMINDER_LEAD — как и в schedule, не напоминаем
+            if created_at and visit - datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S") < self._lead:
+                continue
+            # Если бот был выключен в момент отправки — напоминаем сейчас
+            self._push(appointment_id, max((visit - self._lead).timestamp(), now.timestamp()))
+        self._loaded_until = (now + self._horizon).timestamp()
+    
+    async def _run(self):
+        while True:
+            try:
+                now = datetime.now().timestamp()
+                if now >= self._loaded_until - self._horizon.total_seconds() / 2:
+                    await self._load()
+                
+                while self._heap and self._heap[0][0] <= now:
+                    due, appointment_id = heappop(self._heap)
+                    if self._due.get(appointment_id) == due:
+                        del self._due[appointment_id]
+                        await self._send(appointment_id)
+                
+                next_reload = self._loaded_until - self._horizon.total_seconds() / 2
+                next_due = self._heap[0][0] if self._heap else next_reload
+                timeout = max(0.0, min(next_due, next_reload) - datetime.now().timestamp())
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка планировщика напоминаний: {e}")
+                await asyncio.sleep(60)
+    
+    async def _send(self, appointment_id: int):
+        # Сначала отметка в базе: если запись отменена или уже напомнили — не шлём
+        if not await db.mark_reminded(appointment_id):
+            return
+        details = await db.get_appointment_details(appointment_id)
+        if not details:
+            return
+        
+        user_id, full_name, phone, service, date, time, price = details
+        date_obj = datetime.strptime(date, "%Y-%m-%d")
+        formatted_date = f"{date_obj.day} {MONTHS_RU[date_obj.month]}"
+        
+        text = (
+            f"⏰ <b>Напоминание о записи</b>\n\n"
+            f"{full_name}, ждём вас {formatted_date} в <b>{time}</b>!\n\n"
+            f"💅 {service}\n"
+            f"📍 {SALON_ADDRESS}\n\n"
+            f"Если планы изменились, отмените запись в меню \"📋 Мои записи\""
+        )
+        
+        token = outbound_priority.set(PRIORITY_BULK)
+        try:
+            await bot.send_message(user_id, text, parse_mode="HTML")
+            self.sent += 1
+        except Exception as e:
+            logger.error(f"Не удалось отправить напоминание по записи #{appointment_id}: {e}")
+        finally:
+            outbound_priority.reset(token)
+    
+    def stats(self) -> dict:
+        return {
+            'scheduled': len(self._due),
+            'heap': len(self._heap),
+            'sent': self.sent,
+        }
+
+reminders = ReminderScheduler()
+
+# ================================
+# 🗃 АРХИВ
+# ================================
+
+class AppointmentArchiver:
+    """
+    Периодический перенос записей старше keep_days дней в
+    appointments_archive. Каждая пачка — отдельная короткая транзакция
+    в очереди писателя, так что бронирования между пачками не ждут
+    окончания всего прохода.
+    """
+    
+    def __init__(self, keep_days: int = ARCHIVE_AFTER_DAYS, batch: int = ARCHIVE_BATCH,
+                 interval: int = ARCHIVE_INTERVAL):
+        self._keep_days = keep_days
+        self._batch = batch
+        self._interval = interval
+        self._task = None
+        self.archived = 0
+        self.runs = 0
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    async def run_once(self) -> int:
+        """Один проход: переносит всё, что старше срока; возвращает число строк"""
+        cutoff = (datetime.now() - timedelta(days=self._keep_days)).strftime("%Y-%m-%d")
+        moved = 0
+        while True:
+            count = await db.archive_batch(cutoff, self._batch)
+            moved += count
+            if count < self._batch:
+                break
+        self.archived += moved
+        self.runs += 1
+        return moved
+    
+    async def _run(self):
+        while True:
+            try:
+                moved = await self.run_once()
+                if moved:
+                    logger.info(f"🗃 В архив перенесено записей: {moved}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка архивации: {e}")
+            await asyncio.sleep(self._interval)
+    
+    def stats(self) -> dict:
+        return {
+            'archived': self.archived,
+            'runs': self.runs,
+        }
+
+archiver = AppointmentArchiver()
+
+# ================================
+# ⏳ ЛИСТ ОЖИДАНИЯ
+# ================================
+
+class Waitlist:
+    """
+    Лист ожидания на занятые слоты и целые дни.
+    
+    Подписки хранятся в таблице waitlist, в памяти — FIFO-очереди их id
+    по ключу (дата, время), для целого дня — (дата, None). Освободившийся
+    интервал смотрит только очереди своих стартов и своего дня: прямой
+    поиск по ключу, без перебора подписчиков. Первому подходящему по
+    очереди слот удерживается на hold секунд — в индексе слотов он занят
+    для остальных — и приходит сообщение с кнопкой записи. Отказ или
+    истёкшее удержание снимают подписку, и слот уходит следующему.
+    Удержания переживают перезапуск, прошедшие даты чистятся раз в
+    cleanup_interval.
+    """
     
-    for admin_id in ADMIN_IDS:
+    def __init__(self, hold: int = WAITLIST_HOLD, cleanup_interval: int = WAITLIST_CLEANUP_INTERVAL):
+        self._hold = hold
+        self._cleanup_interval = cleanup_interval
+        self._queues: Dict[tuple, deque] = {}  # (date, time или None) -> id подписок в порядке очереди
+        self._entries: Dict[int, tuple] = {}  # id -> (user_id, service_key, date, time) ждущих предложения
+        self._holds: Dict[int, tuple] = {}  # id -> (user_id, service_key, date, time, таймер) удержанных
+        self._offering: set = set()  # id, для которых удержание сейчас оформляется
+        self._tasks: set = set()
+        self._task = None
+        self.offered = 0
+        self.claimed = 0
+        self.expired = 0
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for *_, timer in self._holds.values():
+            timer.cancel()
+    
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    def _enqueue(self, entry_id: int, user_id: int, service_key: str, date: str, time: Optional[str]):
+        self._entries[entry_id] = (user_id, service_key, date, time)
+        self._queues.setdefault((date, time), deque()).append(entry_id)
+    
+    def _start_hold(self, entry_id: int, user_id: int, service_key: str, date: str, time: str, until: float):
+        delay = max(0.0, until - datetime.now().timestamp())
+        timer = asyncio.get_running_loop().call_later(delay, lambda: self._spawn(self._expire(entry_id)))
+        self._holds[entry_id] = (user_id, service_key, date, time, timer)
+    
+    async def join(self, user_id: int, service_key: str, date: str, time: Optional[str] = None) -> bool:
+        """Подписка на слот или день; False, если пользователь уже в этой очереди"""
+        entry_id = await db.add_waiter(user_id, service_key, date, time)
+        if entry_id is None:
+            return False
+        self._enqueue(entry_id, user_id, service_key, date, time)
+        return True
+    
+    def release(self, date: str, time: str, service_key: str):
+        """Отмена записи: освободившийся слот предлагается в фоне"""
+        self._spawn(self._offer_freed(date, time, service_duration(service_key)))
+    
+    def _next_candidate(self, date: str, starts: List[str]) -> Optional[tuple]:
+        """Самая ранняя подписка из очередей освободившихся стартов и дня, которой слот подходит: (id, время)"""
+        best = None
+        for key in [(date, time) for time in starts] + [(date, None)]:
+            queue = self._queues.get(key)
+            if queue is None:
+                continue
+            # Предложенные и снятые подписки убираются из головы лениво
+            while queue and queue[0] not in self._entries:
+                queue.popleft()
+            if not queue:
+                del self._queues[key]
+                continue
+            for entry_id in queue:
+                if best is not None and entry_id > best[0]:
+                    break
+                entry = self._entries.get(entry_id)
+                if entry is None or entry_id in self._offering:
+                    continue
+                _, service_key, _, wanted = entry
+                duration = service_duration(service_key)
+                time = next((t for t in ([wanted] if wanted else starts) if db.sync.slots.fits(date, t, duration)), None)
+                if time is not None:
+                    best = (entry_id, time)
+                    break
+        return best
+    
+    async def _offer_freed(self, date: str, time: str, duration: int):
+        if date < datetime.now().strftime("%Y-%m-%d"):
+            return
+        start, end = to_minutes(time), to_minutes(time) + duration
+        # Старт мог блокироваться этой записью, даже если он раньше неё:
+        # длинная услуга с более раннего времени упиралась в её начало
+        longest = max([DEFAULT_DURATION] + [service['duration'] for service in SERVICES.values()])
+        starts = [t for t in WORKING_HOURS if to_minutes(t) < end and to_minutes(t) + longest > start]
+        # Длинная отмена может вместить несколько коротких услуг — предлагаем, пока есть кому
+        while True:
+            candidate = self._next_candidate(date, starts)
+            if candidate is None or not await self._offer(*candidate):
+                return
+    
+    async def _offer(self, entry_id: int, time: str) -> bool:
+        user_id, service_key, date, _ = self._entries[entry_id]
+        until = datetime.now().timestamp() + self._hold
+        # Пока идёт запись в базу, параллельное предложение эту подписку не возьмёт
+        self._offering.add(entry_id)
+        try:
+            if not await db.hold_slot(entry_id, date, time, service_duration(service_key), until):
+                return False
+        finally:
+            self._offering.discard(entry_id)
+        del self._entries[entry_id]
+        self._start_hold(entry_id, user_id, service_key, date, time, until)
+        self.offered += 1
+        
+        service = SERVICES.get(service_key, {})
+        date_obj = datetime.strptime(date, "%Y-%m-%d")
+        text = (
+            f"🔔 <b>Освободилось время!</b>\n\n"
+            f"💅 {service.get('name', '')}\n"
+            f"📅 {date_obj.day} {MONTHS_RU[date_obj.month]} в <b>{time}</b>\n\n"
+            f"Держу его для вас {self._hold // 60} мин. Записаться?"
+        )
+        token = outbound_priority.set(PRIORITY_NOTIFICATION)
+        try:
+            await bot.send_message(user_id, text, parse_mode="HTML", reply_markup=get_waitlist_offer_keyboard(entry_id))
+        except Exception as e:
+            # Не доставили (например, бот заблокирован) — слот сразу следующему
+            logger.error(f"Не удалось предложить слот из листа ожидания #{entry_id}: {e}")
+            await self._drop_hold(entry_id)
+        finally:
+            outbound_priority.reset(token)
+        return True
+    
+    async def _drop_hold(self, entry_id: int) -> Optional[tuple]:
+        """Снятие удержания и подписки; освободившийся слот — следующему"""
+        hold = self._holds.pop(entry_id, None)
+        if hold is None:
+            return None
+        user_id, service_key, date, time, timer = hold
+        timer.cancel()
+        await db.remove_waiter(entry_id)
+        self.release(date, time, service_key)
+        return hold
+    
+    async def _expire(self, entry_id: int):
+        if await self._drop_hold(entry_id) is not None:
+            self.expired += 1
+    
+    async def claim(self, entry_id: int, user_id: int) -> Optional[tuple]:
+        """Запись на удержанный слот: (appointment_id, date, time, service_key) или None"""
+        hold = self._holds.get(entry_id)
+        if hold is None or hold[0] != user_id:
+            return None
+        # Забираем удержание до await — таймер истечения его уже не найдёт
+        del self._holds[entry_id]
+        _, service_key, date, time, timer = hold
+        timer.cancel()
+        service = SERVICES[service_key]
+        appointment_id = await db.claim_hold(entry_id, user_id, service['name'], service_key, service['price'])
+        if appointment_id is None:
+            self._holds[entry_id] = hold
+            await self._expire(entry_id)
+            return None
+        self.claimed += 1
+        return appointment_id, date, time, service_key
+    
+    async def decline(self, entry_id: int, user_id: int) -> bool:
+        hold = self._holds.get(entry_id)
+        if hold is None or hold[0] != user_id:
+            return False
+        await self._drop_hold(entry_id)
+        return True
+    
+    async def _load(self):
+        today = datetime.now().strftime("%Y-%m-%d")
+        for entry_id, user_id, service_key, date, time, held_time, hold_until in await db.load_waitlist(today):
+            if held_time:
+                self._start_hold(entry_id, user_id, service_key, date, held_time, hold_until)
+            else:
+                self._enqueue(entry_id, user_id, service_key, date, time)
+    
+    async def cleanup(self) -> int:
+        """Удаление подписок и удержаний на прошедшие даты"""
+        today = datetime.now().strftime("%Y-%m-%d")
+        for key in [key for key in self._queues if key[0] < today]:
+            for entry_id in self._queues.pop(key):
+                self._entries.pop(entry_id, None)
+        for entry_id in [entry_id for entry_id, hold in self._holds.items() if hold[2] < today]:
+            self._holds.pop(entry_id)[4].cancel()
+        return await db.purge_waitlist(today)
+    
+    async def _run(self):
         try:
-            await bot.send_message(admin_id, notification, parse_mode="HTML")
+            await self._load()
         except Exception as e:
-            logger.error(f"Ошибка отправки уведомления: {e}")
+            logger.error(f"Ошибка загрузки листа ожидания: {e}")
+        while True:
+            try:
+                purged = await self.cleanup()
+                if purged:
+                    logger.info(f"⏳ Из листа ожидания удалено прошедших подписок: {purged}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка чистки листа ожидания: {e}")
+            await asyncio.sleep(self._cleanup_interval)
+    
+    def stats(self) -> dict:
+        return {
+            'waiting': len(self._entries),
+            'queues': len(self._queues),
+            'holds': len(self._holds),
+            'offered': self.offered,
+            'claimed': self.claimed,
+            'expired': self.expired,
+        }
+
+waitlist = Waitlist()
+
+# ================================
+# 🩺 МОНИТОРИНГ EVENT LOOP
+# ================================
+
+class LoopMonitor:
+    """
+    Задержка event loop и поиск блокирующих вызовов.
+    
+    Корутина-тикер просыпается каждые interval секунд и записывает, на
+    сколько опоздала, — это и есть задержка loop; последние значения
+    лежат в кольцевом буфере для перцентилей.
+    
+    Сторожевой поток от тиков не зависит: каждые threshold / 4 он ставит
+    в loop пробу (call_soon_threadsafe) и ждёт ответа не дольше threshold.
+    Не дождался — loop занят, и поток снимает его стек
+    (sys._current_frames) и пишет в лог вместе с именем хэндлера,
+    найденного в этом стеке. Так со стеком пишется любая блокировка
+    дольше 1.25 × threshold при любом interval.
+    """
+    
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_BLOCK_THRESHOLD,
+                 samples: int = 4096):
+        self._interval = interval
+        self._threshold = threshold
+        self._lags = deque(maxlen=samples)
+        self._loop = None
+        self._loop_thread = None
+        self._pong = threading.Event()
+        self._task = None
+        self._watchdog = None
+        self._stop = threading.Event()
+        self.blocks = 0
+        self.max_lag = 0.0
+    
+    @property
+    def enabled(self) -> bool:
+        return self._task is not None
+    
+    def start(self):
+        """Включение (вызывать из event loop)"""
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._task = asyncio.create_task(self._run())
+        if self._watchdog is None:
+            self._stop.clear()
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+    
+    def stop(self):
+        """Выключение тикера; сторожевой поток, пока тикер выключен, пробы не ставит"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    async def close(self):
+        self.stop()
+        self._stop.set()
+        self._watchdog = None
+    
+    async def _run(self):
+        expected = monotonic() + self._interval
+        while True:
+            await asyncio.sleep(self._interval)
+            now = monotonic()
+            lag = max(0.0, now - expected)
+            self._lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self._threshold:
+                logger.warning(f"🐢 Event loop был заблокирован на {lag * 1000:.0f} мс")
+            expected = now + self._interval
+    
+    def _watch(self):
+        while not self._stop.wait(self._threshold / 4):
+            if self._task is None:
+                continue
+            self._pong.clear()
+            try:
+                self._loop.call_soon_threadsafe(self._pong.set)
+            except RuntimeError:  # loop уже закрыт
+                return
+            if self._pong.wait(self._threshold):
+                continue
+            self.blocks += 1
+            self._report_stack()
+            # Одна блокировка — один отчёт: ждём, пока loop ответит на пробу
+            while not self._pong.wait(self._threshold) and not self._stop.is_set():
+                pass
+    
+    def _report_stack(self):
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            return
+        handlers = {
+            handler.callback.__code__: handler.callback.__name__
+            for observer in router.observers.values()
+            for handler in observer.handlers
+            if hasattr(handler.callback, '__code__')
+        }
+        handlers.update({handler.__code__: handler.__name__ for _, handler, _, _ in callbacks.routes.values()})
+        active = next((handlers[f.f_code] for f in _walk_frames(frame) if f.f_code in handlers), "—")
+        logger.warning(
+            f"🐢 Event loop не отвечает дольше {self._threshold * 1000:.0f} мс, хэндлер: {active}\n"
+            + "".join(traceback.format_stack(frame))
+        )
+    
+    def percentiles(self) -> Dict[str, float]:
+        lags = sorted(self._lags)
+        if not lags:
+            return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0}
+        return {f'p{q}': lags[min(len(lags) - 1, len(lags) * q // 100)] for q in (50, 95, 99)}
+    
+    def stats(self) -> dict:
+        return {
+            'enabled': int(self.enabled),
+            'samples': len(self._lags),
+            **{f'lag_{name}': value for name, value in self.percentiles().items()},
+            'lag_max': self.max_lag,
+            'blocks': self.blocks,
+        }
+
+def _walk_frames(frame):
+    while frame is not None:
+        yield frame
+        frame = frame.f_back
+
+loop_monitor = LoopMonitor()
+
+# ================================
+# 🔀 МАРШРУТИЗАЦИЯ КНОПОК
+# ================================
+
+class IdempotencyGuard:
+    """
+    Однократное выполнение действия по ключу (пользователь, кнопка, цель).
+    
+    Пока первое выполнение идёт, повторы ждут его результат; после
+    завершения результат помнится ttl секунд. Ошибка не запоминается:
+    ждавшие её повторы получают то же исключение, а следующее нажатие
+    выполнит действие заново. Записи лежат в OrderedDict в порядке
+    истечения и чистятся с начала при каждом вызове; размер ограничен
+    maxsize.
+    """
+    
+    _IN_FLIGHT = float('inf')
+    
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL, maxsize: int = IDEMPOTENCY_MAX):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: OrderedDict = OrderedDict()  # ключ -> (истекает, future с результатом)
+        self.executed = 0
+        self.duplicates = 0
+    
+    def _purge(self, now: float):
+        while self._entries:
+            key, (expires, _) = next(iter(self._entries.items()))
+            if expires > now and len(self._entries) <= self.maxsize:
+                break
+            del self._entries[key]
+    
+    async def run(self, key: tuple, action: Callable[[], Any]) -> tuple:
+        """(результат, был ли это повтор)"""
+        now = monotonic()
+        self._purge(now)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            self.duplicates += 1
+            return await asyncio.shield(entry[1]), True
+        
+        future = asyncio.get_running_loop().create_future()
+        self._entries[key] = (self._IN_FLIGHT, future)
+        self.executed += 1
+        try:
+            result = await action()
+        except BaseException as e:
+            if self._entries.get(key, (None, None))[1] is future:
+                del self._entries[key]
+            future.set_exception(e)
+            future.exception()  # Без ждущих повторов исключение не должно попасть в лог как «не извлечённое»
+            raise
+        
+        future.set_result(result)
+        if self._entries.get(key, (None, None))[1] is future:
+            self._entries[key] = (monotonic() + self.ttl, future)
+            self._entries.move_to_end(key)
+        return result, False
+    
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'executed': self.executed,
+            'duplicates': self.duplicates,
+        }
+
+class CallbackRouter:
+    """
+    Маршрутизация нажатий инлайн-кнопок по префиксу callback_data.
+    
+    Вместо цепочки фильтров F.data.startswith(...), которые aiogram
+    проверяет по очереди, на роутере один хэндлер на все callback_query,
+    а дальше — поиск префикса в словаре и однократный разбор данных
+    фабрикой CallbackData с проверкой полей. Битые и устаревшие кнопки
+    отсекаются до хэндлера.
+    """
+    
+    def __init__(self):
+        self.routes: Dict[str, tuple] = {}  # префикс -> (фабрика или None, хэндлер, нужен ли state, цель или None)
+        self.rejected = 0
+        self.idempotency = IdempotencyGuard()
+    
+    def route(self, key, once: Optional[Callable[[CallbackQuery, Optional[CallbackData]], Any]] = None):
+        """
+        Регистрация хэндлера: key — фабрика CallbackData или строка кнопки без данных.
+        once(callback, callback_data) — цель действия: повторные нажатия с той же
+        целью от того же пользователя выполняются один раз (см. IdempotencyGuard).
+        """
+        factory = None if isinstance(key, str) else key
+        prefix = key if factory is None else factory.__prefix__
+        
+        def decorator(handler):
+            if prefix in self.routes:
+                raise ValueError(f"Префикс кнопок '{prefix}' уже занят")
+            self.routes[prefix] = (factory, handler, 'state' in inspect.signature(handler).parameters, once)
+            return handler
+        return decorator
+    
+    def resolve(self, data: str) -> tuple:
+        """callback_data -> (префикс, разобранные данные или None); ValueError, если не разобрать"""
+        prefix, separator, _ = data.partition(":")
+        route = self.routes.get(prefix)
+        if route is None:
+            raise ValueError(f"Неизвестная кнопка: {data!r}")
+        factory = route[0]
+        if factory is None:
+            if separator:
+                raise ValueError(f"Лишние данные у кнопки: {data!r}")
+            return prefix, None
+        try:
+            return prefix, factory.unpack(data)
+        except TypeError as e:
+            # Неверное число полей aiogram сообщает через TypeError
+            raise ValueError(str(e)) from e
+    
+    async def dispatch(self, callback: CallbackQuery, state: FSMContext):
+        try:
+            prefix, callback_data = self.resolve(callback.data or "")
+        except ValueError as e:
+            self.rejected += 1
+            logger.debug(f"Отклонена кнопка: {e}")
+            await callback.answer("Эта кнопка устарела. Откройте меню заново: /start", show_alert=True)
+            return
+        
+        _, handler, wants_state, once = self.routes[prefix]
+        kwargs = {}
+        if callback_data is not None:
+            kwargs['callback_data'] = callback_data
+        if wants_state:
+            kwargs['state'] = state
+        
+        # Замер по настоящему хэндлеру, а не по общей точке входа
+        name = handler.__name__
+        started = perf_counter()
+        try:
+            if once is None:
+                return await handler(callback, **kwargs)
+            key = (callback.from_user.id, prefix, once(callback, callback_data))
+            result, duplicate = await self.idempotency.run(key, partial(handler, callback, **kwargs))
+            if duplicate:
+                # Действие уже выполнено первым нажатием — только гасим «часики» на кнопке
+                metrics.inc('bot_callback_duplicates_total', name)
+                await callback.answer()
+            return result
+        except Exception:
+            metrics.inc('bot_handler_errors_total', name)
+            raise
+        finally:
+            metrics.observe('bot_handler_duration_seconds', name, perf_counter() - started)
+    
+    def stats(self) -> dict:
+        return {
+            'routes': len(self.routes),
+            'rejected': self.rejected,
+        }
+
+callbacks = CallbackRouter()
+
+@router.callback_query()
+async def dispatch_callback(callback: CallbackQuery, state: FSMContext):
+    """Единая точка входа для инлайн-кнопок"""
+    await callbacks.dispatch(callback, state)
 
 # ================================
 # 🎯 ОБРАБОТЧИКИ КОМАНД
@@ -627,7 +3520,7 @@ async def cmd_start(message: Message, state: FSMContext):
 async def start_booking(message: Message, state: FSMContext):
     """Начало записи"""
     # Проверяем, есть ли уже информация о клиенте
-    client_info = db.get_client_info(message.from_user.id)
+    client_info = await db.get_client_info(message.from_user.id)
     
     if client_info:
         # Клиент уже есть в базе, сразу к выбору услуги
@@ -696,7 +3589,7 @@ async def process_phone(message: Message, state: FSMContext):
     
     # Сохраняем клиента
     data = await state.get_data()
-    db.add_client(
+    await db.add_client(
         user_id=message.from_user.id,
         username=message.from_user.username or "",
         full_name=data['full_name'],
@@ -712,10 +3605,19 @@ async def process_phone(message: Message, state: FSMContext):
         reply_markup=get_services_keyboard()
     )
 
-@router.callback_query(F.data.startswith("service_"))
-async def process_service(callback: CallbackQuery, state: FSMContext):
+async def get_booking_calendar(state: FSMContext, month: int = None, year: int = None) -> InlineKeyboardMarkup:
+    """Календарь с отметками занятых дней для выбранной услуги"""
+    data = await state.get_data()
+    if not (month and year):
+        now = datetime.now()
+        month, year = now.month, now.year
+    availability = await db.get_month_availability(year, month, data.get('duration', DEFAULT_DURATION))
+    return get_calendar_keyboard(month, year, availability)
+
+@callbacks.route(ServiceCallback)
+async def process_service(callback: CallbackQuery, callback_data: ServiceCallback, state: FSMContext):
     """Обработка выбора услуги"""
-    service_key = callback.data.split("_")[1]
+    service_key = callback_data.key
     service = SERVICES[service_key]
     
     await state.update_data(
@@ -732,16 +3634,17 @@ async def process_service(callback: CallbackQuery, state: FSMContext):
         f"📝 {service['description']}\n"
         f"⏱ Продолжительность: {service['duration']} минут\n"
         f"💰 Стоимость: <b>{service['price']}₽</b>\n\n"
-        f"📅 <b>Выберите удобную дату:</b>",
+        f"📅 <b>Выберите удобную дату:</b>\n"
+        f"<i>• — часть времени занята, 🚫 — мест нет (нажмите, чтобы встать в лист ожидания)</i>",
         parse_mode="HTML",
-        reply_markup=get_calendar_keyboard()
+        reply_markup=await get_booking_calendar(state)
     )
     await callback.answer()
 
-@router.callback_query(F.data.startswith("info_"))
-async def show_service_info(callback: CallbackQuery):
+@callbacks.route(ServiceInfoCallback)
+async def show_service_info(callback: CallbackQuery, callback_data: ServiceInfoCallback):
     """Показ информации об услуге"""
-    service_key = callback.data.split("_")[1]
+    service_key = callback_data.key
     service = SERVICES[service_key]
     
     await callback.answer(
@@ -750,28 +3653,48 @@ async def show_service_info(callback: CallbackQuery):
         show_alert=True
     )
 
-@router.callback_query(F.data.startswith("month_"))
-async def change_month(callback: CallbackQuery, state: FSMContext):
+@callbacks.route(MonthCallback)
+async def change_month(callback: CallbackQuery, callback_data: MonthCallback, state: FSMContext):
     """Навигация по месяцам"""
-    _, year, month = callback.data.split("_")
-    
     try:
         await callback.message.edit_reply_markup(
-            reply_markup=get_calendar_keyboard(int(month), int(year))
+            reply_markup=await get_booking_calendar(state, callback_data.month, callback_data.year)
         )
     except TelegramBadRequest:
         pass
     await callback.answer()
 
-@router.callback_query(F.data.startswith("date_"))
-async def process_date(callback: CallbackQuery, state: FSMContext):
+@callbacks.route(WaitDayCallback)
+async def join_day_waitlist(callback: CallbackQuery, callback_data: WaitDayCallback, state: FSMContext):
+    """Нажатие на полностью занятый день — лист ожидания на любое время"""
+    data = await state.get_data()
+    date = unpack_date(callback_data.day)
+    if 'service_key' not in data or date < datetime.now().strftime("%Y-%m-%d"):
+        await callback.answer("Эта кнопка устарела. Откройте меню заново: /start", show_alert=True)
+        return
+    
+    date_obj = datetime.strptime(date, "%Y-%m-%d")
+    formatted_date = f"{date_obj.day} {MONTHS_RU[date_obj.month]}"
+    if await waitlist.join(callback.from_user.id, data['service_key'], date):
+        await callback.answer(
+            f"😔 На {formatted_date} всё время занято.\n\n"
+            f"🔔 Вы в листе ожидания: если время освободится, я сразу напишу.",
+            show_alert=True
+        )
+    else:
+        await callback.answer(f"🔔 Вы уже в листе ожидания на {formatted_date}.", show_alert=True)
+
+@callbacks.route(DateCallback)
+async def process_date(callback: CallbackQuery, callback_data: DateCallback, state: FSMContext):
     """Обработка выбора даты"""
-    date = callback.data.split("_")[1]
+    date = unpack_date(callback_data.day)
     await state.update_data(date=date)
     await state.set_state(BookingStates.choosing_time)
     
     # Получаем занятые времена
-    booked_times = db.get_appointments_by_date(date)
+    data = await state.get_data()
+    duration = data.get('duration', DEFAULT_DURATION)
+    blocked_mask = await db.get_blocked_mask(date, duration)
     
     date_obj = datetime.strptime(date, "%Y-%m-%d")
     formatted_date = f"{date_obj.day} {MONTHS_RU[date_obj.month]} {date_obj.year}"
@@ -781,20 +3704,39 @@ async def process_date(callback: CallbackQuery, state: FSMContext):
         f"📅 <b>Дата:</b> {formatted_date} ({weekday})\n\n"
         f"🕐 <b>Выберите удобное время:</b>\n\n"
         f"🟢 - свободно\n"
-        f"🚫 - занято",
+        f"🚫 - занято (нажмите, чтобы встать в лист ожидания)\n"
+        f"⛔ - услуга не успеет закончиться до закрытия",
         parse_mode="HTML",
-        reply_markup=get_time_keyboard(date, booked_times)
+        reply_markup=get_time_keyboard(date, blocked_mask, duration)
     )
     await callback.answer()
 
-@router.callback_query(F.data.startswith("time_"))
-async def process_time(callback: CallbackQuery, state: FSMContext):
-    """Обработка выбора времени"""
-    if callback.data == "time_unavailable":
-        await callback.answer("⚠️ Это время уже занято. Выберите другое.", show_alert=True)
+@callbacks.route(WaitSlotCallback)
+async def join_slot_waitlist(callback: CallbackQuery, callback_data: WaitSlotCallback, state: FSMContext):
+    """Нажатие на занятое время — лист ожидания на этот слот"""
+    data = await state.get_data()
+    if 'service_key' not in data or 'date' not in data:
+        await callback.answer("Эта кнопка устарела. Откройте меню заново: /start", show_alert=True)
         return
     
-    time = callback.data.split("_")[1]
+    time = unpack_time(callback_data.minutes)
+    # Старт, который не освободится никогда (не из сетки или упирается в закрытие), не ждём
+    if time not in WORKING_HOURS or closing_mask(service_duration(data['service_key'])) & (1 << WORKING_HOURS.index(time)):
+        await callback.answer(f"⛔ В {time} эта услуга не успеет закончиться до закрытия.", show_alert=True)
+        return
+    if await waitlist.join(callback.from_user.id, data['service_key'], data['date'], time):
+        await callback.answer(
+            f"⚠️ {time} уже занято.\n\n"
+            f"🔔 Вы в листе ожидания: если время освободится, я сразу напишу.",
+            show_alert=True
+        )
+    else:
+        await callback.answer(f"🔔 Вы уже в листе ожидания на {time}.", show_alert=True)
+
+@callbacks.route(TimeCallback)
+async def process_time(callback: CallbackQuery, callback_data: TimeCallback, state: FSMContext):
+    """Обработка выбора времени"""
+    time = unpack_time(callback_data.minutes)
     await state.update_data(time=time)
     await state.set_state(BookingStates.confirming)
     
@@ -839,14 +3781,22 @@ async def process_time(callback: CallbackQuery, state: FSMContext):
     )
     await callback.answer()
 
-@router.callback_query(F.data == "confirm_yes")
+# Цель — сообщение с кнопками: один экран подтверждения — одна запись
+@callbacks.route(CB_CONFIRM, once=lambda callback, _: callback.message.message_id if callback.message else None)
 async def confirm_booking(callback: CallbackQuery, state: FSMContext):
     """Подтверждение записи"""
     data = await state.get_data()
     
-    # Проверяем, не занято ли время (двойная проверка)
-    booked_times = db.get_appointments_by_date(data['date'])
-    if data['time'] in booked_times:
+    # Бронируем слот атомарно: проверка и вставка одной операцией
+    appointment_id = await db.reserve_appointment(
+        user_id=callback.from_user.id,
+        service=data['service'],
+        service_key=data['service_key'],
+        date=data['date'],
+        time=data['time'],
+        price=data['price']
+    )
+    if appointment_id is None:
         await callback.message.edit_text(
             "❌ <b>К сожалению, это время только что заняли.</b>\n\n"
             "Пожалуйста, выберите другое время.",
@@ -856,16 +3806,6 @@ async def confirm_booking(callback: CallbackQuery, state: FSMContext):
         await state.set_state(BookingStates.choosing_time)
         return
     
-    # Сохраняем запись
-    appointment_id = db.add_appointment(
-        user_id=callback.from_user.id,
-        service=data['service'],
-        service_key=data['service_key'],
-        date=data['date'],
-        time=data['time'],
-        price=data['price']
-    )
-    
     date_obj = datetime.strptime(data['date'], "%Y-%m-%d")
     formatted_date = f"{date_obj.day} {MONTHS_RU[date_obj.month]} {date_obj.year}"
     
@@ -910,12 +3850,13 @@ async def confirm_booking(callback: CallbackQuery, state: FSMContext):
     )
     
     # Отправляем уведомление админу
-    await notify_admin_new_booking(appointment_id)
+    notify_admin_new_booking(appointment_id)
+    reminders.schedule(appointment_id, data['date'], data['time'])
     
     await state.clear()
     await callback.answer("✅ Запись создана!", show_alert=True)
 
-@router.callback_query(F.data == "confirm_no")
+@callbacks.route(CB_DECLINE)
 async def cancel_booking_process(callback: CallbackQuery, state: FSMContext):
     """Отмена процесса записи"""
     await state.clear()
@@ -937,7 +3878,7 @@ async def cancel_booking_process(callback: CallbackQuery, state: FSMContext):
 @router.message(F.text == "📋 Мои записи")
 async def my_appointments(message: Message):
     """Показать записи пользователя"""
-    appointments = db.get_user_appointments(message.from_user.id)
+    appointments = await db.get_user_appointments(message.from_user.id)
     
     if not appointments:
         await message.answer(
@@ -980,13 +3921,13 @@ async def my_appointments(message: Message):
         reply_markup=get_my_appointments_keyboard(appointments)
     )
 
-@router.callback_query(F.data.startswith("cancel_"))
-async def cancel_appointment(callback: CallbackQuery):
+@callbacks.route(CancelCallback, once=lambda _, callback_data: callback_data.appointment_id)
+async def cancel_appointment(callback: CallbackQuery, callback_data: CancelCallback):
     """Отмена записи клиентом"""
-    appointment_id = int(callback.data.split("_")[1])
+    appointment_id = callback_data.appointment_id
     
     # Получаем детали записи перед отменой
-    details = db.get_appointment_details(appointment_id)
+    details = await db.get_appointment_details(appointment_id)
     if not details:
         await callback.answer("❌ Запись не найдена", show_alert=True)
         return
@@ -998,8 +3939,11 @@ async def cancel_appointment(callback: CallbackQuery):
         await callback.answer("❌ Это не ваша запись", show_alert=True)
         return
     
-    # Отменяем запись
-    db.cancel_appointment(appointment_id)
+    # Отменяем запись и предлагаем слот листу ожидания
+    freed = await db.cancel_appointment(appointment_id)
+    reminders.discard(appointment_id)
+    if freed:
+        waitlist.release(*freed)
     
     date_obj = datetime.strptime(date, "%Y-%m-%d")
     formatted_date = f"{date_obj.day} {MONTHS_RU[date_obj.month]}"
@@ -1014,10 +3958,50 @@ async def cancel_appointment(callback: CallbackQuery):
     )
     
     # Уведомляем админа
-    await notify_admin_cancellation(appointment_id, cancelled_by_user=True)
+    notify_admin_cancellation(appointment_id, cancelled_by_user=True)
     
     await callback.answer("Запись отменена", show_alert=True)
 
+@callbacks.route(WaitClaimCallback, once=lambda _, callback_data: callback_data.entry_id)
+async def claim_waitlist_slot(callback: CallbackQuery, callback_data: WaitClaimCallback):
+    """Запись на слот, предложенный из листа ожидания"""
+    claimed = await waitlist.claim(callback_data.entry_id, callback.from_user.id)
+    if claimed is None:
+        await callback.message.edit_text(
+            "⌛ <b>Время удержания истекло</b>\n\n"
+            "Слот уже предложен другим. Выберите другое время через меню.",
+            parse_mode="HTML"
+        )
+        await callback.answer()
+        return
+    
+    appointment_id, date, time, service_key = claimed
+    service = SERVICES[service_key]
+    date_obj = datetime.strptime(date, "%Y-%m-%d")
+    formatted_date = f"{date_obj.day} {MONTHS_RU[date_obj.month]} {date_obj.year}"
+    
+    await callback.message.edit_text(
+        f"🎉 <b>ЗАПИСЬ УСПЕШНО СОЗДАНА!</b>\n\n"
+        f"{service['name']}\n"
+        f"📅 {formatted_date}\n"
+        f"🕐 {time}\n"
+        f"💰 {service['price']}₽\n\n"
+        f"📍 {SALON_ADDRESS}\n"
+        f"• ID вашей записи: #{appointment_id}",
+        parse_mode="HTML"
+    )
+    
+    notify_admin_new_booking(appointment_id)
+    reminders.schedule(appointment_id, date, time)
+    await callback.answer("✅ Запись создана!", show_alert=True)
+
+@callbacks.route(WaitDeclineCallback, once=lambda _, callback_data: callback_data.entry_id)
+async def decline_waitlist_slot(callback: CallbackQuery, callback_data: WaitDeclineCallback):
+    """Отказ от слота из листа ожидания"""
+    await waitlist.decline(callback_data.entry_id, callback.from_user.id)
+    await callback.message.edit_text("Хорошо! Предложу это время кому-нибудь ещё. 💕")
+    await callback.answer()
+
 @router.message(F.text == "ℹ️ О мастере")
 async def about_master(message: Message):
     """Информация о мастере"""
@@ -1127,7 +4111,7 @@ async def admin_panel(message: Message):
         await message.answer("⛔️ У вас нет доступа")
         return
     
-    stats = db.get_stats()
+    stats = await db.get_stats()
     
     admin_text = f"""
 👑 <b>ПАНЕЛЬ УПРАВЛЕНИЯ</b> 👑
@@ -1147,8 +4131,11 @@ async def admin_panel(message: Message):
 /today - Записи на сегодня
 /week - Записи на неделю
 /all - Все активные записи
-/history - История записей
+/history [с] [по] - Архив записей (даты ДД.ММ.ГГГГ)
 /stats - Подробная статистика
+/rebuild_stats - Сверка и пересчёт статистики и индекса слотов
+/query_plans - Проверка индексов запросов
+/loop_monitor [on|off] - Задержка event loop
     """
     
     await message.answer(admin_text, parse_mode="HTML")
@@ -1161,17 +4148,7 @@ async def show_today_appointments(message: Message):
     
     today = datetime.now().strftime("%Y-%m-%d")
     
-    conn = sqlite3.connect(db.db_file)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT a.id, c.full_name, c.phone, a.service, a.time, a.price
-        FROM appointments a
-        JOIN clients c ON a.user_id = c.user_id
-        WHERE a.date = ? AND a.status = 'pending'
-        ORDER BY a.time
-    """, (today,))
-    appointments = cursor.fetchall()
-    conn.close()
+    appointments = await db.get_day_appointments(today)
     
     if not appointments:
         await message.answer("📅 На сегодня записей нет")
@@ -1207,17 +4184,7 @@ async def show_week_appointments(message: Message):
     week_end = (today + timedelta(days=7)).strftime("%Y-%m-%d")
     today_str = today.strftime("%Y-%m-%d")
     
-    conn = sqlite3.connect(db.db_file)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT a.date, a.time, c.full_name, c.phone, a.service, a.price
-        FROM appointments a
-        JOIN clients c ON a.user_id = c.user_id
-        WHERE a.date BETWEEN ? AND ? AND a.status = 'pending'
-        ORDER BY a.date, a.time
-    """, (today_str, week_end))
-    appointments = cursor.fetchall()
-    conn.close()
+    appointments = await db.get_period_appointments(today_str, week_end)
     
     if not appointments:
         await message.answer("📅 На ближайшую неделю записей нет")
@@ -1249,43 +4216,133 @@ async def show_week_appointments(message: Message):
     
     await message.answer(text, parse_mode="HTML")
 
+def trim_page(rows: List[tuple], backward: bool) -> tuple:
+    """Отрезает лишнюю строку-признак следующей страницы: (rows, has_more)"""
+    if len(rows) <= ADMIN_PAGE_SIZE:
+        return rows, False
+    return (rows[1:] if backward else rows[:-1]), True
+
+async def render_appointments_page(cursor: Optional[tuple] = None, backward: bool = False):
+    """Текст и клавиатура страницы активных записей"""
+    rows, has_more = trim_page(await db.get_appointments_page(cursor, backward), backward)
+    if not rows:
+        return None, None
+    
+    count, revenue = await db.get_pending_totals()
+    text = f"📋 <b>ВСЕ АКТИВНЫЕ ЗАПИСИ</b> ({count} на {revenue}₽)\n\n"
+    
+    for apt_id, name, phone, service, date, time, price in rows:
+        date_obj = datetime.strptime(date, "%Y-%m-%d")
+        formatted_date = f"{date_obj.day}.{date_obj.month}.{date_obj.year}"
+        
+        text += (
+            f"<b>#{apt_id}</b> | {formatted_date} {time}\n"
+            f"👤 {name} | 📱 {phone}\n"
+            f"💅 {service} | 💰 {price}₽\n"
+            f"━━━━━━━━━━━━━━━━\n\n"
+        )
+    
+    return text, get_admin_page_keyboard(PageCallback, rows, cursor, backward, has_more)
+
 @router.message(Command("all"))
 async def show_all_appointments(message: Message):
-    """Все активные записи (только для админа)"""
+    """Активные записи постранично (только для админа)"""
     if message.from_user.id not in ADMIN_IDS:
         return
     
-    appointments = db.get_all_appointments(status='pending')
-    
-    if not appointments:
+    text, keyboard = await render_appointments_page()
+    if text is None:
         await message.answer("📋 Активных записей нет")
         return
     
-    text = "📋 <b>ВСЕ АКТИВНЫЕ ЗАПИСИ:</b>\n\n"
+    await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
+
+@callbacks.route(PageCallback)
+async def page_all_appointments(callback: CallbackQuery, callback_data: PageCallback):
+    """Листание /all"""
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer()
+        return
     
-    total = 0
-    for apt in appointments:
-        apt_id, name, phone, username, service, date, time, price, status = apt
-        
+    cursor = unpack_date(callback_data.day), unpack_time(callback_data.minutes), callback_data.appointment_id
+    text, keyboard = await render_appointments_page(cursor, backward=callback_data.backward)
+    if text is None:
+        await callback.answer("Записей больше нет", show_alert=True)
+        return
+    
+    try:
+        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+    except TelegramBadRequest:
+        pass
+    await callback.answer()
+
+HISTORY_STATUSES = {'pending': '✅', 'cancelled': '❌'}
+
+async def render_history_page(date_from: str, date_to: str, cursor: Optional[tuple] = None,
+                              backward: bool = False):
+    """Текст и клавиатура страницы архива"""
+    rows, has_more = trim_page(await db.get_history_page(date_from, date_to, cursor, backward), backward)
+    if not rows:
+        return None, None
+    
+    text = "🗃 <b>ИСТОРИЯ ЗАПИСЕЙ</b>\n\n"
+    for apt_id, name, phone, service, date, time, price, status in rows:
         date_obj = datetime.strptime(date, "%Y-%m-%d")
         formatted_date = f"{date_obj.day}.{date_obj.month}.{date_obj.year}"
         
         text += (
-            f"<b>#{apt_id}</b> | {formatted_date} {time}\n"
-            f"👤 {name} | 📱 {phone}\n"
+            f"{HISTORY_STATUSES.get(status, '•')} <b>#{apt_id}</b> | {formatted_date} {time}\n"
+            f"👤 {name or 'Неизвестно'} | 📱 {phone or '—'}\n"
             f"💅 {service} | 💰 {price}₽\n"
             f"━━━━━━━━━━━━━━━━\n\n"
         )
-        total += price
-        
-        # Разбиваем на части если слишком длинное
-        if len(text) > 3500:
-            await message.answer(text, parse_mode="HTML")
-            text = ""
     
-    if text:
-        text += f"💵 <b>Общая сумма:</b> {total}₽"
-        await message.answer(text, parse_mode="HTML")
+    page = partial(HistoryPageCallback, date_from=pack_date(date_from), date_to=pack_date(date_to))
+    return text, get_admin_page_keyboard(page, rows, cursor, backward, has_more)
+
+@router.message(Command("history"))
+async def show_history(message: Message, command: CommandObject):
+    """Архив записей за период, от новых к старым (только для админа)"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    # /history [с ДД.ММ.ГГГГ] [по ДД.ММ.ГГГГ]
+    bounds = ['0001-01-01', '9999-12-31']
+    try:
+        for i, arg in enumerate((command.args or "").split()[:2]):
+            bounds[i] = datetime.strptime(arg, "%d.%m.%Y").strftime("%Y-%m-%d")
+    except ValueError:
+        await message.answer("Формат: /history [ДД.ММ.ГГГГ] [ДД.ММ.ГГГГ]")
+        return
+    
+    text, keyboard = await render_history_page(*bounds)
+    if text is None:
+        await message.answer(f"🗃 В архиве нет записей за этот период (в архив попадают записи старше {ARCHIVE_AFTER_DAYS} дней)")
+        return
+    
+    await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
+
+@callbacks.route(HistoryPageCallback)
+async def page_history(callback: CallbackQuery, callback_data: HistoryPageCallback):
+    """Листание /history"""
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer()
+        return
+    
+    cursor = unpack_date(callback_data.day), unpack_time(callback_data.minutes), callback_data.appointment_id
+    text, keyboard = await render_history_page(
+        unpack_date(callback_data.date_from), unpack_date(callback_data.date_to),
+        cursor, backward=callback_data.backward
+    )
+    if text is None:
+        await callback.answer("Записей больше нет", show_alert=True)
+        return
+    
+    try:
+        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+    except TelegramBadRequest:
+        pass
+    await callback.answer()
 
 @router.message(Command("stats"))
 async def detailed_stats(message: Message):
@@ -1293,42 +4350,13 @@ async def detailed_stats(message: Message):
     if message.from_user.id not in ADMIN_IDS:
         return
     
-    conn = sqlite3.connect(db.db_file)
-    cursor = conn.cursor()
-    
     # Статистика по услугам
-    cursor.execute("""
-        SELECT service_key, COUNT(*), SUM(price)
-        FROM appointments
-        WHERE status = 'pending' AND date >= date('now')
-        GROUP BY service_key
-    """)
-    services_stats = cursor.fetchall()
+    services_stats = await db.get_services_stats()
     
     # Популярные дни недели
-    cursor.execute("""
-        SELECT 
-            CASE CAST(strftime('%w', date) AS INTEGER)
-                WHEN 0 THEN 'Воскресенье'
-                WHEN 1 THEN 'Понедельник'
-                WHEN 2 THEN 'Вторник'
-                WHEN 3 THEN 'Среда'
-                WHEN 4 THEN 'Четверг'
-                WHEN 5 THEN 'Пятница'
-                WHEN 6 THEN 'Суббота'
-            END as day,
-            COUNT(*)
-        FROM appointments
-        WHERE status = 'pending'
-        GROUP BY strftime('%w', date)
-        ORDER BY COUNT(*) DESC
-        LIMIT 3
-    """)
-    popular_days = cursor.fetchall()
+    popular_days = await db.get_popular_days()
     
-    conn.close()
-    
-    stats = db.get_stats()
+    stats = await db.get_stats()
     
     text = f"""
 📊 <b>ПОДРОБНАЯ СТАТИСТИКА</b>
@@ -1361,8 +4389,78 @@ async def detailed_stats(message: Message):
     
     await message.answer(text, parse_mode="HTML")
 
+@router.message(Command("rebuild_stats"))
+async def rebuild_stats(message: Message):
+    """Сверка и пересчёт материализованной статистики и индекса слотов (только для админа)"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    problems = await db.check_stats()
+    await db.rebuild_stats()
+    slot_problems = await db.verify_slot_index()
+    if slot_problems:
+        logger.error(f"❌ Индекс слотов расходится с базой: {', '.join(slot_problems)}")
+        await db.warm_slot_index()
+    
+    if not problems and not slot_problems:
+        await message.answer("✅ Статистика и индекс слотов сходятся с записями, статистика пересчитана заново")
+        return
+    
+    text = ""
+    if problems:
+        text += f"⚠️ <b>Расхождений в статистике: {len(problems)}</b>\n\n"
+        text += "\n".join(problems[:20])
+        text += "\n\n✅ Статистика пересчитана\n\n"
+    if slot_problems:
+        text += f"⚠️ <b>Индекс слотов расходится с базой по датам: {len(slot_problems)}</b>\n\n"
+        text += "\n".join(slot_problems[:20])
+        text += "\n\n✅ Индекс загружен из базы заново"
+    await message.answer(text.strip(), parse_mode="HTML")
+
+@router.message(Command("query_plans"))
+async def query_plans(message: Message):
+    """Проверка планов горячих запросов (только для админа)"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    problems = await db.check_query_plans()
+    if not problems:
+        await message.answer(f"✅ Все горячие запросы ({len(HOT_QUERIES)}) идут по индексам")
+        return
+    
+    text = f"⚠️ <b>Полный просмотр в запросах: {len(problems)}</b>\n\n"
+    text += "\n".join(problems)
+    await message.answer(text, parse_mode="HTML")
+
+@router.message(Command("loop_monitor"))
+async def loop_monitor_command(message: Message, command: CommandObject):
+    """Задержка event loop; /loop_monitor on|off — включить или выключить (только для админа)"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    if command.args == "on":
+        loop_monitor.start()
+    elif command.args == "off":
+        loop_monitor.stop()
+    
+    if not loop_monitor.enabled:
+        await message.answer("🩺 Мониторинг event loop выключен\n\nВключить: /loop_monitor on")
+        return
+    
+    lag = loop_monitor.percentiles()
+    await message.answer(
+        f"🩺 <b>Задержка event loop</b>\n\n"
+        f"p50: {lag['p50'] * 1000:.1f} мс\n"
+        f"p95: {lag['p95'] * 1000:.1f} мс\n"
+        f"p99: {lag['p99'] * 1000:.1f} мс\n"
+        f"Максимум: {loop_monitor.max_lag * 1000:.1f} мс\n"
+        f"Блокировок дольше {LOOP_BLOCK_THRESHOLD * 1000:.0f} мс: {loop_monitor.blocks}\n\n"
+        f"Выключить: /loop_monitor off",
+        parse_mode="HTML"
+    )
+
 # Обработка кнопок "Назад"
-@router.callback_query(F.data == "back_to_menu")
+@callbacks.route(CB_MENU)
 async def back_to_menu(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.message.delete()
@@ -1373,7 +4471,7 @@ async def back_to_menu(callback: CallbackQuery, state: FSMContext):
     )
     await callback.answer()
 
-@router.callback_query(F.data == "back_to_services")
+@callbacks.route(CB_SERVICES)
 async def back_to_services(callback: CallbackQuery, state: FSMContext):
     await state.set_state(BookingStates.choosing_service)
     await callback.message.edit_text(
@@ -1383,7 +4481,7 @@ async def back_to_services(callback: CallbackQuery, state: FSMContext):
     )
     await callback.answer()
 
-@router.callback_query(F.data == "back_to_date")
+@callbacks.route(CB_DATES)
 async def back_to_date(callback: CallbackQuery, state: FSMContext):
     await state.set_state(BookingStates.choosing_date)
     data = await state.get_data()
@@ -1391,13 +4489,14 @@ async def back_to_date(callback: CallbackQuery, state: FSMContext):
     
     await callback.message.edit_text(
         f"{service['emoji']} <b>Вы выбрали:</b> {service['name'].replace(service['emoji'] + ' ', '')}\n\n"
-        f"📅 <b>Выберите удобную дату:</b>",
+        f"📅 <b>Выберите удобную дату:</b>\n"
+        f"<i>• — часть времени занята, 🚫 — мест нет (нажмите, чтобы встать в лист ожидания)</i>",
         parse_mode="HTML",
-        reply_markup=get_calendar_keyboard()
+        reply_markup=await get_booking_calendar(state)
     )
     await callback.answer()
 
-@router.callback_query(F.data == "ignore")
+@callbacks.route(CB_NOOP)
 async def ignore_callback(callback: CallbackQuery):
     await callback.answer()
 
@@ -1414,27 +4513,85 @@ async def run_bot():
     logger.info(f"💅 Мастер: {MASTER_NAME}")
     logger.info(f"📍 Адрес: {SALON_ADDRESS}")
     logger.info(f"👑 Админов: {len(ADMIN_IDS)}")
+    logger.info(f"🗓 Индекс слотов: {db.sync.slots.stats()['days']} дней")
     logger.info("=" * 50)
     
+    for problem in await db.check_query_plans():
+        logger.warning(f"⚠️ Запрос без индекса: {problem}")
+    
     try:
-        await dp.start_polling(bot, skip_updates=True)
+        if WEBHOOK_URL:
+            # Обновления принимает веб-сервер, здесь только регистрируем адрес
+            await bot.set_webhook(
+                f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=MAX_CONCURRENT_UPDATES,
+                drop_pending_updates=True
+            )
+            logger.info(f"🔗 Webhook: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+            await asyncio.Event().wait()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            logger.info("🔄 WEBHOOK_URL не задан, работаем через polling")
+            await dp.start_polling(bot, skip_updates=True)
     except Exception as e:
         logger.error(f"❌ Ошибка: {e}")
 
-# Простой веб-сервер для Render (чтобы не было timeout)
-async def run_web_server():
-    """Запуск фейкового веб-сервера для Render"""
+def create_web_app():
+    """Веб-приложение: health-check и (в режиме webhook) приём обновлений Telegram"""
     from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler
     
     async def health(request):
-        return web.Response(text="Bot is running! 🤖")
+        text = "Bot is running! 🤖"
+        if loop_monitor.enabled:
+            lag = loop_monitor.percentiles()
+            text += (
+                f"\nloop lag, ms: p50={lag['p50'] * 1000:.1f} p95={lag['p95'] * 1000:.1f} "
+                f"p99={lag['p99'] * 1000:.1f} max={loop_monitor.max_lag * 1000:.1f} blocks={loop_monitor.blocks}"
+            )
+        return web.Response(text=text)
+    
+    async def metrics_endpoint(request):
+        text = metrics.render({
+            'keyboards': keyboard_cache_stats(),
+            'slot_index': db.sync.slots.stats(),
+            'outbound': outbound.stats(),
+            'notifier': notifier.stats(),
+            'fsm_storage': storage.stats(),
+            'reminders': reminders.stats(),
+            'archiver': archiver.stats(),
+            'waitlist': waitlist.stats(),
+            'loop': loop_monitor.stats(),
+            'callbacks': callbacks.stats(),
+            'idempotency': callbacks.idempotency.stats(),
+            'clients': db.clients.stats(),
+            'throttle': throttle.stats(),
+        })
+        return web.Response(text=text, content_type='text/plain', charset='utf-8')
     
     app = web.Application()
     app.router.add_get('/', health)
     app.router.add_get('/health', health)
+    app.router.add_get('/metrics', metrics_endpoint)
+    
+    if WEBHOOK_URL:
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET
+        ).register(app, path=WEBHOOK_PATH)
+    
+    return app
+
+# Веб-сервер для Render: health-check и webhook на одном порту
+async def run_web_server():
+    """Запуск веб-сервера"""
+    from aiohttp import web
     
     port = int(os.getenv('PORT', 10000))
-    runner = web.AppRunner(app)
+    runner = web.AppRunner(create_web_app())
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', port)
     
@@ -1443,10 +4600,24 @@ async def run_web_server():
 
 async def main():
     """Главная функция - запускает бота и веб-сервер"""
-    await asyncio.gather(
-        run_bot(),
-        run_web_server()
-    )
+    reminders.start()
+    archiver.start()
+    waitlist.start()
+    if LOOP_MONITOR:
+        loop_monitor.start()
+    try:
+        await asyncio.gather(
+            run_bot(),
+            run_web_server()
+        )
+    finally:
+        await reminders.close()
+        await archiver.close()
+        await waitlist.close()
+        await loop_monitor.close()
+        await notifier.close()
+        await storage.close()
+        await db.close()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,571 @@
+"""
+Проверки поведения бота под нагрузкой и на краевых случаях.
+
+    python checks.py                      # все проверки
+    python checks.py confirm_storm        # выбранные, по именам
+
+Каждая проверка — сценарий на тех же заглушках, что и bench.py:
+апдейты идут через Dispatcher.feed_update, исходящие запросы пишет
+сессия без сети, база — отдельный засеянный файл во временном
+каталоге. Нарушение инварианта печатается с ❌, и скрипт завершается
+с кодом 1.
+"""
+
+import argparse
+import asyncio
+import random
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta
+from time import monotonic, perf_counter
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import bench
+import bot
+
+from aiogram import Bot, __version__ as aiogram_version
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.types import Update
+
+CONFIRM_USERS = 300     # Одновременных подтверждений одного слота
+CONFIRM_ID = 3 * 10 ** 9  # Пользователи шторма подтверждений
+SOAK_SESSIONS = 1_000_000  # Брошенных сессий в soak-тесте FSM
+SOAK_MAX_ENTRIES = 10_000
+SOAK_CHECKPOINTS = 10     # Замеров памяти за прогон
+API_GLOBAL_RATE = 50      # Лимиты фальшивого Bot API (ниже боевых, чтобы проверка шла секунды)
+API_CHAT_RATE = 10
+API_CHAT_BURST = 3
+PLAN_SEED = 100_000       # Записей в базе для проверки планов запросов
+CACHE_ROUNDS = 500        # Раундов чтений вперемешку с add_client
+CACHE_ID = 4 * 10 ** 9    # Пользователи проверки кэша профилей
+DUPLICATE_TAPS = 50       # Одновременных нажатий одной кнопки
+DUPLICATE_ID = 5 * 10 ** 9
+REMINDER_ID = 6 * 10 ** 9  # Клиент проверки напоминаний
+SLOT_OPERATIONS = 400     # Одновременных броней и отмен в проверке индекса слотов
+SLOT_DAYS = 5
+SLOT_ID = 7 * 10 ** 9     # Клиент проверки индекса слотов
+
+CHECKS: Dict[str, Callable[[], Awaitable[str]]] = {}
+
+
+def check(func: Callable[[], Awaitable[str]]) -> Callable[[], Awaitable[str]]:
+    """Регистрация проверки; она возвращает сводку или падает с AssertionError"""
+    CHECKS[func.__name__] = func
+    return func
+
+
+def expect(condition: bool, message: str):
+    if not condition:
+        raise AssertionError(message)
+
+
+# ================================
+# 🧪 ОКРУЖЕНИЕ
+# ================================
+
+class RecordingSession(bench.StubSession):
+    """Заглушка сессии, которая запоминает (метод, chat_id, текст) каждого запроса"""
+
+    def __init__(self):
+        super().__init__()
+        self.requests: List[tuple] = []
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests.append((type(method).__name__, getattr(method, 'chat_id', None), getattr(method, 'text', None)))
+        return await super().make_request(bot, method, timeout)
+
+    def count(self, name: str, text: Optional[str] = None) -> int:
+        return sum(1 for method, _, body in self.requests
+                   if method == name and (text is None or (body and text in body)))
+
+
+class FakeBotAPI(bench.StubSession):
+    """
+    Bot API, который сам следит за лимитами: не больше global_rate
+    сообщений за любую секунду и не больше burst + rate × t сообщений
+    в чат за любое окно t. Превышение отвечается RetryAfter и считается
+    нарушением; flood_chats получают один RetryAfter на первое сообщение.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, flood_chats=(), flood_wait: int = 1):
+        super().__init__()
+        self._global_rate = global_rate
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._flood = dict.fromkeys(flood_chats, 0.0)
+        self._flood_wait = flood_wait
+        self._sent: List[float] = []
+        self._chats: Dict[int, List[float]] = defaultdict(list)
+        self.delivered: List[tuple] = []  # (chat_id, text) в порядке приёма
+        self.violations: List[str] = []
+
+    def _reject(self, method, reason: str):
+        self.violations.append(reason)
+        raise TelegramRetryAfter(method=method, message=f"Too Many Requests: {reason}", retry_after=1)
+
+    async def make_request(self, bot, method, timeout=None):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await super().make_request(bot, method, timeout)
+
+        now = monotonic()
+        if chat_id in self._flood:
+            if not self._flood[chat_id]:
+                self._flood[chat_id] = now + self._flood_wait
+                raise TelegramRetryAfter(method=method, message="Flood control", retry_after=self._flood_wait)
+            if now < self._flood[chat_id]:
+                self._reject(method, f"чат {chat_id}: запрос до конца flood wait")
+
+        # Допуск в одно сообщение — на дрожание таймеров event loop
+        if sum(1 for sent in self._sent if now - sent < 1) + 1 > self._global_rate + 1:
+            self._reject(method, "общий лимит")
+        history = self._chats[chat_id]
+        for i, sent in enumerate(history):
+            if len(history) - i + 1 > self._chat_burst + (now - sent) * self._chat_rate + 1:
+                self._reject(method, f"лимит чата {chat_id}")
+
+        self._sent.append(now)
+        history.append(now)
+        self.delivered.append((chat_id, getattr(method, 'text', None)))
+        return await super().make_request(bot, method, timeout)
+
+
+async def use_database(name: str, size: int = 1000) -> bot.Database:
+    """Свежая засеянная база вместо текущей bot.db"""
+    await bot.db.close()
+    database = bench.seed(f"{bench._TMP.name}/check_{name}.db", size)
+    bot.db = bot.AsyncDatabase(database)
+    return database
+
+
+def storage_key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=bot.bot.id, chat_id=user_id, user_id=user_id)
+
+
+def repeated_taps(user_id: int, data: str, count: int) -> List[Update]:
+    """count нажатий одной кнопки под одним сообщением — как при двойном тапе"""
+    first = bench.callback_update(user_id, data)
+    return [
+        first.model_copy(update={
+            'update_id': first.update_id + i,
+            'callback_query': first.callback_query.model_copy(update={'id': f"{first.callback_query.id}-{i}"}),
+        })
+        for i in range(count)
+    ]
+
+
+# ================================
+# ✅ ПРОВЕРКИ
+# ================================
+
+@check
+async def confirm_storm() -> str:
+    """
+    Сотни пользователей одновременно подтверждают один и тот же слот
+    разными услугами: запись создаётся ровно одна, total_visits растёт
+    только у победителя, остальным приходит «Время занято».
+    """
+    database = await use_database('confirm_storm')
+    day, slot = bench.far_day(0), bot.WORKING_HOURS[0]
+    users = range(CONFIRM_ID, CONFIRM_ID + CONFIRM_USERS)
+    keys = list(bot.SERVICES)
+    with database._writer as conn:
+        conn.executemany(
+            "INSERT INTO clients (user_id, username, full_name, phone) VALUES (?, 'check', 'Проверка', '+79000000000')",
+            ((user_id,) for user_id in users)
+        )
+    for user_id in users:
+        service_key = keys[user_id % len(keys)]
+        service = bot.SERVICES[service_key]
+        await bot.storage.set_state(storage_key(user_id), bot.BookingStates.confirming)
+        await bot.storage.set_data(storage_key(user_id), {
+            'full_name': 'Проверка', 'phone': '+79000000000', 'service': service['name'],
+            'service_key': service_key, 'price': service['price'], 'duration': service['duration'],
+            'date': day, 'time': slot,
+        })
+
+    session = bot.bot.session = RecordingSession()
+    bot.throttle.enabled = False
+    try:
+        started = perf_counter()
+        await asyncio.gather(*(
+            bot.dp.feed_update(bot.bot, bench.callback_update(user_id, bot.CB_CONFIRM)) for user_id in users
+        ))
+        elapsed = perf_counter() - started
+    finally:
+        bot.throttle.enabled = bot.THROTTLE
+
+    booked = database._reader().execute(
+        "SELECT COUNT(*) FROM appointments WHERE date = ? AND status = 'pending'", (day,)
+    ).fetchone()[0]
+    visits = database._reader().execute(
+        "SELECT COALESCE(SUM(total_visits), 0) FROM clients WHERE user_id BETWEEN ? AND ?",
+        (CONFIRM_ID, CONFIRM_ID + CONFIRM_USERS - 1)
+    ).fetchone()[0]
+    taken = session.count('AnswerCallbackQuery', 'Время занято')
+    expect(booked == 1, f"на один слот создано записей: {booked}")
+    expect(visits == 1, f"total_visits выросло на {visits}, а не на 1")
+    expect(taken == CONFIRM_USERS - 1, f"«Время занято» получили {taken} из {CONFIRM_USERS - 1}")
+    expect(not database.slots.fits(day, slot, bot.DEFAULT_DURATION), "индекс слотов не видит созданную запись")
+    return f"{CONFIRM_USERS} подтверждений за {elapsed:.2f} с: 1 запись, {taken} отказов"
+
+
+@check
+async def fsm_soak() -> str:
+    """
+    Миллион пользователей начинают запись и бросают её: BoundedMemoryStorage
+    держит не больше max_entries сессий, память после первого заполнения
+    не растёт, а простаивающие дольше TTL сессии снимаются.
+    """
+    storage = bot.BoundedMemoryStorage(ttl=3600, max_entries=SOAK_MAX_ENTRIES)
+    step = SOAK_SESSIONS // SOAK_CHECKPOINTS
+    memory = []
+    tracemalloc.start()
+    try:
+        for user_id in range(SOAK_SESSIONS):
+            key = storage_key(user_id)
+            await storage.set_state(key, bot.BookingStates.choosing_service)
+            await storage.set_data(key, {'full_name': f'Клиент {user_id}', 'phone': '+79000000000'})
+            if (user_id + 1) % step == 0:
+                memory.append(tracemalloc.get_traced_memory()[0])
+    finally:
+        tracemalloc.stop()
+
+    stats = storage.stats()
+    expect(stats['live'] == SOAK_MAX_ENTRIES, f"живых сессий {stats['live']}, ожидалось {SOAK_MAX_ENTRIES}")
+    expect(stats['evicted'] == SOAK_SESSIONS - SOAK_MAX_ENTRIES, f"вытеснено {stats['evicted']}")
+    # Первый замер — уже полный кэш; дальше память должна стоять на месте
+    expect(max(memory) <= memory[0] * 1.1,
+           f"память растёт: {memory[0] // 1024} -> {max(memory) // 1024} КиБ")
+    expect(await storage.get_state(storage_key(0)) is None, "вытесненная сессия всё ещё читается")
+
+    short = bot.BoundedMemoryStorage(ttl=0.1, max_entries=SOAK_MAX_ENTRIES)
+    for user_id in range(1000):
+        await short.set_state(storage_key(user_id), bot.BookingStates.choosing_service)
+    await asyncio.sleep(0.2)
+    await short.get_state(storage_key(0))
+    expect(short.stats() == {'live': 0, 'expired': 1000, 'evicted': 0}, f"после TTL: {short.stats()}")
+    return (f"{SOAK_SESSIONS} сессий: живых {stats['live']}, память "
+            f"{memory[0] // 1024} -> {memory[-1] // 1024} КиБ, TTL снял {short.expired}")
+
+
+@check
+async def outbound_limits() -> str:
+    """
+    Исходящие через OutboundScheduler в фальшивый Bot API с лимитами:
+    рассылка по сотне чатов, поток ответов в один чат и одновременные
+    ответы пользователям. Ни одного нарушения лимитов, RetryAfter
+    выдерживается и запрос повторяется, ответы обгоняют рассылку.
+    """
+    flooded = -1
+    api = FakeBotAPI(API_GLOBAL_RATE, API_CHAT_RATE, API_CHAT_BURST, flood_chats=[flooded])
+    scheduler = bot.OutboundScheduler(global_rate=API_GLOBAL_RATE, chat_rate=API_CHAT_RATE,
+                                      group_rate=API_CHAT_RATE, chat_burst=API_CHAT_BURST)
+    api.middleware(scheduler)
+    fake_bot = Bot(bench.os.environ['BOT_TOKEN'], session=api)
+
+    async def send(chat_id: int, text: str, priority: int, after: float = 0):
+        await asyncio.sleep(after)
+        bot.outbound_priority.set(priority)
+        await fake_bot.send_message(chat_id, text)
+
+    async def notify(chat_id: int, count: int):
+        for i in range(count):
+            await send(chat_id, f'flood {i}', bot.PRIORITY_NOTIFICATION)
+
+    bulk = [send(10_000 + i, 'bulk', bot.PRIORITY_BULK) for i in range(100)]
+    busy = [send(20_000, f'busy {i}', bot.PRIORITY_INTERACTIVE) for i in range(20)]
+    # Первое уведомление получает flood wait; и повтор, и сообщение
+    # из другой задачи, пришедшее во время паузы, должны её выдержать
+    flood = [notify(flooded, 2), send(flooded, 'flood late', bot.PRIORITY_INTERACTIVE, after=0.1)]
+    replies = [send(30_000 + i, 'reply', bot.PRIORITY_INTERACTIVE) for i in range(30)]
+    started = monotonic()
+    await asyncio.wait_for(asyncio.gather(*bulk, *busy, *flood, *replies), timeout=30)
+    elapsed = monotonic() - started
+
+    total = len(bulk) + len(busy) + 3 + len(replies)
+    expect(not api.violations, f"нарушения лимитов: {api.violations[:5]} (всего {len(api.violations)})")
+    expect(len(api.delivered) == total, f"доставлено {len(api.delivered)} из {total}")
+    expect(scheduler.retry_after == 1, f"RetryAfter получено {scheduler.retry_after}, ожидался 1")
+    expect([text for chat_id, text in api.delivered if chat_id == 20_000] == [f'busy {i}' for i in range(20)],
+           "сообщения в один чат ушли не по порядку")
+    last_reply = max(i for i, (_, text) in enumerate(api.delivered) if text == 'reply')
+    expect(last_reply < len(replies) + API_CHAT_BURST + 5,
+           f"последний ответ пользователю ушёл {last_reply + 1}-м: рассылка его обогнала")
+    expect(elapsed >= (total - 1) / API_GLOBAL_RATE, f"{total} сообщений ушли за {elapsed:.2f} с — быстрее лимита")
+    stats = scheduler.stats()['priorities']
+    return (f"{total} сообщений за {elapsed:.2f} с без нарушений; ожидание в очереди: ответы "
+            f"{stats['interactive']['wait_avg'] * 1000:.0f} мс, рассылка {stats['bulk']['wait_avg'] * 1000:.0f} мс")
+
+
+@check
+async def query_plans() -> str:
+    """
+    EXPLAIN QUERY PLAN каждого горячего запроса на засеянной базе
+    (после ANALYZE): ни один не должен скатываться в полный SCAN.
+    """
+    database = await use_database('query_plans', PLAN_SEED)
+    problems = database.check_query_plans()
+    expect(not problems, "полный просмотр таблицы:\n  " + "\n  ".join(problems))
+    return f"{len(bot.HOT_QUERIES)} запросов на {PLAN_SEED} записях без SCAN"
+
+
+@check
+async def client_cache() -> str:
+    """
+    Кэш профилей не отдаёт устаревшую строку после add_client: ни для
+    незарегистрированного пользователя (негативная запись), ни для
+    закэшированного профиля, ни когда чтения идут одновременно с
+    обновлением и новой записью. После каждого раунда профиль из кэша
+    сверяется с базой.
+    """
+    database = await use_database('client_cache')
+    bot.db.clients = bot.ClientCache(maxsize=CACHE_ROUNDS // 2, negative=True)
+    rng = random.Random(CACHE_ROUNDS)
+    service_key = next(iter(bot.SERVICES))
+    fetch = database.get_client_info
+
+    def slow_fetch(user_id: int):
+        # Медленный читатель: строка прочитана до записи, а вернётся после неё
+        row = fetch(user_id)
+        time.sleep(0.002)
+        return row
+
+    database.get_client_info = slow_fetch
+
+    async def read(user_id: int):
+        await asyncio.sleep(0)
+        return await bot.db.get_client_info(user_id)
+
+    stale = []
+    for i in range(CACHE_ROUNDS):
+        user_id = CACHE_ID + rng.randrange(CACHE_ROUNDS // 5)
+        # Профиль в кэше или нет: промахи идут в базу параллельно с записью
+        if rng.random() < 0.5:
+            await bot.db.get_client_info(user_id)
+        else:
+            bot.db.clients._items.pop(user_id, None)
+        # Чтения до, во время и после обновления — в случайном порядке
+        writes = [bot.db.add_client(user_id, f'user{i}', f'Клиент {i}', f'+7900{i:07d}')]
+        if rng.random() < 0.3:
+            writes.append(bot.db.reserve_appointment(
+                user_id, 'check', service_key, bench.far_day(i), bot.WORKING_HOURS[0], 0
+            ))
+        calls = writes + [read(user_id) for _ in range(rng.randrange(1, 6))]
+        rng.shuffle(calls)
+        await asyncio.gather(*calls)
+
+        cached = await bot.db.get_client_info(user_id)
+        actual = fetch(user_id)
+        if cached != actual:
+            stale.append(f"раунд {i}: в кэше {cached}, в базе {actual}")
+
+    stats = bot.db.clients.stats()
+    expect(not stale, f"устаревший профиль ({len(stale)}): {stale[:3]}")
+    expect(stats['hits'] > 0 and stats['negative_hits'] > 0, f"кэш не использовался: {stats}")
+    return (f"{CACHE_ROUNDS} раундов без устаревших строк; попаданий {stats['hits']}, "
+            f"негативных {stats['negative_hits']}, промахов {stats['misses']}")
+
+
+@check
+async def duplicate_taps() -> str:
+    """
+    Десятки одновременных нажатий «Подтвердить» и «Отменить» одного
+    пользователя: запись создаётся и отменяется по одному разу, сообщение
+    редактируется один раз, админ получает одно уведомление о каждом
+    событии, а остальные нажатия только гасят «часики».
+    """
+    database = await use_database('duplicate_taps')
+    user_id = DUPLICATE_ID
+    service_key = next(iter(bot.SERVICES))
+    service = bot.SERVICES[service_key]
+    await bot.db.add_client(user_id, 'check', 'Проверка', '+79000000000')
+    await bot.storage.set_state(storage_key(user_id), bot.BookingStates.confirming)
+    await bot.storage.set_data(storage_key(user_id), {
+        'full_name': 'Проверка', 'phone': '+79000000000', 'service': service['name'],
+        'service_key': service_key, 'price': service['price'], 'duration': service['duration'],
+        'date': bench.far_day(0), 'time': bot.WORKING_HOURS[0],
+    })
+    guard = bot.callbacks.idempotency
+    bot.throttle.enabled = False
+    try:
+        results = {}
+        for action in ('confirm', 'cancel'):
+            if action == 'confirm':
+                data = bot.CB_CONFIRM
+            else:
+                appointment_id = database._reader().execute(
+                    "SELECT id FROM appointments WHERE user_id = ? AND status = 'pending'", (user_id,)
+                ).fetchone()[0]
+                data = bot.CancelCallback(appointment_id=appointment_id).pack()
+
+            session = bot.bot.session = RecordingSession()
+            executed, duplicates = guard.executed, guard.duplicates
+            await asyncio.gather(*(
+                bot.dp.feed_update(bot.bot, update) for update in repeated_taps(user_id, data, DUPLICATE_TAPS)
+            ))
+            await bot.notifier.close()  # Дожидаемся уведомлений админу
+            results[action] = {
+                'executed': guard.executed - executed,
+                'duplicates': guard.duplicates - duplicates,
+                'edits': session.count('EditMessageText'),
+                'admin': sum(1 for method, chat_id, _ in session.requests
+                             if method == 'SendMessage' and chat_id == bench.ADMIN_ID),
+            }
+    finally:
+        bot.throttle.enabled = bot.THROTTLE
+
+    rows = database._reader().execute(
+        "SELECT status, COUNT(*) FROM appointments WHERE user_id = ? GROUP BY status", (user_id,)
+    ).fetchall()
+    expect(rows == [('cancelled', 1)], f"записи пользователя после шторма: {rows}")
+    visits = database.get_client_info(user_id)[2]
+    expect(visits == 1, f"total_visits = {visits}, а не 1")
+    for action, r in results.items():
+        once = {'executed': 1, 'duplicates': DUPLICATE_TAPS - 1, 'edits': 1, 'admin': 1}
+        expect(r == once, f"{action}: {r}, ожидалось {once}")
+    return f"по {DUPLICATE_TAPS} нажатий подтверждения и отмены: каждое действие выполнено один раз"
+
+
+@check
+async def slot_index() -> str:
+    """
+    После сотен одновременных броней и отмен в разных потоках индекс
+    слотов совпадает с таблицей (verify_slot_index). Испорченный индекс
+    сверка находит, а /rebuild_stats сообщает об этом и загружает его
+    из базы заново.
+    """
+    database = await use_database('slot_index')
+    service_keys = list(bot.SERVICES)
+    await bot.db.add_client(SLOT_ID, 'check', 'Проверка', '+79000000000')
+    random.seed(SLOT_OPERATIONS)
+
+    async def book(i: int):
+        service_key = service_keys[i % len(service_keys)]
+        appointment_id = await bot.db.reserve_appointment(
+            SLOT_ID, bot.SERVICES[service_key]['name'], service_key, bench.far_day(i % SLOT_DAYS),
+            random.choice(bot.WORKING_HOURS), bot.SERVICES[service_key]['price']
+        )
+        if appointment_id is not None and random.random() < 0.5:
+            await bot.db.cancel_appointment(appointment_id)
+
+    await asyncio.gather(*(book(i) for i in range(SLOT_OPERATIONS)))
+    problems = await bot.db.verify_slot_index()
+    expect(not problems, f"индекс расходится с базой по датам: {problems}")
+    booked = database._reader().execute(
+        "SELECT COUNT(*) FROM appointments WHERE user_id = ? AND status = 'pending'", (SLOT_ID,)
+    ).fetchone()[0]
+
+    # Контроль: лишний интервал в индексе сверка обязана заметить
+    corrupted = bench.far_day(SLOT_DAYS)
+    database.slots.add(corrupted, bot.WORKING_HOURS[0], bot.DEFAULT_DURATION, force=True)
+    problems = await bot.db.verify_slot_index()
+    expect(problems == [corrupted], f"сверка испорченного индекса вернула {problems}, а не [{corrupted}]")
+
+    session = bot.bot.session = RecordingSession()
+    await bot.dp.feed_update(bot.bot, bench.message_update(bench.ADMIN_ID, '/rebuild_stats'))
+    expect(session.count('SendMessage', 'Индекс слотов расходится') == 1, "/rebuild_stats не сообщил о расхождении индекса")
+    problems = await bot.db.verify_slot_index()
+    expect(not problems, f"после /rebuild_stats индекс всё ещё расходится: {problems}")
+    return f"{SLOT_OPERATIONS} броней и отмен ({booked} активных): индекс сходится, порча найдена и исправлена"
+
+
+@check
+async def short_notice_reminders() -> str:
+    """
+    Запись меньше чем за REMINDER_LEAD до визита остаётся без напоминания
+    и сразу после записи, и после перечитывания горизонта (перезапуска).
+    Запись, напоминание о которой пришлось на простой бота, напоминается
+    сразу после загрузки.
+    """
+    database = await use_database('short_notice_reminders')
+    service_key = next(iter(bot.SERVICES))
+    service = bot.SERVICES[service_key]
+    await bot.db.add_client(REMINDER_ID, 'check', 'Проверка', '+79000000000')
+    lead = bot.REMINDER_LEAD
+    visit = datetime.now() + lead / 2
+    ids = {}
+    for name, minutes in (('short', 0), ('missed', 1)):
+        moment = visit + timedelta(minutes=minutes)
+        ids[name] = database.add_appointment(
+            REMINDER_ID, service['name'], service_key, moment.strftime("%Y-%m-%d"), moment.strftime("%H:%M"), service['price']
+        )
+    # Вторую запись сделали заранее, но бот был выключен, когда подошёл срок напоминания
+    with database._write_lock, database._writer as conn:
+        conn.execute("UPDATE appointments SET created_at = datetime('now', ?) WHERE id = ?",
+                     (f"-{int(2 * lead.total_seconds())} seconds", ids['missed']))
+
+    scheduler = bot.ReminderScheduler()
+    await scheduler._load()
+    scheduler.schedule(ids['short'], visit.strftime("%Y-%m-%d"), visit.strftime("%H:%M"))
+    expect(ids['short'] not in scheduler._due, "короткая запись попала в очередь напоминаний")
+    expect(ids['missed'] in scheduler._due, "пропущенное напоминание не загружено")
+
+    restarted = bot.ReminderScheduler()
+    await restarted._load()
+    expect(ids['short'] not in restarted._due, "после перезапуска короткая запись получила напоминание")
+
+    session = bot.bot.session = RecordingSession()
+    restarted.start()
+    try:
+        for _ in range(100):
+            if restarted.sent:
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        await restarted.close()
+    reminded = dict(database._reader().execute(
+        "SELECT id, reminded_at IS NOT NULL FROM appointments WHERE user_id = ?", (REMINDER_ID,)
+    ).fetchall())
+    expect(reminded == {ids['short']: 0, ids['missed']: 1}, f"отметки reminded_at: {reminded}")
+    sent = sum(1 for method, chat_id, _ in session.requests if method == 'SendMessage' and chat_id == REMINDER_ID)
+    expect(sent == 1, f"клиенту ушло {sent} напоминаний вместо одного")
+    return f"запись за {lead / 2} до визита без напоминания, пропущенное отправлено после загрузки"
+
+
+# ================================
+# 🚀 ЗАПУСК
+# ================================
+
+async def run(names: List[str]) -> List[str]:
+    print(f"aiogram {aiogram_version}, Python {sys.version.split()[0]}\n")
+    bot.dp.include_router(bot.router)
+    bot.bot.session = RecordingSession()
+    failed = []
+    for name in names:
+        try:
+            summary = await CHECKS[name]()
+        except AssertionError as e:
+            failed.append(name)
+            print(f"❌ {name}: {e}")
+        except Exception as e:
+            failed.append(name)
+            print(f"❌ {name}: упала с {type(e).__name__}: {e}")
+        else:
+            print(f"✅ {name}: {summary}")
+    await bot.notifier.close()
+    await bot.db.close()
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверки поведения бота под нагрузкой")
+    parser.add_argument('names', nargs='*', metavar='CHECK',
+                        help=f"Проверки для запуска (по умолчанию все): {', '.join(CHECKS)}")
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in CHECKS]
+    if unknown:
+        parser.error(f"неизвестные проверки: {', '.join(unknown)}")
+
+    failed = asyncio.run(run(args.names or list(CHECKS)))
+    if failed:
+        print(f"\n❌ Не прошли: {', '.join(failed)}")
+        sys.exit(1)
+    print("\n✅ Все проверки прошли")
+
+
+if __name__ == "__main__":
+    main()